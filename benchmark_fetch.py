@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""レース1件あたりのHTTPリクエスト数を計測するベンチマーク
+
+使い方: python benchmark_fetch.py [race_id ...]
+
+legacy は従来の実装 (BeautifulSoup 用と pandas.read_html 用に同じURLを2回取得) を、
+fetch_once は fetch_page で取得した1つの文書を使い回す現在の実装を計測する。
+"""
+import sys
+import time
+from common.fetch import fetch_page, fetch_stats
+from common.page_cache import page_cache
+from common.scrape import scrape_race_info
+
+
+DEFAULT_RACE_ID_LIST = ['202105050811', '202106050811', '202109050611']
+
+
+def legacy_scrape_race_info(race_id: str) -> None:
+    url = 'https://db.sp.netkeiba.com/race/' + race_id
+    fetch_page(url).soup
+    fetch_page(url).tables
+
+
+def measure(func, race_id_list):
+    fetch_stats.reset()
+    start = time.perf_counter()
+    for race_id in race_id_list:
+        func(race_id)
+    elapsed = time.perf_counter() - start
+    n_races = len(race_id_list)
+    return fetch_stats.requests / n_races, fetch_stats.bytes / n_races, elapsed / n_races
+
+
+def main(args):
+    race_id_list = args[1:] if len(args) > 1 else DEFAULT_RACE_ID_LIST
+    # ネットワークへのリクエスト数を比較するため、キャッシュは使わない
+    page_cache.set_mode('off')
+
+    print('{:<12}{:>16}{:>16}{:>16}'.format('mode', 'requests/race', 'KB/race', 'sec/race'))
+    for name, func in [('legacy', legacy_scrape_race_info), ('fetch_once', scrape_race_info)]:
+        n_requests, n_bytes, sec = measure(func, race_id_list)
+        print('{:<12}{:>16.2f}{:>16.1f}{:>16.2f}'.format(name, n_requests, n_bytes / 1024, sec))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""過去成績の結合 (HorseResults.merge_all) の速度を、従来の日付ごとのループと比較するベンチマーク
+
+使い方: python benchmark_merge.py [begin_date] [end_date] [db_path]
+
+同じレース結果と過去成績に対して merge_all_per_date (従来) と merge_all (AsOfEngine) を実行し、
+それぞれの時間と、結果が一致するか (列・行・値の最大誤差) を表示する。
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from common.data_processor import HorseResults, Results
+from common.db_config import db_config
+
+
+DEFAULT_BEGIN_DATE = 20150101
+DEFAULT_END_DATE = 20211231
+
+
+def compare(expected: pd.DataFrame, actual: pd.DataFrame) -> str:
+    if expected.columns.tolist() != actual.columns.tolist():
+        return 'columns differ'
+    if not expected.index.equals(actual.index) or not expected['horse_id'].equals(actual['horse_id']):
+        return 'rows differ'
+    numeric = expected.select_dtypes('number').columns
+    diff = (expected[numeric] - actual[numeric]).abs().max().max()
+    same_nan = (expected[numeric].isna() == actual[numeric].isna()).all().all()
+    others = expected.columns.difference(numeric)
+    if not same_nan or not expected[others].equals(actual[others]):
+        return 'values differ'
+    return 'match (max abs diff {:.3g})'.format(diff if not np.isnan(diff) else 0.0)
+
+
+def main(args):
+    begin_date = int(args[1]) if len(args) > 1 else DEFAULT_BEGIN_DATE
+    end_date = int(args[2]) if len(args) > 2 else DEFAULT_END_DATE
+    db_path = args[3] if len(args) > 3 else db_config['main']
+
+    r = Results.read_db(db_path, begin_date=begin_date, end_date=end_date, flat_only=True)
+    hr = HorseResults.read_db(db_path)
+    print('{} results, {} race dates, {} horse results'.format(
+        len(r.data_p), r.data_p['date'].nunique(), len(hr.data_p)))
+
+    start = time.perf_counter()
+    expected = hr.merge_all_per_date(r.data_p)
+    per_date = time.perf_counter() - start
+
+    # 並べ替えと累積和の計算 (初回のみ) も含めて計測する
+    hr = HorseResults(hr.data)
+    start = time.perf_counter()
+    actual = hr.merge_all(r.data_p)
+    engine = time.perf_counter() - start
+
+    print('{:<20}{:>12}'.format('method', 'sec'))
+    print('{:<20}{:>12.2f}'.format('merge_all_per_date', per_date))
+    print('{:<20}{:>12.2f}'.format('merge_all', engine))
+    print('speedup: {:.1f}x, {}'.format(per_date / engine, compare(expected, actual)))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""HTML解析バックエンドごとの解析速度を計測するベンチマーク
+
+使い方: python benchmark_parser.py [cache_dir]
+
+page_cache に保存済みのページを解析し、バックエンドごとの pages/sec と、
+html.parser と結果が一致しないページの数を表示する。
+"""
+import re
+import sys
+import time
+import pandas as pd
+from common.fetch import DEFAULT_ENCODING, Page
+from common.page_cache import DEFAULT_CACHE_DIR, PageCache
+from common.parser import PARSER_BACKENDS, set_parser
+from common.scrape import parse_horse_results, parse_race_card, parse_race_info
+
+
+PAGE_PARSERS = [
+    (re.compile(r'^https://db\.sp\.netkeiba\.com/race/\d+'), lambda page: parse_race_info(page)),
+    (re.compile(r'^https://db\.netkeiba\.com/horse/result/'), lambda page: parse_horse_results(page)),
+    (re.compile(r'^https://race\.netkeiba\.com/race/shutuba\.html\?race_id=(\d+)'),
+     lambda page: parse_race_card(page, re.findall(r'race_id=(\d+)', page.url)[0], 0)),
+]
+
+
+def load_corpus(cache_dir):
+    corpus = []
+    for entry in PageCache(cache_dir).iter_entries():
+        for pattern, func in PAGE_PARSERS:
+            if pattern.search(entry.url):
+                corpus.append((entry.url, entry.content.decode(DEFAULT_ENCODING, errors='replace'), func))
+                break
+    return corpus
+
+
+def parse_all(corpus):
+    outputs = []
+    for url, text, func in corpus:
+        try:
+            outputs.append(func(Page(url, text)))
+        except Exception as e:
+            outputs.append(e.__class__.__name__)
+    return outputs
+
+
+def is_same(a, b) -> bool:
+    if isinstance(a, pd.DataFrame) and isinstance(b, pd.DataFrame):
+        return a.equals(b)
+    if isinstance(a, tuple) and isinstance(b, tuple):
+        return len(a) == len(b) and all(is_same(x, y) for x, y in zip(a, b))
+    return type(a) == type(b) and a == b
+
+
+def main(args):
+    cache_dir = args[1] if len(args) > 1 else DEFAULT_CACHE_DIR
+    corpus = load_corpus(cache_dir)
+    if not corpus:
+        print('No cached pages in {}.'.format(cache_dir))
+        return
+
+    print('{} pages'.format(len(corpus)))
+    print('{:<14}{:>14}{:>14}'.format('backend', 'pages/sec', 'mismatches'))
+    baseline = None
+    for name in PARSER_BACKENDS:
+        set_parser(name)
+        start = time.perf_counter()
+        outputs = parse_all(corpus)
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = outputs
+        mismatches = sum(not is_same(a, b) for a, b in zip(baseline, outputs))
+        print('{:<14}{:>14.1f}{:>14d}'.format(name, len(corpus) / elapsed, mismatches))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""過去成績の結合 (HorseResults.merge_all) をプロセス数を変えて計測するベンチマーク
+
+使い方: python benchmark_scaling.py [begin_date] [end_date] [db_path]
+
+プロセス数 1/2/4/8 で merge_all を実行し、それぞれの時間と1プロセスに対する速度比、
+1プロセスの結果と一致するかを表示する。プロセスの起動と配列の書き出し (初回のみ) は
+計測に含めず、2回目の実行を計測する。
+"""
+import os
+import sys
+import time
+from common.data_processor import HorseResults, Results
+from common.db_config import db_config
+
+
+DEFAULT_BEGIN_DATE = 20150101
+DEFAULT_END_DATE = 20211231
+N_WORKERS_LIST = [1, 2, 4, 8]
+
+
+def main(args):
+    begin_date = int(args[1]) if len(args) > 1 else DEFAULT_BEGIN_DATE
+    end_date = int(args[2]) if len(args) > 2 else DEFAULT_END_DATE
+    db_path = args[3] if len(args) > 3 else db_config['main']
+
+    r = Results.read_db(db_path, begin_date=begin_date, end_date=end_date, flat_only=True)
+    hr = HorseResults.read_db(db_path)
+    print('{} results, {} horse results, {} cpus'.format(len(r.data_p), len(hr.data_p), os.cpu_count()))
+
+    print('{:<10}{:>12}{:>12}{:>10}'.format('workers', 'sec', 'speedup', 'match'))
+    baseline = None
+    for n_workers in N_WORKERS_LIST:
+        hr_n = HorseResults(hr.data, n_workers)
+        hr_n.merge_all(r.data_p)
+        start = time.perf_counter()
+        merged = hr_n.merge_all(r.data_p)
+        elapsed = time.perf_counter() - start
+        hr_n.close()
+
+        if baseline is None:
+            baseline = (merged, elapsed)
+        print('{:<10}{:>12.2f}{:>12.2f}{:>10}'.format(
+            n_workers, elapsed, baseline[1] / elapsed, str(merged.equals(baseline[0]))))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
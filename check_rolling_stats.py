@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""DBで集計した過去 N 走の平均 (RollingStats) が HorseResults.merge_all と一致するかを確認するスクリプト
+
+使い方: python check_rolling_stats.py [db_path] [n_late_races]
+
+dbファイルを一時ディレクトリに複製し、以下の順に集計して merge_all と比較する。
+    1. 最近のレースの race_info を n_late_races 件削除した状態で全て集計する
+    2. 削除した race_info を登録し直し (過去成績より後にレース情報が登録された場合)、差分のみ集計し直す
+元のdbファイルは変更しない。
+"""
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from common.data_processor import HorseResults
+from common.db_config import db_config
+from common.dbapi import DBManager
+from common.rolling_stats import DEFAULT_ROLLING_WINDOWS, RollingStats, get_rolling_columns
+
+
+DEFAULT_N_LATE_RACES = 40
+
+
+def compare(db_path: str, rolling_stats: RollingStats) -> str:
+    hr = HorseResults.read_db(db_path, use_replica=False)
+    targets = hr.data_p.reset_index()[['race_id', 'horse_id', 'date']].set_index('race_id')
+    expected = hr.merge_all(targets, DEFAULT_ROLLING_WINDOWS).reset_index()
+    actual = expected[['race_id', 'horse_id']].merge(rolling_stats.select(), on=['race_id', 'horse_id'], how='left')
+
+    n_diff = 0
+    for column in get_rolling_columns(DEFAULT_ROLLING_WINDOWS):
+        e = expected[column].astype(float).values
+        a = actual[column].astype(float).values
+        if not np.allclose(e, a, rtol=1e-9, atol=1e-9, equal_nan=True):
+            n_diff += 1
+    return '{} rows, {} of {} columns differ'.format(len(expected), n_diff, len(get_rolling_columns(DEFAULT_ROLLING_WINDOWS)))
+
+
+def main(args):
+    db_path = args[1] if len(args) > 1 else db_config['main']
+    n_late_races = int(args[2]) if len(args) > 2 else DEFAULT_N_LATE_RACES
+
+    tmp_dir = tempfile.mkdtemp(prefix='check_rolling_stats_')
+    try:
+        tmp_path = os.path.join(tmp_dir, os.path.basename(db_path))
+        shutil.copyfile(db_path, tmp_path)
+        dbm = DBManager(tmp_path)
+        rolling_stats = RollingStats(dbm)
+
+        # 過去成績があるレースのうち、最近のレースの race_info を取り除く
+        late = dbm.select_data(
+            'SELECT * FROM race_info WHERE race_id IN (SELECT race_id FROM horse_results) '
+            'ORDER BY date DESC LIMIT {}'.format(n_late_races))
+        dbm.execute_many('DELETE FROM race_info WHERE race_id=?', ((race_id,) for race_id in late['race_id']))
+        rolling_stats.refresh(full=True)
+        print('before late race_info: {}'.format(compare(tmp_path, rolling_stats)))
+
+        placeholders = ','.join(['?'] * len(late.columns))
+        dbm.execute_many('INSERT INTO race_info VALUES ({})'.format(placeholders),
+                         (tuple(None if pd.isna(v) else (v.item() if isinstance(v, np.generic) else v) for v in row) for row in late.itertuples(index=False, name=None)))
+        n_horses = rolling_stats.refresh()
+        print('after {} late race_info ({} horses refreshed): {}'.format(len(late), n_horses, compare(tmp_path, rolling_stats)))
+        dbm.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Union
+import numpy as np
+import pandas as pd
+from common.history_index import AVE_TARGET_COLUMNS, HorseHistoryIndex, to_days
+from common.utils import InvalidArgument
+
+
+# 計算用のプロセスの数の既定値 (1 の場合はプロセスを使わない)
+DEFAULT_N_WORKERS = 1
+# これより対象が少ない場合は、プロセスに分けずに計算する (出馬表など)
+MIN_PARALLEL_TARGETS = 10000
+
+
+def _rolling_averages(
+        values: np.ndarray,
+        ends: np.ndarray,
+        n_active: np.ndarray,
+        ave_samples_list: List[Union[int, str]]
+    ) -> Dict[Union[int, str], np.ndarray]:
+    """新しい出走から順に和を取り、N 走目までの平均を返す
+
+    対象は出走数の多い順に並び、k 走目を持つ対象は先頭の n_active[k] 件とする。
+    """
+    n_targets = len(ends)
+    sums = np.zeros(n_targets)
+    compensation = np.zeros(n_targets)
+    counts = np.zeros(n_targets, dtype=np.int64)
+    averages = {}
+
+    def snapshot():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    for k, a in enumerate(n_active):
+        v = values[ends[:a] - 1 - k]
+        valid = ~np.isnan(v)
+        y = v - compensation[:a]
+        t = sums[:a] + y
+        compensation[:a] = np.where(valid, t - sums[:a] - y, compensation[:a])
+        sums[:a] = np.where(valid, t, sums[:a])
+        counts[:a] += valid
+        for n_samples in ave_samples_list:
+            if n_samples == k + 1:
+                averages[n_samples] = snapshot()
+
+    # 出走数が N 未満の対象は全ての出走の平均となる
+    for n_samples in ave_samples_list:
+        if n_samples not in averages:
+            averages[n_samples] = snapshot()
+    return averages
+
+
+def _get_n_active(n_history: np.ndarray) -> np.ndarray:
+    """出走数の多い順に並んだ対象について、k 走目を持つ対象の数"""
+    max_history = n_history[0] if len(n_history) else 0
+    return np.searchsorted(-n_history, -np.arange(max_history), side='left')
+
+
+# 計算用のプロセスが読み込んだ過去成績 (列 -> メモリマップした配列)
+_worker_values: Dict[str, np.ndarray] = {}
+
+
+def _init_worker(array_dir: str, columns: List[str]) -> None:
+    global _worker_values
+    _worker_values = {column: np.load(os.path.join(array_dir, '{}.npy'.format(i)), mmap_mode='r')
+                      for i, column in enumerate(columns)}
+
+
+def _compute_chunk(
+        ends: np.ndarray,
+        n_history: np.ndarray,
+        ave_samples_list: List[Union[int, str]]
+    ) -> Dict[str, Dict[Union[int, str], np.ndarray]]:
+    n_active = _get_n_active(n_history)
+    return {column: _rolling_averages(values, ends, n_active, ave_samples_list)
+            for column, values in _worker_values.items()}
+
+
+class AsOfEngine:
+    """過去成績から、各レースの時点 (その日より前) の直近 N 走の平均を一括で計算するクラス
+
+    過去成績は馬ごとの索引 (HorseHistoryIndex) として1度だけ (馬, 日付) 順に並べる。
+    対象のレース (馬, 日付) ごとに、その日より前の出走の範囲を二分探索で求め、
+    全ての対象について新しい出走から順に1走ずつ和を取る (k 走目の処理は全ての対象を配列でまとめて行う)。
+    和は pandas の groupby().mean() と同じ順番と補正 (Kahan summation) で取るため、
+    HorseResults.merge_all_per_date (日付ごとのループ) と完全に同じ値を返す。
+
+    Parameters
+    ----------
+    history : pandas.DataFrame or HorseHistoryIndex
+        前処理済みの過去成績 (HorseResults.data_p, index: 馬ID)、または作成済みの索引
+    target_columns : list[str], default AVE_TARGET_COLUMNS
+        平均を取る列 (history が索引の場合は、索引の列を使う)
+    n_workers : int, default DEFAULT_N_WORKERS
+        計算用のプロセスの数。2以上の場合は、対象を出走数で均等になるように分けてプロセスで計算する。
+        過去成績の配列は一時ディレクトリに書き出し、各プロセスはメモリマップして読み込む
+        (プロセスごとに pickle で渡さない)。使い終わったら close を呼ぶこと
+        (ガベージコレクションやインタプリタの終了時に待たされないよう、__del__ では終了しない)。
+    """
+
+    def __init__(
+            self,
+            history: Union[pd.DataFrame, HorseHistoryIndex],
+            target_columns: List[str] = AVE_TARGET_COLUMNS,
+            n_workers: int = DEFAULT_N_WORKERS
+        ) -> None:
+        self._executor = None
+        self._array_dir = None
+        if n_workers < 1:
+            raise InvalidArgument("'n_workers' must be >=1")
+        self.n_workers = n_workers
+
+        if isinstance(history, HorseHistoryIndex):
+            self.index = history
+        else:
+            self.index = HorseHistoryIndex.build(history, target_columns)
+        self.target_columns = list(self.index.columns)
+
+    def _start_workers(self) -> None:
+        self._array_dir = tempfile.mkdtemp(prefix='asof_engine_')
+        for i, column in enumerate(self.target_columns):
+            np.save(os.path.join(self._array_dir, '{}.npy'.format(i)), self.index.columns[column])
+        self._executor = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                             initargs=(self._array_dir, self.target_columns))
+
+    def close(self) -> None:
+        """計算用のプロセスを終了し、書き出した配列を削除する"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._array_dir is not None:
+            shutil.rmtree(self._array_dir, ignore_errors=True)
+            self._array_dir = None
+
+    def _compute_parallel(
+            self,
+            ends: np.ndarray,
+            n_history: np.ndarray,
+            ave_samples_list: List[Union[int, str]]
+        ) -> Dict[str, Dict[Union[int, str], np.ndarray]]:
+        """出走数の多い順に並んだ対象を1つおきに分け (出走数の合計がほぼ等しくなる)、プロセスで計算する"""
+        if self._executor is None:
+            self._start_workers()
+        chunks = [slice(i, None, self.n_workers) for i in range(self.n_workers)]
+        futures = [self._executor.submit(_compute_chunk, ends[chunk], n_history[chunk], ave_samples_list)
+                   for chunk in chunks]
+
+        averages = {column: {n_samples: np.empty(len(ends)) for n_samples in ave_samples_list}
+                    for column in self.target_columns}
+        for chunk, future in zip(chunks, futures):
+            for column, column_averages in future.result().items():
+                for n_samples, values in column_averages.items():
+                    averages[column][n_samples][chunk] = values
+        return averages
+
+    def compute(self, horse_id: pd.Series, date: pd.Series, ave_samples_list: List[Union[int, str]] = [5, 9, 'all']) -> pd.DataFrame:
+        """(馬, 日付) ごとに、前走からの日数と直近 N 走の平均を返す
+
+        Returns
+        -------
+        pandas.DataFrame
+            'l_days' と '<列>_<N>R' の列 (行は引数の順)
+        """
+        for n_samples in ave_samples_list:
+            if n_samples != 'all' and not n_samples > 0:
+                raise InvalidArgument("'n_samples' must be >0")
+
+        starts, ends = self.index.locate(horse_id, date)
+        has_history = ends > starts
+
+        l_days = np.full(len(starts), np.nan)
+        l_days[has_history] = to_days(date)[has_history] - self.index.days[ends[has_history] - 1]
+        features = {'l_days': l_days if not has_history.all() else l_days.astype(np.int64)}
+
+        # k 走目を持つ対象が先頭の n_active[k] 件になるように、出走数の多い順に並べる
+        n_history = ends - starts
+        order = np.argsort(-n_history, kind='stable')
+        n_active = _get_n_active(n_history[order])
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+
+        if self.n_workers == 1 or len(order) < MIN_PARALLEL_TARGETS:
+            averages = {column: _rolling_averages(self.index.columns[column], ends[order], n_active, ave_samples_list)
+                        for column in self.target_columns}
+        else:
+            averages = self._compute_parallel(ends[order], n_history[order], ave_samples_list)
+        for n_samples in ave_samples_list:
+            for column in self.target_columns:
+                features['{}_{}R'.format(column, n_samples)] = averages[column][n_samples][inverse]
+
+        return pd.DataFrame(features, index=horse_id.index)
+
+    def merge(self, results: pd.DataFrame, ave_samples_list: List[Union[int, str]] = [5, 9, 'all']) -> pd.DataFrame:
+        """results の各行に、前走からの日数と直近 N 走の平均を結合する
+
+        行の順番は HorseResults.merge_all_per_date と同じ (開催日が最初に現れた順、同じ開催日の中は元の順)。
+        """
+        date_codes, _ = pd.factorize(results['date'])
+        df = results.iloc[np.argsort(date_codes, kind='stable')]
+        features = self.compute(df['horse_id'], df['date'], ave_samples_list)
+        return pd.concat([df, features], axis=1)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple, Union
+from urllib.parse import urlparse
+from common.utils import InvalidArgument
+
+
+# ホストごとのレート制限 (1秒あたりのリクエスト数, バースト上限)
+HOST_RATE_LIMITS = {
+    'db.sp.netkeiba.com': (1.0, 1),
+    'db.netkeiba.com': (1.0, 1),
+    'race.netkeiba.com': (1.0, 1),
+}
+DEFAULT_RATE_LIMIT = (1.0, 1)
+DEFAULT_MAX_WORKERS = 4
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限クラス
+
+    Parameters
+    ----------
+    rate : float
+        1秒あたりに補充されるトークン数
+    capacity : int, default 1
+        バケットの容量 (連続して送信できるリクエスト数の上限)
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        if rate <= 0:
+            raise InvalidArgument("'rate' must be >0")
+        if capacity < 1:
+            raise InvalidArgument("'capacity' must be >=1")
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """トークンを1つ取得する (取得できるまでブロックする)"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """ホスト単位のレート制限クラス
+
+    Parameters
+    ----------
+    limits : dict[str, tuple[float, int]], optional
+        ホスト名 -> (1秒あたりのリクエスト数, バースト上限)
+    default : tuple[float, int], default DEFAULT_RATE_LIMIT
+        limits に無いホストに適用するレート制限
+    """
+
+    def __init__(
+            self,
+            limits: Dict[str, Tuple[float, int]] = None,
+            default: Tuple[float, int] = DEFAULT_RATE_LIMIT
+        ) -> None:
+        self._default = default
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        if limits is not None:
+            for host, (rate, capacity) in limits.items():
+                self.set_limit(host, rate, capacity)
+
+    def set_limit(self, host: str, rate: float, capacity: int = 1) -> None:
+        with self._lock:
+            self._buckets[host] = TokenBucket(rate, capacity)
+
+    def acquire(self, url: str) -> None:
+        """url のホストに対するトークンを取得する"""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(*self._default)
+            bucket = self._buckets[host]
+        bucket.acquire()
+
+
+# 全スクレイパーで共有するレート制限
+rate_limiter = RateLimiter(HOST_RATE_LIMITS)
+
+
+class Crawler:
+    """IDのバッチを並行してスクレイピングするクラス
+
+    スループットはスレッド数ではなく rate_limiter のホスト単位の制限で決まる。
+
+    Parameters
+    ----------
+    max_workers : int, default DEFAULT_MAX_WORKERS
+        並行実行するスレッド数
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS) -> None:
+        if max_workers < 1:
+            raise InvalidArgument("'max_workers' must be >=1")
+        self.max_workers = max_workers
+
+    def map(
+            self,
+            func: Callable[..., Any],
+            id_list: Iterable[str],
+            **kwargs
+        ) -> Iterator[Tuple[str, Any, Union[Exception, None]]]:
+        """id_list の各IDに func を並行して適用する
+
+        Parameters
+        ----------
+        func : Callable
+            スクレイピング関数 (第1引数にIDを取る)
+        id_list : Iterable[str]
+            IDのリスト
+        **kwargs
+            func に渡すキーワード引数
+
+        Yields
+        ------
+        id : str
+            ID
+        result : Any
+            func の戻り値 (例外発生時は None)
+        error : Exception or None
+            func で発生した例外
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(func, id, **kwargs): id for id in id_list}
+            try:
+                for future in as_completed(futures):
+                    id = futures[future]
+                    try:
+                        yield id, future.result(), None
+                    except Exception as e:
+                        yield id, None, e
+            finally:
+                # 途中で中断された場合は未着手のリクエストを破棄する
+                for future in futures:
+                    future.cancel()
@@ -7,7 +7,7 @@ import weakref
 sys.path.append(os.pardir)
 import datetime as dt
 import re
-from typing import List, Tuple, Union
+from typing import Iterator, List, Tuple, Union
 import warnings
 import pandas as pd
 import itertools
@@ -18,8 +18,15 @@ if get_environment() == 'Jupyter':
     from tqdm.notebook import tqdm
 else:
     from tqdm import tqdm
-from common.dbapi import DBManager
+from common.asof_engine import DEFAULT_N_WORKERS, AsOfEngine
+from common.dbapi import DBManager, reader_pool
+from common.derived_columns import fill_horse_results_derived_columns, fill_results_derived_columns
+from common.feature_store import FeatureStore
+from common.history_index import AVE_TARGET_COLUMNS, HorseHistoryIndex
+from common.replica import sync_replica
+from common.rolling_stats import RollingStats
 from common.scrape import scrape_race_card
+from common.snapshot import DEFAULT_SNAPSHOT_DIR, Snapshot
 
 
 def split_data(df: pd.DataFrame, test_size: float = 0.3) -> Tuple[pd.DataFrame, pd.DataFrame]:
@@ -102,11 +109,19 @@ class Peds:
         self.encode()
 
     @classmethod
-    def read_db(cls, db_path: str):
-        dbm = DBManager(db_path)
-        df = dbm.select_horse_peds()
+    def read_db(cls, db_path: str, use_replica: bool = True):
+        """DBから血統を読み込む (use_replica が True の場合は、同期したローカルのレプリカから読み込む)"""
+        if use_replica:
+            db_path = sync_replica(db_path)
+        with reader_pool.reader(db_path) as dbm:
+            df = dbm.select_horse_peds()
         return cls(df)
 
+    @classmethod
+    def read_snapshot(cls, snapshot_dir: str = DEFAULT_SNAPSHOT_DIR) -> 'Peds':
+        """snapshot.py で書き出したスナップショットから読み込む"""
+        return cls(Snapshot(snapshot_dir).read_peds())
+
     def encode(self):
         df = self.data.copy()
         le = LabelEncoder().fit(list(set(itertools.chain.from_iterable(df.fillna('Na').values))))
@@ -115,50 +130,58 @@ class Peds:
         self.data_e = df
 
 
+HORSE_RESULTS_COLUMNS = ['race_id', 'horse_id', 'date', 'place_id',
+                         'weather', 'race_no', 'horse_no',
+                         'win_odds', 'popularity',
+                         'arriving_order', 'ground', 'goal_time_sec',
+                         'race_type', 'distance', 'ground', 'time_diff',
+                         'first_corner', 'last_corner', 'last_three_furlong', 'prise',
+                         'horse_num']
+
+
 class HorseResults:
-    def __init__(self, result_df: pd.DataFrame) -> None:
-        self.data = result_df[['race_id', 'horse_id', 'date', 'place_id',
-                               'weather', 'race_no', 'horse_no',
-                               'win_odds', 'popularity',
-                               'arriving_order', 'ground', 'goal_time',
-                               'race_type', 'distance', 'ground', 'time_diff',
-                               'corner_pass', 'last_three_furlong', 'prise',
-                               'horse_num']]
+    def __init__(self, result_df: pd.DataFrame, n_workers: int = DEFAULT_N_WORKERS) -> None:
+        """n_workers は merge_all で使う計算用のプロセスの数 (AsOfEngine を参照)"""
+        self.data = fill_horse_results_derived_columns(result_df)[HORSE_RESULTS_COLUMNS]
         self.data_p = pd.DataFrame()
         self.preprocesing()
+        self.n_workers = n_workers
+        self._history_index = None
+        self._engine = None
 
     @classmethod
-    def read_db(cls, db_path: str) -> 'Results':
-        dbm = DBManager(db_path)
-        df = dbm.select_horse_results()
-        return cls(df)
+    def read_db(cls, db_path: str, use_replica: bool = True, n_workers: int = DEFAULT_N_WORKERS) -> 'HorseResults':
+        """DBから過去成績を読み込む (use_replica が True の場合は、同期したローカルのレプリカから読み込む)"""
+        if use_replica:
+            db_path = sync_replica(db_path)
+        with reader_pool.reader(db_path) as dbm:
+            df = dbm.select_horse_results()
+        return cls(df, n_workers)
+
+    @classmethod
+    def read_snapshot(
+            cls,
+            snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+            begin_date: int = None,
+            end_date: int = None,
+            n_workers: int = DEFAULT_N_WORKERS
+        ) -> 'HorseResults':
+        """snapshot.py で書き出したスナップショットから、使う列と対象の年のみを読み込む"""
+        columns = list(dict.fromkeys(HORSE_RESULTS_COLUMNS))
+        df = Snapshot(snapshot_dir).read('horse_results', columns, begin_date, end_date)
+        return cls(df, n_workers)
 
     def preprocesing(self) -> None:
         df = self.data.copy()
 
-        def convert_time(x):
-            try:
-                return float(x.split(':')[0]) * 60.0 + float(x.split(':')[1])
-            except:
-                return np.nan
-
-        # 型変換
+        # 型変換 (タイムと通過順は登録時に計算した列を使う)
         df['arriving_order'] = pd.to_numeric(df['arriving_order'], errors='coerce')
         df[df['arriving_order']==1]['time_diff'].fillna(0, inplace=True)
         df['date'] = pd.to_datetime(df['date'], format='%Y%m%d')
-        df['goal_time'] = df['goal_time'].map(convert_time, na_action='ignore')
-
-        def corner(x, n):
-            if type(x) != str:
-                return x
-            elif n == 4:
-                return int(re.findall(r'\d+', x)[-1])
-            elif n == 1:
-                return int(re.findall(r'\d+', x)[0])
-
-        # 通過順
-        df['first_corner'] = df['corner_pass'].map(lambda x: corner(x, 1))
-        df['last_corner'] = df['corner_pass'].map(lambda x: corner(x, 4))
+        df.rename(columns={'goal_time_sec': 'goal_time'}, inplace=True)
+        df['goal_time'] = df['goal_time'].astype(float)
+        df['first_corner'] = df['first_corner'].astype(float)
+        df['last_corner'] = df['last_corner'].astype(float)
 
         # 頭数で割る
         df['arriving_order'] = df['arriving_order'] / df['horse_num']
@@ -178,10 +201,7 @@ class HorseResults:
         return td.map(lambda x: x.days)
 
     def _get_average(self, target_df: pd.DataFrame, n_samples: Union[int, str] = 'all'):
-        ave_target_cols = [
-            'arriving_order', 'popularity', 'distance', 'goal_time', 'time_diff', 'last_three_furlong',
-            'first_corner', 'last_corner', 'prise'
-        ]
+        ave_target_cols = AVE_TARGET_COLUMNS
 
         if n_samples == 'all':
             filtered_df = target_df
@@ -205,6 +225,29 @@ class HorseResults:
         return merged_df
 
     def merge_all(self, results: pd.DataFrame, ave_samples_list: List[Union[int, str]] = [5, 9, 'all']) -> pd.DataFrame:
+        """各レースの時点での過去成績 (前走からの日数と直近 N 走の平均) を結合する
+
+        過去成績を1度だけ並べ替えた AsOfEngine で全てのレースを一括で計算する。
+        結果は merge_all_per_date と同じ。
+        """
+        if self._engine is None:
+            self._engine = AsOfEngine(self.history_index, n_workers=self.n_workers)
+        return self._engine.merge(results, ave_samples_list)
+
+    @property
+    def history_index(self) -> HorseHistoryIndex:
+        """馬ごとの過去成績の索引 (初回のみ作成する)。save で保存し、RaceCard.merge_horse_results に渡せる"""
+        if self._history_index is None:
+            self._history_index = HorseHistoryIndex.build(self.data_p)
+        return self._history_index
+
+    def close(self) -> None:
+        """merge_all で起動した計算用のプロセスを終了する"""
+        if self._engine is not None:
+            self._engine.close()
+
+    def merge_all_per_date(self, results: pd.DataFrame, ave_samples_list: List[Union[int, str]] = [5, 9, 'all']) -> pd.DataFrame:
+        """開催日ごとに過去成績を絞り込んで結合する (AsOfEngine を使う前の実装。比較用)"""
         date_list = results['date'].unique()
         merged_df = pd.concat([self._merge_per_date(results, date, ave_samples_list) for date in tqdm(date_list)])
         return merged_df
@@ -218,11 +261,50 @@ class DataProcessor:
         self.data_pe = pd.DataFrame()
         self.data_c = pd.DataFrame()
 
-    def merge_horse_results(self, hr: HorseResults, ave_samples_list: List[Union[int, str]] = [5, 9, 'all']) -> None:
+    def merge_horse_results(
+            self,
+            hr: HorseResults,
+            ave_samples_list: List[Union[int, str]] = [5, 9, 'all'],
+            feature_store: FeatureStore = None,
+            incremental: bool = False
+        ) -> None:
+        """過去成績を結合する
+
+        feature_store を指定した場合は、保存済みの特徴量を再利用する。
+        incremental が True の場合は、前回までに処理した最終開催日より後のレースのみ計算して追記する。
+        """
         df = self.data_p.copy()
-        df = hr.merge_all(df, ave_samples_list)
+        if feature_store is None:
+            df = hr.merge_all(df, ave_samples_list)
+        else:
+            df = feature_store.get_merged(df, hr, ave_samples_list, incremental=incremental)
         self.data_m = df
 
+    def merge_rolling_stats(
+            self,
+            db_path: str,
+            ave_samples_list: List[Union[int, str]] = [5, 9, 'all'],
+            use_replica: bool = True
+        ) -> None:
+        """DBで集計した過去 N 走の平均を (race_id, horse_id) で結合する
+
+        特徴量の列と値は merge_horse_results と同じだが、以下が異なる。
+            - 行は data_p の順のまま (merge_all は開催日が最初に現れた順に並べ替える)
+            - horse_results に登録されていない (馬, レース) の行は全て NaN となる
+        集計はレプリカで、結合の前に差分のみ更新する。
+        """
+        if use_replica:
+            db_path = sync_replica(db_path)
+        dbm = DBManager(db_path)
+        rolling_stats = RollingStats(dbm, ave_samples_list)
+        rolling_stats.refresh()
+        date = self.data_p['date']
+        stats = rolling_stats.select(int(date.min().strftime('%Y%m%d')), int(date.max().strftime('%Y%m%d')))
+        dbm.close()
+
+        df = self.data_p.reset_index().merge(stats, on=['race_id', 'horse_id'], how='left')
+        self.data_m = df.set_index('race_id')
+
     def merge_peds(self, peds: Peds):
         self.data_pe = self.data_m.merge(peds.data_e, left_on='horse_id', right_index=True, how='left')
 
@@ -269,13 +351,28 @@ class DataProcessor:
         return df.drop(['horse_id'], axis=1)
 
 
+# Results.read_db で読み込む列 (preprocesing で削除する列は読み込まない)
+RESULTS_COLUMNS = [
+    'race_id', 'horse_no', 'frame_no', 'arriving_order', 'horse_id', 'sex', 'age', 'impost',
+    'jockey_id', 'weight', 'weight_change', 'trainer_id', 'prise', 'date', 'place_id', 'hold_no',
+    'hold_day', 'race_no', 'distance', 'race_type', 'turn', 'ground', 'weather', 'horse_num'
+]
+RESULTS_DTYPES = {
+    'horse_no': 'float32', 'frame_no': 'float32', 'impost': 'float32', 'prise': 'float32',
+    'date': 'int32', 'hold_no': 'float32', 'hold_day': 'float32', 'race_no': 'float32',
+    'distance': 'float32', 'horse_num': 'float32'
+}
+RESULTS_CHUNK_SIZE = 100000
+FLAT_RACE_TYPE_LIST = ['芝', 'ダート']
+
+
 class Results(DataProcessor):
     def __init__(self, result_df: pd.DataFrame, is_merged: bool = False) -> None:
         super().__init__()
         if is_merged:
             self.data_m = result_df
         else:
-            self.data = result_df
+            self.data = fill_results_derived_columns(result_df)
             self.preprocesing()
         self.le_horse = None
         self.le_jockey = None
@@ -287,25 +384,77 @@ class Results(DataProcessor):
             db_path: str,
             begin_date: int = None,
             end_date: int = None,
-            flat_only: bool = False
+            flat_only: bool = False,
+            chunksize: int = RESULTS_CHUNK_SIZE,
+            use_replica: bool = True
         ) -> 'Results':
+        """DBからレース結果を読み込む
+
+        preprocesing で使う列のみを型を指定して、chunksize 行ずつ読み込む。
+        use_replica が True の場合は、同期したローカルのレプリカから読み込む。
+        """
+        if use_replica:
+            db_path = sync_replica(db_path)
+        chunks = list(cls._iter_db_chunks(db_path, begin_date, end_date, flat_only, chunksize))
+        if not chunks:
+            raise InvalidArgument('No results in the specified period.')
+        return cls(pd.concat(chunks, ignore_index=True))
 
-        dbm = DBManager(db_path)
+    @classmethod
+    def iter_db(
+            cls,
+            db_path: str,
+            begin_date: int = None,
+            end_date: int = None,
+            flat_only: bool = False,
+            chunksize: int = RESULTS_CHUNK_SIZE,
+            use_replica: bool = True
+        ) -> Iterator['Results']:
+        """DBからレース結果を約 chunksize 行ずつ読み込み、前処理済みの Results を順に返す
+
+        1つのレースの結果が複数に分かれることはない。
+        """
+        if use_replica:
+            db_path = sync_replica(db_path)
+        for chunk in cls._iter_db_chunks(db_path, begin_date, end_date, flat_only, chunksize):
+            yield cls(chunk)
+
+    @staticmethod
+    def _iter_db_chunks(
+            db_path: str,
+            begin_date: int,
+            end_date: int,
+            flat_only: bool,
+            chunksize: int
+        ) -> Iterator[pd.DataFrame]:
+        race_type_list = FLAT_RACE_TYPE_LIST if flat_only else None
+        with reader_pool.reader(db_path) as dbm:
+            chunk_iter = dbm.select_results(begin_date, end_date, race_type_list,
+                                            columns=RESULTS_COLUMNS, dtype=RESULTS_DTYPES, chunksize=chunksize)
+            carry = None
+            for chunk in chunk_iter:
+                if carry is not None:
+                    chunk = pd.concat([carry, chunk], ignore_index=True)
+                # 最後のレースは次の chunk に続く可能性があるため持ち越す
+                is_last_race = chunk['race_id'] == chunk['race_id'].iat[-1]
+                carry = chunk[is_last_race]
+                if not is_last_race.all():
+                    yield chunk[~is_last_race]
+            if carry is not None and len(carry) > 0:
+                yield carry
 
-        # 条件文の生成
-        where = ''
-        if begin_date is not None:
-            where += 'date>={}'.format(begin_date)
-        if end_date is not None:
-            if where != '':
-                where += ' and '
-            where += 'date<={}'.format(end_date)
-        if flat_only:
-            if where != '':
-                where += ' and '
-            where += 'race_type IN ("芝", "ダート")'
-
-        df = dbm.select_resutls(where)
+    @classmethod
+    def read_snapshot(
+            cls,
+            snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+            begin_date: int = None,
+            end_date: int = None,
+            flat_only: bool = False
+        ) -> 'Results':
+        """snapshot.py で書き出したスナップショットから、使う列と対象の年のみを読み込む (条件は read_db と同じ)"""
+        race_type_list = FLAT_RACE_TYPE_LIST if flat_only else None
+        df = Snapshot(snapshot_dir).read('results', RESULTS_COLUMNS, begin_date, end_date, race_type_list)
+        df = df.astype(RESULTS_DTYPES).sort_values('race_id', kind='stable', ignore_index=True)
         return cls(df)
 
     @classmethod
@@ -327,13 +476,11 @@ class Results(DataProcessor):
         df['arriving_order'] = df['arriving_order'].astype(int)
         #df['rank'] = df['arriving_order'].map(lambda x: 1 if x < 4 else 0)
 
-        # 性齢
-        df['sex'] = df['sex_age'].map(lambda x: str(x)[0])
-        df['age'] = df['sex_age'].map(lambda x: re.findall(r'\d+', x)[0]).astype(int)
-
-        # 馬体重
-        df['weight'] = df['horse_weight'].str.split('(', expand=True)[0].astype(int)
-        df['weight_change'] = df['horse_weight'].str.split('(', expand=True)[1].str[:-1].astype(int)
+        # 性齢と馬体重 (登録時に計算した列を使う。列の順番は従来と揃える)
+        df['sex'] = df.pop('sex')
+        df['age'] = df.pop('age').astype(int)
+        df['weight'] = df.pop('weight').astype(int)
+        df['weight_change'] = df.pop('weight_change').astype(int)
 
         # 型変換
         df['date'] = pd.to_datetime(df['date'], format='%Y%m%d')
@@ -348,7 +495,7 @@ class Results(DataProcessor):
         df.drop(['sex_age', 'horse_weight', 'win_odds', 'popularity',
                  'corner_pass', 'owner_name', 'margin_length', 'race_title',
                  'goal_time', 'last_three_furlong', 'prise'],
-                axis=1, inplace=True)
+                axis=1, inplace=True, errors='ignore')
 
         self.data_p = df
 
@@ -432,5 +579,20 @@ class RaceCard(DataProcessor):
                           'horse_num', 'month', 'sex', 'age', 'weight',
                           'weight_change', 'win_prise']]
 
+    def merge_horse_results(
+            self,
+            hr: Union[HorseResults, HorseHistoryIndex],
+            ave_samples_list: List[Union[int, str]] = [5, 9, 'all']
+        ) -> None:
+        """過去成績を結合する
+
+        hr には HorseResults の代わりに、保存しておいた HorseHistoryIndex (HorseHistoryIndex.load) を渡せる。
+        その場合は過去成績をDBから読み込まずに、出走する馬の直近の出走のみを参照する。
+        """
+        if isinstance(hr, HorseHistoryIndex):
+            self.data_m = AsOfEngine(hr).merge(self.data_p.copy(), ave_samples_list)
+        else:
+            super().merge_horse_results(hr, ave_samples_list)
+
     def process_categorical(self, results: Results) -> None:
         super().process_categorical(results.le_horse, results.le_jockey, results.le_trainer)
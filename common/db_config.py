@@ -2,5 +2,11 @@
 
 db_config = {
     'main': "\\\\MOKAD-PI-OMV\\public\\99_work\\keiba.db",
-    'test': "D:\\Masatoshi\\Work\\db\\keiba_test.db"
+    'test': "D:\\Masatoshi\\Work\\db\\keiba_test.db",
+    # スクレイピングのジョブキュー (ローカルに置く)
+    'queue': "./crawl_queue.db",
+    # 分析用の列指向のスナップショット (ローカルに置く)
+    'snapshot': "./snapshot",
+    # 過去成績を結合した特徴量の保存先 (ローカルに置く)
+    'feature_store': "./feature_store"
 }
@@ -3,15 +3,136 @@ import os
 import sys
 from tkinter.messagebox import NO
 sys.path.append(os.pardir)
+import importlib.util
+import re
+import threading
 import warnings
-import glob
-from typing import Any, List, Tuple, Union
+from contextlib import contextmanager
+from urllib.request import pathname2url
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union
 import sqlite3
 import numpy as np
 import pandas as pd
 from common.utils import InvalidArgument
 
 
+SQL_IN_CHUNK_SIZE = 500
+# カレントディレクトリによらず、このモジュールからの相対パスで探す
+MIGRATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'sql')
+RE_MIGRATION = re.compile(r'^(\d+)_\w+\.(sql|py)$')
+CREATE_SCHEMA_VERSION_SQL = '''CREATE TABLE if not exists "schema_version" (
+	"version"	INTEGER NOT NULL,
+	"name"	TEXT NOT NULL,
+	"applied_at"	TEXT,
+	PRIMARY KEY("version")
+)'''
+
+# 接続の用途ごとの PRAGMA
+CONNECTION_PROFILES = {
+    # 登録用 (1プロセスのみ)
+    'writer': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -256 * 1024,      # 256 MiB (負の値は KiB 単位)
+        'temp_store': 'MEMORY',
+        'busy_timeout': 60 * 1000,
+    },
+    # 分析用 (読み取り専用、複数可)
+    'reader': {
+        'mmap_size': 1024 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 60 * 1000,
+        'query_only': 1,
+    },
+}
+READER_POOL_SIZE = 4
+
+
+def is_network_path(path: str) -> bool:
+    """ネットワーク共有上のパス (UNCパス) か"""
+    return path.startswith('\\\\') or path.startswith('//')
+
+
+def get_migration_list(migration_dir: str = MIGRATION_DIR) -> List[Tuple[int, str]]:
+    """マイグレーションの (バージョン, パス) のリストをバージョン順に返す"""
+    migration_list = []
+    for name in os.listdir(migration_dir):
+        m = RE_MIGRATION.match(name)
+        if m is not None:
+            migration_list.append((int(m.group(1)), os.path.join(migration_dir, name)))
+    migration_list.sort()
+
+    versions = [version for version, _ in migration_list]
+    if len(versions) != len(set(versions)):
+        raise InvalidArgument("Duplicate migration versions in '{}'".format(migration_dir))
+    return migration_list
+
+
+RE_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _check_identifier(name: str) -> str:
+    if RE_IDENTIFIER.match(name) is None:
+        raise InvalidArgument("invalid identifier: '{}'".format(name))
+    return name
+
+
+class SelectQuery:
+    """バインド変数を使うSELECT文を組み立てるクラス
+
+    Parameters
+    ----------
+    table : str
+        テーブル名
+    columns : list[str], optional
+        取得する列 (省略時は全ての列)
+
+    Examples
+    --------
+    >>> query = SelectQuery('results', ['race_id', 'date']).join('race_info', 'race_id').where('date>=?', 20150101)
+    >>> query.build()
+    ('SELECT race_id, date FROM results INNER JOIN race_info USING(race_id) WHERE (date>=?)', [20150101])
+    """
+
+    def __init__(self, table: str, columns: List[str] = None) -> None:
+        self.table = _check_identifier(table)
+        self.columns = None if columns is None else [_check_identifier(c) for c in columns]
+        self._joins: List[str] = []
+        self._conditions: List[str] = []
+        self._order_by: List[str] = []
+        self.params: List[Any] = []
+
+    def join(self, table: str, using: str) -> 'SelectQuery':
+        self._joins.append('INNER JOIN {} USING({})'.format(_check_identifier(table), _check_identifier(using)))
+        return self
+
+    def where(self, condition: str, *params: Any) -> 'SelectQuery':
+        """条件を AND で追加する (値は condition 中の ? に params でバインドする)"""
+        self._conditions.append(condition)
+        self.params.extend(params)
+        return self
+
+    def where_in(self, column: str, values: Iterable[Any]) -> 'SelectQuery':
+        values = list(values)
+        placeholders = ','.join(['?'] * len(values))
+        return self.where('{} IN ({})'.format(_check_identifier(column), placeholders), *values)
+
+    def order_by(self, *columns: str) -> 'SelectQuery':
+        self._order_by.extend(_check_identifier(c) for c in columns)
+        return self
+
+    def build(self) -> Tuple[str, List[Any]]:
+        sql = 'SELECT {} FROM {}'.format('*' if self.columns is None else ', '.join(self.columns), self.table)
+        for join in self._joins:
+            sql += ' ' + join
+        if self._conditions:
+            sql += ' WHERE ' + ' AND '.join('({})'.format(c) for c in self._conditions)
+        if self._order_by:
+            sql += ' ORDER BY ' + ', '.join(self._order_by)
+        return sql, list(self.params)
+
+
 class DBManager:
     """データベース管理クラス
 
@@ -21,42 +142,115 @@ class DBManager:
         dbファイルへのパス
     """
 
-    def __init__(self, db_filepath: str) -> None:
-        # 存在しないdbファイルの場合は、各tableを作成する
-        if not os.path.exists(db_filepath):
-            print('Creating tables...')
-            self._conn = sqlite3.connect(db_filepath)
-            cur = self._conn.cursor()
-            paths = map(os.path.abspath, glob.glob('./sql/*.sql', recursive=False))
-            paths = filter(os.path.isfile, paths)
-            paths = sorted(paths)
-            for _, p in enumerate(paths):
-                with open(p) as f:
-                    sql = f.read()
-                    cur.execute(sql)
-            cur.close()
+    def __init__(self, db_filepath: str, profile: str = 'writer') -> None:
+        if profile not in CONNECTION_PROFILES:
+            raise InvalidArgument("invalid argument of profile: '{}'".format(profile))
+        self.profile = profile
+
+        if profile == 'reader':
+            # 読み取り専用で開く (スレッド間で使い回すため、スレッドのチェックはしない)
+            uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(db_filepath)))
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
         else:
+            # 存在しないdbファイルの場合は、各tableを作成する
+            if not os.path.exists(db_filepath):
+                print('Creating tables...')
             self._conn = sqlite3.connect(db_filepath)
+        self._apply_profile(db_filepath)
+
+        # transaction のネストの深さ (2段目以降はセーブポイントになる)
+        self._tx_depth = 0
+        self._tx_listeners: List[Callable[[bool, int], None]] = []
+        if profile == 'writer':
+            # 既存のdbファイルにも後から追加したマイグレーションを適用する
+            self.migrate()
+
+    def _apply_profile(self, db_filepath: str) -> None:
+        for name, value in CONNECTION_PROFILES[self.profile].items():
+            if name == 'journal_mode' and value == 'WAL' and is_network_path(db_filepath):
+                # WALは共有メモリを使うため、ネットワーク共有上では使わない
+                continue
+            self._conn.execute('PRAGMA {}={}'.format(name, value))
+
+    @property
+    def schema_version(self) -> int:
+        """適用済みのマイグレーションの最新のバージョン (1度もマイグレーションしていないdbファイルは0)"""
+        if self.profile == 'reader':
+            # 読み取り専用では schema_version を作成できないため、無い場合は未適用とみなす
+            if not self.get_column_types('schema_version'):
+                return 0
+        else:
+            self._conn.execute(CREATE_SCHEMA_VERSION_SQL)
+        version = self._conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0]
+        return 0 if version is None else version
+
+    def migrate(self) -> None:
+        """未適用のマイグレーションをバージョン順に適用する
+
+        マイグレーションは MIGRATION_DIR の '<バージョン>_<説明>.sql' または '<バージョン>_<説明>.py' で、
+        1つずつトランザクション内で実行し、schema_version に記録する。
+        .py のマイグレーションは upgrade(conn: sqlite3.Connection) を定義し、
+        SQLだけでは書けない変換 (既存の行の埋め直しなど) に使う。
+        """
+        current_version = self.schema_version
+        for version, path in get_migration_list():
+            if version <= current_version:
+                continue
+            name = os.path.basename(path)
+            try:
+                if path.endswith('.py'):
+                    self._apply_python_migration(version, name, path)
+                else:
+                    self._apply_sql_migration(version, name, path)
+            except sqlite3.Error as e:
+                if self._conn.in_transaction:
+                    self._conn.rollback()
+                print("sqlite3.Error occurred:", e.args[0])
+                raise
+
+    def _apply_sql_migration(self, version: int, name: str, path: str) -> None:
+        with open(path, encoding='utf-8') as f:
+            script = f.read()
+        # executescript はトランザクションを自動で開始しないため、明示的に囲む
+        script = 'BEGIN;\n{}\n;\nINSERT INTO schema_version VALUES ({}, \'{}\', datetime(\'now\', \'localtime\'));\nCOMMIT;'.format(
+            script, version, name)
+        self._conn.executescript(script)
+
+    def _apply_python_migration(self, version: int, name: str, path: str) -> None:
+        spec = importlib.util.spec_from_file_location('migration_{}'.format(version), path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        if self._conn.in_transaction:
+            self._conn.commit()
+        self._conn.execute('BEGIN')
+        try:
+            module.upgrade(self._conn)
+            self._conn.execute("INSERT INTO schema_version VALUES (?, ?, datetime('now', 'localtime'))", (version, name))
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._conn.commit()
 
     def __del__(self) -> None:
         self._conn.close()
 
+    def close(self) -> None:
+        self._conn.close()
+
     def is_id_inserted(self, table_name: str, id: str) -> bool:
         if table_name not in ['race_info', 'horse', 'jockey', 'trainer']:
             raise InvalidArgument("invalid argument of table_name: '{}'".format(table_name))
 
         if table_name == 'race_info':
-            sql = 'SELECT * FROM {} WHERE race_id="{}"'.format(table_name, id)
+            sql = 'SELECT 1 FROM race_info WHERE race_id=? LIMIT 1'
         else:
-            sql = 'SELECT * FROM {} WHERE id="{}"'.format(table_name, id)
+            sql = 'SELECT 1 FROM {} WHERE id=? LIMIT 1'.format(table_name)
 
         cur = self._conn.cursor()
         try:
-            cur.execute(sql)
-            if cur.fetchall():
-                ret = True
-            else:
-                ret = False
+            cur.execute(sql, (id,))
+            ret = cur.fetchone() is not None
         except sqlite3.Error as e:
             print("sqlite3.Error occurred:", e.args[0])
             ret = False
@@ -65,6 +259,43 @@ class DBManager:
 
         return ret
 
+    def get_id_set(self, table_name: str) -> Set[str]:
+        """テーブルに登録済みのIDの集合を返す"""
+        if table_name not in ['race_info', 'horse', 'jockey', 'trainer']:
+            raise InvalidArgument("invalid argument of table_name: '{}'".format(table_name))
+
+        column = 'race_id' if table_name == 'race_info' else 'id'
+        cur = self._conn.cursor()
+        try:
+            cur.execute('SELECT {} FROM {}'.format(column, table_name))
+            ret = {row[0] for row in cur}
+        finally:
+            cur.close()
+
+        return ret
+
+    def get_jockey_name_dict(self) -> Dict[str, Set[str]]:
+        """騎手名 -> 騎手IDの集合 を返す"""
+        name_dict = {}
+        cur = self._conn.cursor()
+        try:
+            cur.execute('SELECT id, name FROM jockey')
+            for id, name in cur:
+                name_dict.setdefault(name, set()).add(id)
+        finally:
+            cur.close()
+
+        return name_dict
+
+    def iter_horse_results_keys(self) -> Iterator[Tuple[str, str]]:
+        """horse_results に登録済みの (horse_id, race_id) を順に返す"""
+        cur = self._conn.cursor()
+        try:
+            cur.execute('SELECT horse_id, race_id FROM horse_results')
+            yield from cur
+        finally:
+            cur.close()
+
     def select_resutls(self, where: str = None) -> Union[pd.DataFrame, None]:
         sql = 'SELECT * FROM results INNER JOIN race_info USING(race_id)'
         if where is not None:
@@ -75,6 +306,146 @@ class DBManager:
         except sqlite3.Error as e:
             print("sqlite3.Error occurred:", e.args[0])
 
+    def select_query(
+            self,
+            query: SelectQuery,
+            dtype: Dict[str, Any] = None,
+            chunksize: int = None
+        ) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+        """SelectQuery を実行する
+
+        Parameters
+        ----------
+        query : SelectQuery
+            クエリ
+        dtype : dict[str, Any], optional
+            列ごとの型 (読み込み時に変換する)
+        chunksize : int, optional
+            指定した場合は chunksize 行ずつの DataFrame のイテレータを返す
+        """
+        sql, params = query.build()
+        return pd.read_sql_query(sql, self._conn, params=params, dtype=dtype, chunksize=chunksize)
+
+    def select_results(
+            self,
+            begin_date: int = None,
+            end_date: int = None,
+            race_type_list: List[str] = None,
+            columns: List[str] = None,
+            dtype: Dict[str, Any] = None,
+            chunksize: int = None
+        ) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+        """レース結果とレース情報を結合して返す (select_resutls の条件をバインド変数で指定する版)
+
+        Parameters
+        ----------
+        begin_date, end_date : int, optional
+            開催日の範囲 (yyyymmdd、両端を含む)
+        race_type_list : list[str], optional
+            レースの種類 ('芝', 'ダート' など)
+        columns : list[str], optional
+            取得する列 (省略時は全ての列)
+        dtype : dict[str, Any], optional
+            列ごとの型
+        chunksize : int, optional
+            指定した場合は race_id 順に chunksize 行ずつの DataFrame のイテレータを返す
+        """
+        query = SelectQuery('results', columns).join('race_info', 'race_id')
+        if begin_date is not None:
+            query.where('date>=?', begin_date)
+        if end_date is not None:
+            query.where('date<=?', end_date)
+        if race_type_list is not None:
+            query.where_in('race_type', race_type_list)
+        if chunksize is not None:
+            query.order_by('race_id')
+        return self.select_query(query, dtype, chunksize)
+
+    def get_column_types(self, table_name: str) -> Dict[str, str]:
+        """テーブルの列名 -> 宣言された型 を返す"""
+        _check_identifier(table_name)
+        cur = self._conn.cursor()
+        try:
+            cur.execute('PRAGMA table_info({})'.format(table_name))
+            ret = {row[1]: row[2].upper() for row in cur.fetchall()}
+        finally:
+            cur.close()
+
+        return ret
+
+    def select_rows_since(self, table_name: str, last_rowid: int) -> pd.DataFrame:
+        """rowid が last_rowid より大きい行を race_info と結合して rowid 順に返す
+
+        rowid は列 '_rowid' に入れる。
+        """
+        if table_name not in ['results', 'horse_results']:
+            raise InvalidArgument("invalid argument of table_name: '{}'".format(table_name))
+
+        sql = 'SELECT {0}.rowid AS _rowid, * FROM {0} INNER JOIN race_info USING(race_id) ' \
+              'WHERE {0}.rowid>? ORDER BY {0}.rowid'.format(table_name)
+        return pd.read_sql_query(sql, self._conn, params=(last_rowid,))
+
+    def get_max_rowid(self, table_name: str) -> int:
+        _check_identifier(table_name)
+        max_rowid = self._conn.execute('SELECT MAX(rowid) FROM {}'.format(table_name)).fetchone()[0]
+        return 0 if max_rowid is None else max_rowid
+
+    def iter_table_rows(
+            self,
+            table_name: str,
+            last_rowid: int = 0,
+            chunksize: int = 10000
+        ) -> Iterator[Tuple[List[str], List[Tuple[Any]]]]:
+        """rowid が last_rowid より大きい行を rowid 順に chunksize 行ずつ返す
+
+        Yields
+        ------
+        columns : list[str]
+            列名 (先頭は '_rowid')
+        rows : list[tuple]
+            行
+        """
+        _check_identifier(table_name)
+        cur = self._conn.cursor()
+        try:
+            cur.execute('SELECT rowid AS _rowid, * FROM {} WHERE rowid>? ORDER BY rowid'.format(table_name), (last_rowid,))
+            columns = [d[0] for d in cur.description]
+            while True:
+                rows = cur.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield columns, rows
+        finally:
+            cur.close()
+
+    def select_rows_by_key(self, table_name: str, key_column: str, key_list: List[Any]) -> Tuple[List[str], List[Tuple[Any]]]:
+        """key_column の値が key_list に含まれる行を返す (戻り値は iter_table_rows と同じ形式で、'_rowid' は含まない)"""
+        sql = 'SELECT * FROM {} WHERE {} IN ({{}})'.format(_check_identifier(table_name), _check_identifier(key_column))
+        cur = self._conn.cursor()
+        rows = []
+        columns = None
+        try:
+            for i in range(0, len(key_list), SQL_IN_CHUNK_SIZE):
+                chunk = key_list[i:i + SQL_IN_CHUNK_SIZE]
+                cur.execute(sql.format(','.join(['?'] * len(chunk))), chunk)
+                columns = [d[0] for d in cur.description]
+                rows += cur.fetchall()
+        finally:
+            cur.close()
+
+        return columns, rows
+
+    def select_change_log(self, last_seq: int) -> List[Tuple[int, str, str]]:
+        """seq が last_seq より大きい変更履歴 (seq, table_name, row_key) を seq 順に返す"""
+        cur = self._conn.cursor()
+        try:
+            cur.execute('SELECT seq, table_name, row_key FROM change_log WHERE seq>? ORDER BY seq', (last_seq,))
+            ret = cur.fetchall()
+        finally:
+            cur.close()
+
+        return ret
+
     def select_payoffs(self) -> pd.DataFrame:
         sql = 'SELECT * FROM race_payoff'
         return pd.read_sql(sql, self._conn)
@@ -98,28 +469,108 @@ class DBManager:
         df = pd.read_sql(sql, self._conn)
         return df['id'].values.tolist()
 
-    def insert_data(self, sql: str, data: Tuple[Any]) -> None:
-        cur = self._conn.cursor()
+    def get_horse_id_list_without_peds(self) -> List[str]:
+        sql = 'SELECT id FROM horse WHERE father IS NULL AND mother IS NULL'
+        df = pd.read_sql(sql, self._conn)
+        return df['id'].values.tolist()
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """ブロック内の書き込みを1つのトランザクションとしてコミットする
+
+        例外が発生した場合はブロック内の書き込みを全てロールバックし、例外を送出する。
+        ネストした場合、内側のブロックはセーブポイントとなり、内側の失敗は
+        内側の書き込みのみを取り消す (外側で例外を捕捉すれば、外側は続行できる)。
+
+        ブロック内では insert_data, update_data, execute_many はコミットせず、
+        sqlite3.Error を送出する。
+        """
+        if self._tx_depth == 0:
+            if self._conn.in_transaction:
+                self._conn.commit()
+            self._conn.execute('BEGIN')
+            commit, rollback = self._conn.commit, self._conn.rollback
+        else:
+            name = 'sp_{}'.format(self._tx_depth)
+            self._conn.execute('SAVEPOINT ' + name)
+            commit = lambda: self._conn.execute('RELEASE ' + name)
+            rollback = lambda: (self._conn.execute('ROLLBACK TO ' + name), self._conn.execute('RELEASE ' + name))
+
+        self._tx_depth += 1
+        depth = self._tx_depth
         try:
-            cur.execute(sql, data)
-            self._conn.commit()
-        except sqlite3.Error as e:
-            print("sqlite3.Error occurred:", e.args[0])
-            self._conn.rollback()
-        finally:
-            cur.close()
+            yield
+        except BaseException:
+            self._tx_depth -= 1
+            rollback()
+            self._notify_transaction(False, depth)
+            raise
+        else:
+            self._tx_depth -= 1
+            commit()
+            self._notify_transaction(True, depth)
 
-    def update_data(self, sql: str):
+    @property
+    def in_transaction(self) -> bool:
+        return self._tx_depth > 0
+
+    @property
+    def transaction_depth(self) -> int:
+        """実行中の transaction のネストの深さ (transaction の外では0)"""
+        return self._tx_depth
+
+    def add_transaction_listener(self, listener: Callable[[bool, int], None]) -> None:
+        """transaction の各ブロックの終了時に呼ぶ関数を登録する
+
+        listener は (コミットしたか, 終了したブロックの深さ) で呼ばれる。深さは最も外側のブロックが1で、
+        2以上のブロック (セーブポイント) のコミットは外側のブロックへの取り込みとなり、
+        DBに書き込まれるのは深さ1のブロックのコミット時のみである。
+        """
+        self._tx_listeners.append(listener)
+
+    def _notify_transaction(self, committed: bool, depth: int) -> None:
+        for listener in self._tx_listeners:
+            listener(committed, depth)
+
+    def _execute(self, sql: str, data: Union[Tuple[Any], Iterable[Tuple[Any]]] = (), many: bool = False) -> None:
         cur = self._conn.cursor()
         try:
-            cur.execute(sql)
-            self._conn.commit()
+            if many:
+                cur.executemany(sql, data)
+            else:
+                cur.execute(sql, data)
+            if not self.in_transaction:
+                self._conn.commit()
         except sqlite3.Error as e:
+            if self.in_transaction:
+                # ロールバックは transaction に任せる
+                raise
             print("sqlite3.Error occurred:", e.args[0])
             self._conn.rollback()
         finally:
             cur.close()
 
+    def insert_data(self, sql: str, data: Tuple[Any]) -> None:
+        self._execute(sql, data)
+
+    def execute_many(self, sql: str, data_list: Iterable[Tuple[Any]]) -> None:
+        """複数行の INSERT / UPDATE を executemany でまとめて実行する
+
+        transaction の外では1回だけコミットする。
+        重複を無視する場合は 'INSERT OR IGNORE'、上書きする場合は 'INSERT OR REPLACE' を使う。
+
+        Parameters
+        ----------
+        sql : str
+            プレースホルダ付きのSQL
+        data_list : Iterable[tuple]
+            各行のパラメータ
+        """
+        self._execute(sql, data_list, many=True)
+
+    def update_data(self, sql: str):
+        self._execute(sql)
+
     def select_data(self, sql: str):
         try:
             df = pd.read_sql(sql, self._conn)
@@ -130,17 +581,16 @@ class DBManager:
 
     def is_horse_results_inserted(self, horse_id: str, race_id: str) -> bool:
         if race_id is None:
-            sql = 'SELECT * FROM horse_results WHERE horse_id="{}"'.format(horse_id)
+            sql = 'SELECT 1 FROM horse_results WHERE horse_id=? LIMIT 1'
+            params = (horse_id,)
         else:
-            sql = 'SELECT * FROM horse_results WHERE horse_id="{}" and race_id="{}"'.format(horse_id, race_id)
+            sql = 'SELECT 1 FROM horse_results WHERE horse_id=? and race_id=? LIMIT 1'
+            params = (horse_id, race_id)
         cur = self._conn.cursor()
 
         try:
-            cur.execute(sql)
-            if cur.fetchall():
-                ret = True
-            else:
-                ret = False
+            cur.execute(sql, params)
+            ret = cur.fetchone() is not None
         except sqlite3.Error as e:
             print("sqlite3.Error occurred:", e.args[0])
             ret = False
@@ -154,12 +604,62 @@ class DBManager:
         df = pd.read_sql(sql, self._conn)
         return df['race_id'].values.tolist()
 
+    def select_horse_freshness(self, horse_id_list: List[str]) -> pd.DataFrame:
+        """馬ごとの鮮度情報を返す
+
+        Returns
+        -------
+        pandas.DataFrame
+            index: horse_id, columns: last_race_date, last_checked, latest_result_date
+            (latest_result_date は results に登録済みの最新のレースの日付)
+        """
+        freshness_list = []
+        latest_list = []
+        # SQLiteのプレースホルダ数の上限を超えないように分割する
+        for i in range(0, len(horse_id_list), SQL_IN_CHUNK_SIZE):
+            chunk = horse_id_list[i:i + SQL_IN_CHUNK_SIZE]
+            placeholders = ','.join(['?'] * len(chunk))
+            sql = 'SELECT horse_id, last_race_date, last_checked FROM horse_freshness ' \
+                  'WHERE horse_id IN ({})'.format(placeholders)
+            freshness_list.append(pd.read_sql(sql, self._conn, params=chunk))
+            sql = 'SELECT horse_id, MAX(date) AS latest_result_date FROM results ' \
+                  'INNER JOIN race_info USING(race_id) ' \
+                  'WHERE horse_id IN ({}) GROUP BY horse_id'.format(placeholders)
+            latest_list.append(pd.read_sql(sql, self._conn, params=chunk))
+
+        df = pd.DataFrame(index=pd.Index(horse_id_list, name='horse_id'))
+        if freshness_list:
+            df = df.join(pd.concat(freshness_list).set_index('horse_id'))
+            df = df.join(pd.concat(latest_list).set_index('horse_id'))
+        else:
+            df = df.reindex(columns=['last_race_date', 'last_checked', 'latest_result_date'])
+        return df
+
+    def get_empty_race_ranges(self, year: int) -> Set[Tuple[int, int, int]]:
+        """開催が無いと確認済みの (place_id, hold_no, hold_day) の集合を返す
+
+        hold_day が 0 の場合は、その回 (hold_no) 以降の開催が無いことを表す。
+        """
+        sql = 'SELECT place_id, hold_no, hold_day FROM race_id_probe WHERE year=?'
+        cur = self._conn.cursor()
+        try:
+            cur.execute(sql, (year,))
+            ret = set(cur.fetchall())
+        except sqlite3.Error as e:
+            print("sqlite3.Error occurred:", e.args[0])
+            ret = set()
+        finally:
+            cur.close()
+
+        return ret
+
     def get_jockey_id(self, jockey_name: str):
-        sql = 'SELECT id FROM jockey WHERE name="{}"'.format(jockey_name)
+        sql = 'SELECT id FROM jockey WHERE name=?'
         cur = self._conn.cursor()
+        jockey_id = np.nan
 
         try:
-            cur.execute(sql)
+            cur.execute(sql, (jockey_name,))
             jockey_id_list = cur.fetchall()
             if len(jockey_id_list) == 0:
                 warnings.warn("jockey_name:'{}' does not exists. Retun NaN.".format(jockey_name))
@@ -175,3 +675,59 @@ class DBManager:
             cur.close()
 
         return jockey_id
+
+
+class ReaderPool:
+    """読み取り専用の DBManager を使い回すプール
+
+    dbファイルごとに最大 max_size 個の接続を保持する。
+
+    Parameters
+    ----------
+    max_size : int, default READER_POOL_SIZE
+        dbファイルごとに保持する接続の数
+    """
+
+    def __init__(self, max_size: int = READER_POOL_SIZE) -> None:
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._idle: Dict[str, List[DBManager]] = {}
+
+    @contextmanager
+    def reader(self, db_filepath: str) -> Iterator[DBManager]:
+        """読み取り専用の DBManager を借りる
+
+        Examples
+        --------
+        >>> with reader_pool.reader(db_path) as dbm:
+        ...     df = dbm.select_payoffs()
+        """
+        key = os.path.abspath(db_filepath)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            dbm = idle.pop() if idle else None
+        if dbm is None:
+            dbm = DBManager(db_filepath, profile='reader')
+
+        try:
+            yield dbm
+        finally:
+            with self._lock:
+                idle = self._idle[key]
+                if len(idle) < self.max_size:
+                    idle.append(dbm)
+                    dbm = None
+            if dbm is not None:
+                dbm.close()
+
+    def clear(self) -> None:
+        """保持している接続を全て閉じる"""
+        with self._lock:
+            idle_list = list(self._idle.values())
+            self._idle.clear()
+        for idle in idle_list:
+            for dbm in idle:
+                dbm.close()
+
+
+reader_pool = ReaderPool()
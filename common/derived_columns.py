@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import re
+from typing import Optional, Tuple
+import pandas as pd
+
+
+# 登録時に文字列の列から計算して保存する列
+RESULTS_DERIVED_COLUMNS = ['sex', 'age', 'weight', 'weight_change']
+HORSE_RESULTS_DERIVED_COLUMNS = ['goal_time_sec', 'first_corner', 'last_corner']
+
+RE_NUMBER = re.compile(r'\d+')
+RE_HORSE_WEIGHT = re.compile(r'^\s*(\d+)\s*\(\s*([+-]?\d+)\s*\)')
+
+
+def parse_sex_age(sex_age: str) -> Tuple[Optional[str], Optional[int]]:
+    """'牡3' のような性齢を (性, 年齢) に分ける (解析できない場合は None)"""
+    if not isinstance(sex_age, str) or sex_age == '':
+        return None, None
+    m = RE_NUMBER.search(sex_age)
+    return sex_age[0], (int(m.group()) if m is not None else None)
+
+
+def parse_horse_weight(horse_weight: str) -> Tuple[Optional[int], Optional[int]]:
+    """'480(+2)' のような馬体重を (体重, 増減) に分ける (計不などの場合は None)"""
+    if not isinstance(horse_weight, str):
+        return None, None
+    m = RE_HORSE_WEIGHT.match(horse_weight)
+    if m is None:
+        return None, None
+    return int(m.group(1)), int(m.group(2))
+
+
+def parse_goal_time(goal_time: str) -> Optional[float]:
+    """'1:34.5' のようなタイムを秒に変換する (解析できない場合は None)"""
+    try:
+        minutes, seconds = goal_time.split(':')
+        return float(minutes) * 60.0 + float(seconds)
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_corner_pass(corner_pass: str) -> Tuple[Optional[int], Optional[int]]:
+    """'3-3-2-1' のような通過順を (最初のコーナー, 最後のコーナー) に分ける (解析できない場合は None)"""
+    if not isinstance(corner_pass, str):
+        return None, None
+    numbers = RE_NUMBER.findall(corner_pass)
+    if not numbers:
+        return None, None
+    return int(numbers[0]), int(numbers[-1])
+
+
+def derive_results_columns(sex_age: str, horse_weight: str) -> Tuple:
+    """results の派生列 (RESULTS_DERIVED_COLUMNS の順) の値"""
+    return parse_sex_age(sex_age) + parse_horse_weight(horse_weight)
+
+
+def derive_horse_results_columns(goal_time: str, corner_pass: str) -> Tuple:
+    """horse_results の派生列 (HORSE_RESULTS_DERIVED_COLUMNS の順) の値"""
+    return (parse_goal_time(goal_time),) + parse_corner_pass(corner_pass)
+
+
+def fill_results_derived_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """派生列が無い DataFrame (派生列を追加する前のスナップショットなど) に、文字列の列から派生列を追加する"""
+    if all(c in df.columns for c in RESULTS_DERIVED_COLUMNS):
+        return df
+    df = df.copy()
+    values = [derive_results_columns(*x) for x in zip(df['sex_age'], df['horse_weight'])]
+    derived = pd.DataFrame(values, columns=RESULTS_DERIVED_COLUMNS, index=df.index)
+    for column in RESULTS_DERIVED_COLUMNS:
+        df[column] = derived[column]
+    return df
+
+
+def fill_horse_results_derived_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """派生列が無い DataFrame に、文字列の列から派生列を追加する"""
+    if all(c in df.columns for c in HORSE_RESULTS_DERIVED_COLUMNS):
+        return df
+    df = df.copy()
+    values = [derive_horse_results_columns(*x) for x in zip(df['goal_time'], df['corner_pass'])]
+    derived = pd.DataFrame(values, columns=HORSE_RESULTS_DERIVED_COLUMNS, index=df.index, dtype='float64')
+    for column in HORSE_RESULTS_DERIVED_COLUMNS:
+        df[column] = derived[column]
+    return df
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import datetime as dt
+import hashlib
+import json
+from typing import Any, Dict, List, Union
+import numpy as np
+import pandas as pd
+from common.utils import get_environment
+if get_environment() == 'Jupyter':
+    from tqdm.notebook import tqdm
+else:
+    from tqdm import tqdm
+
+
+DEFAULT_FEATURE_STORE_DIR = os.environ.get('KEIBA_FEATURE_STORE_DIR', './feature_store')
+MANIFEST_NAME = '_manifest.json'
+# HorseResults.merge_all の出力 (列や計算方法) を変えた場合は上げる
+FEATURE_SET_VERSION = 1
+
+
+class FeatureStore:
+    """過去成績を結合した特徴量を月ごとに保存し、再利用するクラス
+
+    特徴量は (特徴量のバージョン, パラメータ) ごとのディレクトリに、開催月ごとの
+    pickle として保存する。各月には元データの watermark (その月のレース結果の
+    ハッシュと、その月の最終日より前の過去成績の行数) を記録し、一致する月は
+    保存済みの特徴量を読み込み、一致しない月 (新しい月や過去成績が追加された月) のみ
+    作り直す。
+
+    Parameters
+    ----------
+    store_dir : str, default DEFAULT_FEATURE_STORE_DIR
+        保存先のディレクトリ
+    """
+
+    def __init__(self, store_dir: str = DEFAULT_FEATURE_STORE_DIR) -> None:
+        self.store_dir = store_dir
+
+    @staticmethod
+    def _params_key(params: Dict[str, Any]) -> str:
+        text = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+    def _key_dir(self, params: Dict[str, Any]) -> str:
+        return os.path.join(self.store_dir, 'v{}-{}'.format(FEATURE_SET_VERSION, self._params_key(params)))
+
+    def _load_manifest(self, key_dir: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        path = os.path.join(key_dir, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        return {'version': FEATURE_SET_VERSION, 'params': params, 'partitions': {}}
+
+    @staticmethod
+    def _save_manifest(key_dir: str, manifest: Dict[str, Any]) -> None:
+        path = os.path.join(key_dir, MANIFEST_NAME)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, default=str)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _watermark(results_month: pd.DataFrame, history_dates: np.ndarray) -> str:
+        """月の特徴量が依存する元データの watermark"""
+        results_hash = int(pd.util.hash_pandas_object(results_month, index=True).sum())
+        n_history = int(np.searchsorted(history_dates, results_month['date'].max().to_datetime64(), side='left'))
+        return '{}:{:x}:{}'.format(len(results_month), results_hash & 0xFFFFFFFFFFFFFFFF, n_history)
+
+    def _write_partition(self, key_dir: str, manifest: Dict[str, Any], month: str, merged: pd.DataFrame, watermark: str) -> None:
+        path = os.path.join(key_dir, '{}.pkl'.format(month))
+        merged.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        manifest['partitions'][month] = {
+            'watermark': watermark,
+            'n_rows': len(merged),
+            'built_at': dt.datetime.now().isoformat(timespec='seconds')
+        }
+        self._save_manifest(key_dir, manifest)
+
+    @staticmethod
+    def _merge_by_month(
+            hr: 'HorseResults',
+            results_list: List[pd.DataFrame],
+            ave_samples_list: List[Union[int, str]]
+        ) -> Dict[str, pd.DataFrame]:
+        """results_list の行をまとめて1回の merge_all で計算し、開催月 -> 特徴量 に分けて返す
+
+        月ごとに merge_all を呼ぶと1回の行数が少なく、HorseResults の n_workers のプロセスが使われない。
+        各行の特徴量は (馬, 開催日) のみで決まるため、まとめて計算しても月ごとに計算した場合と同じになる。
+        """
+        results_list = [df for df in results_list if len(df) > 0]
+        if not results_list:
+            return {}
+        merged = hr.merge_all(pd.concat(results_list), ave_samples_list)
+        return {month: df for month, df in merged.groupby(merged['date'].dt.strftime('%Y%m'), sort=False)}
+
+    @staticmethod
+    def _row_keys(df: pd.DataFrame) -> pd.MultiIndex:
+        """行を識別する (race_id, horse_id)"""
+        return pd.MultiIndex.from_arrays([df.index, df['horse_id']])
+
+    @staticmethod
+    def _read_partition(key_dir: str, month: str) -> pd.DataFrame:
+        path = os.path.join(key_dir, '{}.pkl'.format(month))
+        return pd.read_pickle(path) if os.path.exists(path) else None
+
+    def get_merged(
+            self,
+            results: pd.DataFrame,
+            hr: 'HorseResults',
+            ave_samples_list: List[Union[int, str]] = [5, 9, 'all'],
+            params: Dict[str, Any] = None,
+            incremental: bool = False
+        ) -> pd.DataFrame:
+        """過去成績を結合した特徴量を返す (保存済みの月は再利用し、それ以外の月は作り直して保存する)
+
+        Parameters
+        ----------
+        results : pandas.DataFrame
+            前処理済みのレース結果 (Results.data_p)
+        hr : HorseResults
+            過去成績
+        ave_samples_list : list[int or str], default [5, 9, 'all']
+            HorseResults.merge_all に渡す平均を取るレース数のリスト
+        params : dict[str, Any], optional
+            特徴量に影響するその他のパラメータ (キーに含める)
+        incremental : bool, default False
+            True の場合は、前回までに処理した最終開催日 (last_date) 以前のレースは保存済みの特徴量を
+            確認せずに使い、それより後の開催日のレースのみ計算して追記する。
+            過去のレースの特徴量はその日より前の過去成績のみで決まるため、過去のレースの
+            過去成績が後から追加されない限り、全体を作り直した場合と同じ結果になる。
+            last_date 以前の開催日でも保存済みの特徴量に無い行 (後から登録されたレースなど) は計算して追記する。
+
+        Returns
+        -------
+        pandas.DataFrame
+            HorseResults.merge_all と同じ特徴量 (開催月順)
+        """
+        key_params = {'ave_samples_list': list(ave_samples_list)}
+        if params is not None:
+            key_params.update(params)
+        key_dir = self._key_dir(key_params)
+        os.makedirs(key_dir, exist_ok=True)
+        manifest = self._load_manifest(key_dir, key_params)
+        partitions = manifest['partitions']
+
+        history_dates = np.sort(hr.data_p['date'].values)
+        if incremental and manifest.get('last_date') is not None:
+            merged = self._append_new_dates(key_dir, manifest, results, hr, ave_samples_list, history_dates)
+        else:
+            months = results['date'].dt.strftime('%Y%m')
+            merged_dict = {}
+            build_list = []
+            watermarks = {}
+            for month, results_month in tqdm(results.groupby(months, sort=True), leave=False):
+                watermark = self._watermark(results_month, history_dates)
+                entry = partitions.get(month)
+                if entry is not None and entry['watermark'] == watermark:
+                    stored = self._read_partition(key_dir, month)
+                    if stored is not None:
+                        merged_dict[month] = stored
+                        continue
+                build_list.append(results_month)
+                watermarks[month] = watermark
+
+            for month, merged_month in self._merge_by_month(hr, build_list, ave_samples_list).items():
+                self._write_partition(key_dir, manifest, month, merged_month, watermarks[month])
+                merged_dict[month] = merged_month
+
+            print('Feature store: {} months reused, {} months built.'.format(len(merged_dict) - len(build_list), len(build_list)))
+            merged = pd.concat([merged_dict[month] for month in sorted(merged_dict)])
+
+        if len(results) > 0:
+            last_date = int(results['date'].max().strftime('%Y%m%d'))
+            if incremental and manifest.get('last_date') is not None:
+                last_date = max(last_date, manifest['last_date'])
+            manifest['last_date'] = last_date
+            self._save_manifest(key_dir, manifest)
+        return merged
+
+    def _append_new_dates(
+            self,
+            key_dir: str,
+            manifest: Dict[str, Any],
+            results: pd.DataFrame,
+            hr: 'HorseResults',
+            ave_samples_list: List[Union[int, str]],
+            history_dates: np.ndarray
+        ) -> pd.DataFrame:
+        """last_date より後の開催日のみ計算して保存済みの月に追記し、results の行の特徴量を返す
+
+        last_date 以前の開催日でも、保存済みの月に無い (race_id, horse_id) の行
+        (後から登録されたレースなど) は計算してその月に追記する。
+        """
+        last_date = pd.to_datetime(str(manifest['last_date']), format='%Y%m%d')
+        months = results['date'].dt.strftime('%Y%m')
+        results_dict = dict(tuple(results.groupby(months, sort=True)))
+
+        # 保存済みの月に無い行 (last_date 以前) と新しい開催日の行を集める
+        stored_dict = {}
+        compute_list = []
+        n_late_rows = 0
+        for month, results_month in results_dict.items():
+            stored = self._read_partition(key_dir, month)
+            if stored is not None:
+                stored = stored[stored['date'] <= last_date]
+            stored_dict[month] = stored
+
+            is_new = results_month['date'] > last_date
+            old_results = results_month[~is_new]
+            if stored is None:
+                missing = np.ones(len(old_results), dtype=bool)
+            else:
+                missing = ~self._row_keys(old_results).isin(self._row_keys(stored))
+            n_late_rows += int(missing.sum())
+            compute_list += [old_results[missing], results_month[is_new]]
+
+        # 月ごとに保存済みの行の後ろに追記し、results にある行を返す
+        merged_list = []
+        computed = self._merge_by_month(hr, compute_list, ave_samples_list)
+        for month, stored in stored_dict.items():
+            results_month = results_dict[month]
+            if month in computed:
+                stored = computed[month] if stored is None else pd.concat([stored, computed[month]])
+                self._write_partition(key_dir, manifest, month, stored, self._watermark(results_month, history_dates))
+            merged_list.append(stored[self._row_keys(stored).isin(self._row_keys(results_month))])
+
+        n_new_dates = results.loc[results['date'] > last_date, 'date'].nunique()
+        print('Feature store: {} new race dates appended after {} ({} late rows added).'.format(
+            n_new_dates, manifest['last_date'], n_late_rows))
+        return pd.concat(merged_list) if merged_list else hr.merge_all(results, ave_samples_list)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import io
+from typing import List
+import pandas as pd
+from bs4 import BeautifulSoup
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+from common import session
+from common.page_cache import CacheMiss, page_cache
+from common.session import fetch_stats
+
+
+DEFAULT_ENCODING = 'EUC-JP'
+
+
+class Page:
+    """取得済みのHTMLページ
+
+    デコード済みの文書を1度だけ保持し、BeautifulSoup (または lxml) による解析と
+    pandas.read_html によるテーブル抽出の両方で使い回す。
+
+    Parameters
+    ----------
+    url : str
+        取得元のURL
+    text : str
+        デコード済みのHTML
+    """
+
+    def __init__(self, url: str, text: str) -> None:
+        self.url = url
+        self.text = text
+        self._soup = None
+        self._tree = None
+        self._tables = None
+
+    def __getstate__(self) -> dict:
+        # 解析用のプロセスへはHTMLのみを渡し、解析結果のキャッシュは渡さない
+        return {'url': self.url, 'text': self.text}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['url'], state['text'])
+
+    @property
+    def soup(self) -> BeautifulSoup:
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.text, 'html.parser')
+        return self._soup
+
+    @property
+    def tree(self) -> 'lxml.html.HtmlElement':
+        if self._tree is None:
+            self._tree = lxml.html.document_fromstring(self.text)
+        return self._tree
+
+    @property
+    def tables(self) -> List[pd.DataFrame]:
+        if self._tables is None:
+            self._tables = pd.read_html(io.StringIO(self.text))
+        return self._tables
+
+
+def fetch_page(url: str, encoding: str = DEFAULT_ENCODING) -> Page:
+    """ページを1回だけダウンロードする関数
+
+    page_cache に有効なページがあればネットワークには接続しない。
+    期限切れのページは条件付きリクエストで再検証する。
+
+    Parameters
+    ----------
+    url : str
+        URL
+    encoding : str, default 'EUC-JP'
+        ページの文字コード
+
+    Returns
+    -------
+    Page
+        取得したページ
+    """
+    entry = page_cache.get(url)
+    if entry is not None and (page_cache.mode == 'replay' or entry.is_fresh()):
+        fetch_stats.add_cache_hit()
+        return Page(url, entry.content.decode(encoding, errors='replace'))
+    if page_cache.mode == 'replay':
+        raise CacheMiss("url:'{}' is not cached.".format(url))
+
+    headers = entry.conditional_headers() if entry is not None else None
+    html = session.get(url, headers=headers)
+
+    if html.status_code == 304 and entry is not None:
+        page_cache.touch(entry)
+        content = entry.content
+    else:
+        html.raise_for_status()
+        content = html.content
+        page_cache.put(url, content, html.headers)
+
+    return Page(url, content.decode(encoding, errors='replace'))
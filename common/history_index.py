@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+from typing import Dict, List, Tuple
+import numpy as np
+import pandas as pd
+from common.utils import InvalidArgument
+
+
+# 過去成績で平均を取る列 (HorseResults._get_average と同じ)
+AVE_TARGET_COLUMNS = [
+    'arriving_order', 'popularity', 'distance', 'goal_time', 'time_diff', 'last_three_furlong',
+    'first_corner', 'last_corner', 'prise'
+]
+# 馬ごとの日数の範囲 (馬の番号 * DAY_KEY_SCALE + 日数 で全ての馬をまとめて二分探索する)
+DAY_KEY_SCALE = 1 << 20
+INDEX_FORMAT_VERSION = 1
+
+
+def to_days(dates: pd.Series) -> np.ndarray:
+    """日付を 1970-01-01 からの日数に変換する"""
+    return np.asarray(dates).astype('datetime64[D]').astype(np.int64)
+
+
+class HorseHistoryIndex:
+    """馬ごとの過去成績の索引 (CSR 形式)
+
+    過去成績を (馬, 日付) 順に並べた連続した NumPy の列と、馬ごとの開始位置 (offsets) を持つ。
+    馬 i の出走は [offsets[i], offsets[i + 1]) の範囲に日付順に並ぶため、
+    「馬 h の日付 d より前の直近 k 走」は二分探索とスライスで求まる。
+    save / load で np.savez 形式のファイルに保存し、読み込み直せる。
+
+    Parameters
+    ----------
+    horse_ids : numpy.ndarray
+        馬ID (索引の順)
+    offsets : numpy.ndarray
+        馬ごとの開始位置 (長さは馬の数 + 1)
+    days : numpy.ndarray
+        開催日 (1970-01-01 からの日数、馬ごとに昇順)
+    columns : dict[str, numpy.ndarray]
+        列名 -> 値 (float64)
+    """
+
+    def __init__(
+            self,
+            horse_ids: np.ndarray,
+            offsets: np.ndarray,
+            days: np.ndarray,
+            columns: Dict[str, np.ndarray]
+        ) -> None:
+        if len(offsets) != len(horse_ids) + 1 or offsets[-1] != len(days):
+            raise InvalidArgument('offsets does not match horse_ids and days')
+        self.horse_ids = horse_ids
+        self.offsets = offsets
+        self.days = days
+        self.columns = columns
+        self._horse_index = pd.Index(horse_ids)
+        self._keys = None
+
+    @classmethod
+    def build(cls, history: pd.DataFrame, target_columns: List[str] = AVE_TARGET_COLUMNS) -> 'HorseHistoryIndex':
+        """前処理済みの過去成績 (HorseResults.data_p, index: 馬ID) から作る"""
+        horse_codes, horse_ids = pd.factorize(history.index, sort=True)
+        days = to_days(history['date'])
+        order = np.lexsort((days, horse_codes))
+        offsets = np.searchsorted(horse_codes[order], np.arange(len(horse_ids) + 1), side='left')
+        columns = {column: history[column].values.astype(np.float64)[order] for column in target_columns}
+        return cls(np.asarray(horse_ids, dtype=str), offsets.astype(np.int64), days[order], columns)
+
+    def save(self, path: str) -> None:
+        """np.savez 形式で保存する"""
+        names = list(self.columns)
+        arrays = {'col_{}'.format(i): self.columns[name] for i, name in enumerate(names)}
+        np.savez(path, version=INDEX_FORMAT_VERSION, horse_ids=self.horse_ids, offsets=self.offsets,
+                 days=self.days, column_names=np.asarray(names, dtype=str), **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> 'HorseHistoryIndex':
+        """save で保存したファイルから読み込む"""
+        with np.load(path, allow_pickle=False) as f:
+            if int(f['version']) != INDEX_FORMAT_VERSION:
+                raise InvalidArgument("Unsupported index version in '{}'".format(path))
+            names = f['column_names'].tolist()
+            columns = {name: f['col_{}'.format(i)] for i, name in enumerate(names)}
+            return cls(f['horse_ids'], f['offsets'], f['days'], columns)
+
+    @property
+    def n_horses(self) -> int:
+        return len(self.horse_ids)
+
+    @property
+    def keys(self) -> np.ndarray:
+        """馬の番号 * DAY_KEY_SCALE + 日数 (全体で昇順)。まとめて二分探索するために使う"""
+        if self._keys is None:
+            n_races = np.diff(self.offsets)
+            codes = np.repeat(np.arange(self.n_horses, dtype=np.int64), n_races)
+            self._keys = codes * DAY_KEY_SCALE + (self.days - self.day_offset)
+        return self._keys
+
+    @property
+    def day_offset(self) -> int:
+        return int(self.days.min()) if len(self.days) else 0
+
+    def locate(self, horse_id: pd.Series, date: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+        """対象 (馬, 日付) ごとに、その日より前の出走の範囲 [starts, ends) を返す
+
+        過去成績の無い馬や、最初の出走以前の日付は空の範囲となる。
+        """
+        codes = self._horse_index.get_indexer(horse_id)
+        known = codes >= 0
+        safe_codes = np.maximum(codes, 0)
+        starts = np.where(known, self.offsets[safe_codes], 0)
+        keys = safe_codes.astype(np.int64) * DAY_KEY_SCALE + (to_days(date) - self.day_offset)
+        ends = np.where(known, np.searchsorted(self.keys, keys, side='left'), 0)
+        # 最初の出走より前の日付のキーは前の馬の範囲に入るため、その馬の先頭に揃える
+        ends = np.maximum(ends, starts)
+        return starts, ends
+
+    def get_last_races(self, horse_id: str, date: pd.Timestamp, k: int = None) -> pd.DataFrame:
+        """馬 horse_id の date より前の直近 k 走 (k を省略した場合は全て) を新しい順に返す"""
+        i = self._horse_index.get_indexer([horse_id])[0]
+        if i < 0:
+            return pd.DataFrame(columns=['date'] + list(self.columns))
+        start, end = self.offsets[i], self.offsets[i + 1]
+        end = start + np.searchsorted(self.days[start:end], to_days([date])[0], side='left')
+        if k is not None:
+            start = max(start, end - k)
+        rows = slice(start, end)
+        df = pd.DataFrame({column: values[rows] for column, values in self.columns.items()})
+        df.insert(0, 'date', self.days[rows].astype('datetime64[D]').astype('datetime64[ns]'))
+        return df.iloc[::-1].reset_index(drop=True)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import hashlib
+import math
+import warnings
+from typing import Dict, Iterable, Set, Tuple
+import numpy as np
+from common.dbapi import DBManager
+from common.utils import InvalidArgument
+
+
+ID_KIND_LIST = ['race_info', 'horse', 'jockey', 'trainer']
+BLOOM_MIN_CAPACITY = 1000000
+BLOOM_ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    """文字列の集合の Bloom filter
+
+    含まれないと判定した要素は確実に含まれない。含まれると判定した要素は
+    error_rate 程度の確率で誤判定となる。
+
+    Parameters
+    ----------
+    capacity : int
+        想定する要素数
+    error_rate : float, default BLOOM_ERROR_RATE
+        capacity 個の要素を追加したときの誤判定率
+    """
+
+    def __init__(self, capacity: int, error_rate: float = BLOOM_ERROR_RATE) -> None:
+        if capacity < 1:
+            raise InvalidArgument("'capacity' must be >=1")
+        if not 0 < error_rate < 1:
+            raise InvalidArgument("'error_rate' must be in (0, 1)")
+
+        self.n_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.n_hashes = max(1, int(round(self.n_bits / capacity * math.log(2))))
+        self._bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, key: str) -> Iterable[int]:
+        # 2つのハッシュ値の線形結合で n_hashes 個の位置を得る (double hashing)
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, key: str) -> None:
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class IdCache:
+    """DBに登録済みのIDをメモリ上に保持するクラス
+
+    race_info, horse, jockey, trainer のIDは集合で、horse_results の
+    (horse_id, race_id) は Bloom filter で保持し、Bloom filter で
+    登録済みと判定した場合のみDBに問い合わせて確認する。
+
+    transaction 内で追加したIDはコミットされるまで仮登録とし、
+    ロールバックされた場合は破棄する。仮登録はネストの深さごとに分けて保持し、
+    内側のブロック (セーブポイント) のロールバックではそのブロックで追加したIDのみを破棄する。
+
+    Parameters
+    ----------
+    dbm : DBManager
+        IDを読み込むDB
+    """
+
+    def __init__(self, dbm: DBManager) -> None:
+        self._dbm = dbm
+        self._ids: Dict[str, Set[str]] = {kind: dbm.get_id_set(kind) for kind in ID_KIND_LIST}
+        self._jockey_names = dbm.get_jockey_name_dict()
+        # transaction の深さ -> 仮登録したID
+        self._staged_ids: Dict[int, Dict[str, Set[str]]] = {}
+        self._staged_jockey_names: Dict[int, Dict[str, str]] = {}
+
+        # 追加で登録する分の余裕を持たせる
+        n_horse_results = int(dbm.select_data('SELECT COUNT(*) AS n FROM horse_results')['n'][0])
+        self._horse_results = BloomFilter(max(BLOOM_MIN_CAPACITY, 2 * n_horse_results))
+        for horse_id, race_id in dbm.iter_horse_results_keys():
+            self._horse_results.add(horse_id + race_id)
+
+        dbm.add_transaction_listener(self._on_transaction)
+
+    def _on_transaction(self, committed: bool, depth: int) -> None:
+        staged_ids = self._staged_ids.pop(depth, {})
+        staged_jockey_names = self._staged_jockey_names.pop(depth, {})
+        if not committed:
+            return
+
+        if depth > 1:
+            # セーブポイントのコミットは、外側のブロックの仮登録に移す
+            for kind, id_set in staged_ids.items():
+                self._get_staged_ids(depth - 1, kind).update(id_set)
+            self._staged_jockey_names.setdefault(depth - 1, {}).update(staged_jockey_names)
+        else:
+            for kind, id_set in staged_ids.items():
+                self._ids[kind] |= id_set
+            for id, name in staged_jockey_names.items():
+                self._jockey_names.setdefault(name, set()).add(id)
+
+    def _get_staged_ids(self, depth: int, kind: str) -> Set[str]:
+        return self._staged_ids.setdefault(depth, {}).setdefault(kind, set())
+
+    @staticmethod
+    def _check_kind(kind: str) -> None:
+        if kind not in ID_KIND_LIST:
+            raise InvalidArgument("invalid argument of kind: '{}'".format(kind))
+
+    def has(self, kind: str, id: str) -> bool:
+        """IDが登録済みか
+
+        Parameters
+        ----------
+        kind : str
+            'race_info', 'horse', 'jockey' or 'trainer'
+        id : str
+            ID
+        """
+        self._check_kind(kind)
+        if id in self._ids[kind]:
+            return True
+        return any(id in staged.get(kind, ()) for staged in self._staged_ids.values())
+
+    def add(self, kind: str, id_list: Iterable[str]) -> None:
+        """登録したIDを追加する"""
+        self._check_kind(kind)
+        if self._dbm.in_transaction:
+            self._get_staged_ids(self._dbm.transaction_depth, kind).update(id_list)
+        else:
+            self._ids[kind].update(id_list)
+
+    def add_jockeys(self, jockey_dict: Dict[str, str]) -> None:
+        """登録した騎手を追加する (騎手ID -> 騎手名)"""
+        self.add('jockey', jockey_dict.keys())
+        if self._dbm.in_transaction:
+            self._staged_jockey_names.setdefault(self._dbm.transaction_depth, {}).update(jockey_dict)
+        else:
+            for id, name in jockey_dict.items():
+                self._jockey_names.setdefault(name, set()).add(id)
+
+    def get_jockey_id(self, jockey_name: str):
+        """騎手名から騎手IDを返す (見つからない場合や同名の騎手が複数いる場合は NaN)"""
+        id_set = self._jockey_names.get(jockey_name, set())
+        if len(id_set) == 0:
+            warnings.warn("jockey_name:'{}' does not exists. Retun NaN.".format(jockey_name))
+            return np.nan
+        elif len(id_set) > 1:
+            warnings.warn("Multi records of jockey_name:'{}' exist. Return NaN.".format(jockey_name))
+            return np.nan
+        return next(iter(id_set))
+
+    def has_horse_result(self, horse_id: str, race_id: str) -> bool:
+        """(horse_id, race_id) の過去成績が登録済みか"""
+        if horse_id + race_id not in self._horse_results:
+            return False
+        return self._dbm.is_horse_results_inserted(horse_id=horse_id, race_id=race_id)
+
+    def add_horse_results(self, key_list: Iterable[Tuple[str, str]]) -> None:
+        """登録した過去成績の (horse_id, race_id) を追加する
+
+        Bloom filter は誤って登録済みと判定しても has_horse_result でDBに確認するため、
+        transaction 内でも仮登録とせずに追加する。
+        """
+        for horse_id, race_id in key_list:
+            self._horse_results.add(horse_id + race_id)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import socket
+import sqlite3
+import time
+from typing import Dict, Iterable, List
+from common.utils import InvalidArgument
+
+
+JOB_STATUS_LIST = ['pending', 'in_flight', 'done', 'failed']
+JOB_KIND_LIST = ['race', 'horse_results']
+# 同じ対象を繰り返し取得する種類 (完了したジョブも、追加し直した場合は再実行する)
+RECURRING_JOB_KIND_LIST = ['horse_results']
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_BASE = 60.0
+# この時間 [秒] を過ぎても完了も heartbeat も無い in_flight のジョブは、ワーカーが落ちたものとみなす
+# (ワーカーはジョブを1件ずつ完了させ、そのたびに残りのジョブの heartbeat を行う)
+LOCK_TIMEOUT = 30 * 60
+
+CREATE_TABLE_SQL = '''CREATE TABLE if not exists "crawl_job" (
+	"kind"	TEXT NOT NULL,
+	"target_id"	TEXT NOT NULL,
+	"status"	TEXT NOT NULL DEFAULT 'pending',
+	"attempts"	INTEGER NOT NULL DEFAULT 0,
+	"last_error"	TEXT,
+	"next_run_at"	REAL NOT NULL DEFAULT 0,
+	"locked_by"	TEXT,
+	"locked_at"	REAL,
+	"created_at"	REAL,
+	"updated_at"	REAL,
+	PRIMARY KEY("kind","target_id")
+)'''
+CREATE_INDEX_SQL = 'CREATE INDEX if not exists "crawl_job_status" ON "crawl_job" ("kind", "status", "next_run_at")'
+
+
+class JobQueue:
+    """SQLiteに保存する再開可能なスクレイピングのジョブキュー
+
+    ジョブは (kind, target_id) で一意となり、pending -> in_flight -> done/failed と遷移する。
+    取り出しは BEGIN IMMEDIATE の排他で行うため、複数のプロセスが同じキューから
+    ジョブを取り出しても重複しない。
+
+    Parameters
+    ----------
+    db_path : str
+        キューのdbファイルへのパス (ネットワーク越しのロックを避けるため、ローカルに置く)
+    max_attempts : int, default MAX_ATTEMPTS
+        failed とするまでの試行回数
+    """
+
+    def __init__(self, db_path: str, max_attempts: int = MAX_ATTEMPTS) -> None:
+        # トランザクションは明示的に管理する
+        self._conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self._conn.execute(CREATE_TABLE_SQL)
+        self._conn.execute(CREATE_INDEX_SQL)
+        self.max_attempts = max_attempts
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def __del__(self) -> None:
+        self._conn.close()
+
+    @staticmethod
+    def _check_kind(kind: str) -> None:
+        if kind not in JOB_KIND_LIST:
+            raise InvalidArgument("invalid argument of kind: '{}'".format(kind))
+
+    def enqueue(self, kind: str, target_id_list: Iterable[str]) -> int:
+        """ジョブを追加する
+
+        登録済みのジョブは状態を変えない。ただし RECURRING_JOB_KIND_LIST の種類の
+        done のジョブは、試行回数を0に戻して pending にする (出走するたびに過去成績を取得し直すため)。
+
+        Returns
+        -------
+        int
+            新たに追加した (または pending に戻した) ジョブの数
+        """
+        self._check_kind(kind)
+        # 書き込みのロックを取っている間に target_id_list (ジェネレータなど) を評価しない
+        target_id_list = list(target_id_list)
+        now = time.time()
+        if kind in RECURRING_JOB_KIND_LIST:
+            sql = "INSERT INTO crawl_job (kind, target_id, created_at, updated_at) VALUES (?,?,?,?) " \
+                  "ON CONFLICT(kind, target_id) DO UPDATE SET status='pending', attempts=0, last_error=NULL, " \
+                  "next_run_at=0, created_at=excluded.created_at, updated_at=excluded.updated_at WHERE status='done'"
+        else:
+            sql = 'INSERT OR IGNORE INTO crawl_job (kind, target_id, created_at, updated_at) VALUES (?,?,?,?)'
+        cur = self._conn.cursor()
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.executemany(sql, ((kind, target_id, now, now) for target_id in target_id_list))
+            n_added = cur.rowcount
+            cur.execute('COMMIT')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        finally:
+            cur.close()
+        return n_added
+
+    def claim(self, kind: str, n: int = 1) -> List[str]:
+        """実行可能なジョブを最大 n 件取り出し、in_flight にする"""
+        self._check_kind(kind)
+        now = time.time()
+        cur = self._conn.cursor()
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute("SELECT target_id FROM crawl_job WHERE kind=? AND status='pending' AND next_run_at<=? "
+                        "ORDER BY created_at, target_id LIMIT ?", (kind, now, n))
+            target_id_list = [row[0] for row in cur.fetchall()]
+            cur.executemany("UPDATE crawl_job SET status='in_flight', locked_by=?, locked_at=?, updated_at=? "
+                            "WHERE kind=? AND target_id=?",
+                            ((self.worker_id, now, now, kind, target_id) for target_id in target_id_list))
+            cur.execute('COMMIT')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        finally:
+            cur.close()
+        return target_id_list
+
+    def complete(self, kind: str, target_id_list: Iterable[str]) -> None:
+        now = time.time()
+        self._conn.executemany("UPDATE crawl_job SET status='done', locked_by=NULL, locked_at=NULL, updated_at=? "
+                               "WHERE kind=? AND target_id=?",
+                               ((now, kind, target_id) for target_id in target_id_list))
+
+    def heartbeat(self) -> int:
+        """このワーカーの in_flight のジョブのロックの時刻を更新する (recover で pending に戻されないようにする)
+
+        Returns
+        -------
+        int
+            更新したジョブの数
+        """
+        now = time.time()
+        cur = self._conn.execute("UPDATE crawl_job SET locked_at=?, updated_at=? WHERE status='in_flight' AND locked_by=?",
+                                 (now, now, self.worker_id))
+        return cur.rowcount
+
+    def fail(self, kind: str, target_id: str, error: str) -> None:
+        """ジョブの失敗を記録する
+
+        試行回数が max_attempts に達するまでは、指数バックオフ後に再実行する。
+        """
+        now = time.time()
+        cur = self._conn.cursor()
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            cur.execute('SELECT attempts FROM crawl_job WHERE kind=? AND target_id=?', (kind, target_id))
+            attempts = cur.fetchone()[0] + 1
+            if attempts >= self.max_attempts:
+                status = 'failed'
+                next_run_at = now
+            else:
+                status = 'pending'
+                next_run_at = now + RETRY_BACKOFF_BASE * (2 ** (attempts - 1))
+            cur.execute('UPDATE crawl_job SET status=?, attempts=?, last_error=?, next_run_at=?, '
+                        'locked_by=NULL, locked_at=NULL, updated_at=? WHERE kind=? AND target_id=?',
+                        (status, attempts, error, next_run_at, now, kind, target_id))
+            cur.execute('COMMIT')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        finally:
+            cur.close()
+
+    def release(self, kind: str, target_id_list: Iterable[str]) -> None:
+        """中断などで処理しなかったジョブを、試行回数を変えずに pending に戻す"""
+        now = time.time()
+        self._conn.executemany("UPDATE crawl_job SET status='pending', locked_by=NULL, locked_at=NULL, updated_at=? "
+                               "WHERE kind=? AND target_id=? AND status='in_flight'",
+                               ((now, kind, target_id) for target_id in target_id_list))
+
+    def recover(self, lock_timeout: float = LOCK_TIMEOUT) -> int:
+        """ワーカーが落ちて残った in_flight のジョブを pending に戻す
+
+        Returns
+        -------
+        int
+            pending に戻したジョブの数
+        """
+        now = time.time()
+        cur = self._conn.execute("UPDATE crawl_job SET status='pending', locked_by=NULL, locked_at=NULL, updated_at=? "
+                                 "WHERE status='in_flight' AND (locked_at<? OR locked_by=?)",
+                                 (now, now - lock_timeout, self.worker_id))
+        return cur.rowcount
+
+    def retry_failed(self, kind: str = None) -> int:
+        """failed のジョブを試行回数を0に戻して再実行する"""
+        now = time.time()
+        sql = "UPDATE crawl_job SET status='pending', attempts=0, next_run_at=?, updated_at=? WHERE status='failed'"
+        params = [now, now]
+        if kind is not None:
+            self._check_kind(kind)
+            sql += ' AND kind=?'
+            params.append(kind)
+        return self._conn.execute(sql, params).rowcount
+
+    def counts(self, kind: str = None) -> Dict[str, int]:
+        """状態ごとのジョブ数を返す"""
+        sql = 'SELECT status, COUNT(*) FROM crawl_job'
+        params = []
+        if kind is not None:
+            sql += ' WHERE kind=?'
+            params.append(kind)
+        sql += ' GROUP BY status'
+        counts = dict.fromkeys(JOB_STATUS_LIST, 0)
+        counts.update(self._conn.execute(sql, params).fetchall())
+        return counts
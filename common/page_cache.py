@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import email.utils
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+from common.utils import InvalidArgument
+
+
+DEFAULT_CACHE_DIR = os.environ.get('KEIBA_CACHE_DIR', './cache/html')
+
+# キャッシュのモード
+#   normal  : 有効期限内ならキャッシュを使い、期限切れなら条件付きリクエストで再検証する
+#   refresh : 常にダウンロードし、キャッシュを更新する
+#   replay  : キャッシュのみを使う (ネットワークには接続しない)
+#   off     : キャッシュを使わない
+CACHE_MODES = ['normal', 'refresh', 'replay', 'off']
+
+FOREVER = None
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# ページ種別ごとの有効期限 [秒]
+#   (URLのパターン, 有効期限, 確定済みページに含まれる文字列)
+#   確定済みを示す文字列が無いページ (開催前のレースなど) は INCOMPLETE_TTL を適用する
+PAGE_TTL_RULES: List[Tuple[re.Pattern, Union[int, None], Union[str, None]]] = [
+    (re.compile(r'^https://db\.sp\.netkeiba\.com/race/\d+'), FOREVER, 'ResultsByRaceDetail'),
+    (re.compile(r'^https://db\.netkeiba\.com/horse/result/'), DAY, None),
+    (re.compile(r'^https://db\.netkeiba\.com/horse/'), FOREVER, 'blood_table'),
+    (re.compile(r'^https://race\.netkeiba\.com/race/shutuba\.html'), 10 * MINUTE, None),
+    (re.compile(r'^https://race\.netkeiba\.com/top/race_list'), 10 * MINUTE, None),
+    (re.compile(r'^https://db\.netkeiba\.com/\?pid=race_list'), HOUR, None),
+]
+DEFAULT_TTL = DAY
+INCOMPLETE_TTL = DAY
+
+
+def _tmp_suffix() -> str:
+    """書き込み用の一時ファイルの接尾辞 (同じURLを複数のプロセスやスレッドが同時に書き込んでも衝突しない)"""
+    return '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+
+
+class CacheMiss(Exception):
+    """replay モードでキャッシュに存在しないページを要求した場合の例外クラス"""
+    pass
+
+
+class CacheEntry:
+    """キャッシュされたページ
+
+    Parameters
+    ----------
+    url : str
+        URL
+    content : bytes
+        レスポンスのバイト列 (デコード前)
+    meta : dict
+        取得日時やバリデータ (ETag, Last-Modified) などのメタデータ
+    """
+
+    def __init__(self, url: str, content: bytes, meta: Dict[str, Union[str, float, None]]) -> None:
+        self.url = url
+        self.content = content
+        self.meta = meta
+
+    @property
+    def fetched_at(self) -> float:
+        return self.meta['fetched_at']
+
+    @property
+    def ttl(self) -> Union[int, None]:
+        return self.meta['ttl']
+
+    def is_fresh(self, now: float = None) -> bool:
+        if self.ttl is FOREVER:
+            return True
+        if now is None:
+            now = time.time()
+        return now - self.fetched_at < self.ttl
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """再検証用のリクエストヘッダ"""
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('last_modified'):
+            headers['If-Modified-Since'] = self.meta['last_modified']
+        else:
+            headers['If-Modified-Since'] = email.utils.formatdate(self.fetched_at, usegmt=True)
+        return headers
+
+
+class PageCache:
+    """URLをキーとした圧縮HTMLキャッシュクラス
+
+    URLのハッシュ値をファイル名として、gzip 圧縮したバイト列とメタデータ (json) を保存する。
+
+    Parameters
+    ----------
+    cache_dir : str, default DEFAULT_CACHE_DIR
+        キャッシュの保存先ディレクトリ
+    mode : str, default 'normal'
+        キャッシュのモード (CACHE_MODES のいずれか)
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, mode: str = 'normal') -> None:
+        self.cache_dir = cache_dir
+        self.set_mode(mode)
+
+    def set_mode(self, mode: str) -> None:
+        if mode not in CACHE_MODES:
+            raise InvalidArgument("invalid argument of mode: '{}'".format(mode))
+        self.mode = mode
+
+    def _path(self, url: str) -> str:
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, url: str) -> Union[CacheEntry, None]:
+        if self.mode in ['off', 'refresh']:
+            return None
+
+        path = self._path(url)
+        try:
+            with open(path + '.json', encoding='utf-8') as f:
+                meta = json.load(f)
+            with gzip.open(path + '.html.gz', 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+
+        return CacheEntry(url, content, meta)
+
+    def put(self, url: str, content: bytes, headers: Dict[str, str] = None) -> None:
+        if self.mode == 'off':
+            return
+
+        if headers is None:
+            headers = {}
+        meta = {
+            'url': url,
+            'fetched_at': time.time(),
+            'ttl': ttl_for(url, content),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書き込み途中のファイルを読まないように一時ファイル経由で置き換える
+        tmp_suffix = _tmp_suffix()
+        with gzip.open(path + '.html.gz' + tmp_suffix, 'wb') as f:
+            f.write(content)
+        with open(path + '.json' + tmp_suffix, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(path + '.html.gz' + tmp_suffix, path + '.html.gz')
+        os.replace(path + '.json' + tmp_suffix, path + '.json')
+
+    def touch(self, entry: CacheEntry) -> None:
+        """再検証の結果、変更が無かったエントリの取得日時を更新する"""
+        meta = dict(entry.meta, fetched_at=time.time())
+        path = self._path(entry.url)
+        # 他のスレッドが読み込み中のファイルを書き換えないように、put と同じく一時ファイル経由で置き換える
+        tmp_path = path + '.json' + _tmp_suffix()
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path + '.json')
+
+    def invalidate(self, url: str) -> None:
+        path = self._path(url)
+        for ext in ['.json', '.html.gz']:
+            if os.path.exists(path + ext):
+                os.remove(path + ext)
+
+    def iter_entries(self):
+        """キャッシュされている全エントリを返すジェネレータ"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        for sub_dir in sorted(os.listdir(self.cache_dir)):
+            dir_path = os.path.join(self.cache_dir, sub_dir)
+            if not os.path.isdir(dir_path):
+                continue
+            for filename in sorted(os.listdir(dir_path)):
+                if not filename.endswith('.json'):
+                    continue
+                with open(os.path.join(dir_path, filename), encoding='utf-8') as f:
+                    url = json.load(f)['url']
+                entry = self.get(url)
+                if entry is not None:
+                    yield entry
+
+
+def ttl_for(url: str, content: bytes) -> Union[int, None]:
+    """ページの有効期限を返す関数
+
+    Parameters
+    ----------
+    url : str
+        URL
+    content : bytes
+        レスポンスのバイト列
+
+    Returns
+    -------
+    int or None
+        有効期限 [秒] (None は無期限)
+    """
+    for pattern, ttl, final_marker in PAGE_TTL_RULES:
+        if pattern.search(url):
+            if final_marker is not None and final_marker.encode('ascii') not in content:
+                return INCOMPLETE_TTL
+            return ttl
+    return DEFAULT_TTL
+
+
+# 全スクレイパーで共有するキャッシュ
+page_cache = PageCache(mode=os.environ.get('KEIBA_CACHE_MODE', 'normal'))
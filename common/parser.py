@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import re
+from typing import Any, List, Union
+from common.utils import InvalidArgument
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+
+class SoupParser:
+    """BeautifulSoup (html.parser) によるHTML解析バックエンド"""
+
+    name = 'html.parser'
+
+    def root(self, page: Any) -> Any:
+        return page.soup
+
+    def find(self, node: Any, tag: str, cls: str) -> Any:
+        return node.find(tag, attrs={'class': cls})
+
+    def find_all(self, node: Any, tag: str, cls: str = None) -> List[Any]:
+        if cls is None:
+            return node.find_all(tag)
+        return node.find_all(tag, attrs={'class': cls})
+
+    def text(self, node: Any) -> str:
+        return node.text
+
+    def attr(self, node: Any, name: str, default: str = None) -> str:
+        return node.get(name, default)
+
+    def hrefs(self, node: Any, pattern: str = None) -> List[str]:
+        if pattern is None:
+            return [a.get('href') for a in node.find_all('a')]
+        return [a['href'] for a in node.find_all('a', attrs={'href': re.compile(pattern)})]
+
+
+class LxmlParser:
+    """lxml (XPath) によるHTML解析バックエンド
+
+    SoupParser と同じ要素を同じ順序で返す。
+    """
+
+    name = 'lxml'
+
+    @staticmethod
+    def _xpath(tag: str, cls: str) -> str:
+        # BeautifulSoup と同様に、空白を含むクラス指定は属性値の完全一致、
+        # それ以外はクラスのいずれかとの一致で判定する
+        if ' ' in cls:
+            return './/{}[@class="{}"]'.format(tag, cls)
+        return './/{}[contains(concat(" ", normalize-space(@class), " "), " {} ")]'.format(tag, cls)
+
+    def root(self, page: Any) -> Any:
+        return page.tree
+
+    def find(self, node: Any, tag: str, cls: str) -> Any:
+        elems = node.xpath(self._xpath(tag, cls))
+        return elems[0] if elems else None
+
+    def find_all(self, node: Any, tag: str, cls: str = None) -> List[Any]:
+        if cls is None:
+            return node.xpath('.//' + tag)
+        return node.xpath(self._xpath(tag, cls))
+
+    def text(self, node: Any) -> str:
+        return node.text_content()
+
+    def attr(self, node: Any, name: str, default: str = None) -> str:
+        return node.get(name, default)
+
+    def hrefs(self, node: Any, pattern: str = None) -> List[str]:
+        if pattern is None:
+            return [a.get('href') for a in node.iter('a')]
+        regex = re.compile(pattern)
+        return [href for href in (a.get('href') for a in node.iter('a')) if href is not None and regex.search(href)]
+
+
+PARSER_BACKENDS = {
+    SoupParser.name: SoupParser,
+    LxmlParser.name: LxmlParser,
+}
+
+_parser: Union[SoupParser, LxmlParser] = LxmlParser() if lxml is not None else SoupParser()
+
+
+def get_parser() -> Union[SoupParser, LxmlParser]:
+    """スクレイパーで使うHTML解析バックエンドを返す関数"""
+    return _parser
+
+
+def set_parser(name: str) -> None:
+    """スクレイパーで使うHTML解析バックエンドを切り替える関数
+
+    Parameters
+    ----------
+    name : str
+        'lxml' or 'html.parser'
+    """
+    global _parser
+    if name not in PARSER_BACKENDS:
+        raise InvalidArgument("invalid argument of name: '{}'".format(name))
+    if name == LxmlParser.name and lxml is None:
+        raise InvalidArgument("lxml is not installed.")
+    _parser = PARSER_BACKENDS[name]()
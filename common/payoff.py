@@ -4,7 +4,8 @@ import sys
 sys.path.append(os.pardir)
 from typing import List
 import pandas as pd
-from common.dbapi import DBManager
+from common.dbapi import reader_pool
+from common.replica import sync_replica
 
 
 def str_list_to_int(x: List[str]) -> List[int]:
@@ -16,9 +17,12 @@ class Payoff:
         self.table = payoff_table
 
     @classmethod
-    def read_db(cls, db_path: str) -> 'Payoff':
-        dbm = DBManager(db_path)
-        df = dbm.select_payoffs()
+    def read_db(cls, db_path: str, use_replica: bool = True) -> 'Payoff':
+        """DBから払い戻し表を読み込む (use_replica が True の場合は、同期したローカルのレプリカから読み込む)"""
+        if use_replica:
+            db_path = sync_replica(db_path)
+        with reader_pool.reader(db_path) as dbm:
+            df = dbm.select_payoffs()
         return cls(df.set_index('race_id'))
 
     @property
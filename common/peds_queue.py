@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import List, Set, Tuple, Union
+import pandas as pd
+from common.crawler import DEFAULT_MAX_WORKERS
+from common.scrape import scrape_horse_peds
+
+
+class PedsQueue:
+    """馬の血統をバックグラウンドで取得するキュー
+
+    同じ馬IDは1度しか取得しない (取得に失敗した馬IDは、再び予約できる)。取得結果は drain で取り出し、
+    DBへの書き込みは呼び出し側のスレッドで行う。
+
+    Parameters
+    ----------
+    max_workers : int, default DEFAULT_MAX_WORKERS
+        血統を取得するスレッド数
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='peds')
+        self._lock = threading.Lock()
+        self._submitted: Set[str] = set()
+        self._futures: List[Future] = []
+        self._results = queue.Queue()
+        self.n_submitted = 0
+        self.n_done = 0
+        self.n_failed = 0
+
+    def _fetch(self, horse_id: str) -> None:
+        try:
+            peds = scrape_horse_peds(horse_id)
+            self._results.put((horse_id, peds, None))
+        except Exception as e:
+            # 失敗した馬IDは regist_missing_horse_peds などで予約し直せるようにする
+            with self._lock:
+                self._submitted.discard(horse_id)
+            self._results.put((horse_id, None, e))
+
+    def submit(self, horse_id: str) -> bool:
+        """血統の取得を予約する (予約済みの馬IDの場合は False を返す)"""
+        with self._lock:
+            if horse_id in self._submitted:
+                return False
+            self._submitted.add(horse_id)
+            self._futures.append(self._executor.submit(self._fetch, horse_id))
+            self.n_submitted += 1
+        return True
+
+    def drain(self) -> List[Tuple[str, Union[pd.Series, None], Union[Exception, None]]]:
+        """取得が完了した血統を全て取り出す (ブロックしない)"""
+        results = []
+        while True:
+            try:
+                horse_id, peds, error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if error is None:
+                self.n_done += 1
+            else:
+                self.n_failed += 1
+            results.append((horse_id, peds, error))
+        return results
+
+    def join(self) -> None:
+        """予約済みの血統の取得が全て完了するまで待つ"""
+        with self._lock:
+            futures = list(self._futures)
+            self._futures.clear()
+        wait(futures)
+
+    @property
+    def n_pending(self) -> int:
+        return self.n_submitted - self.n_done - self.n_failed
+
+    def shutdown(self) -> None:
+        """未実行の予約を取り消し、血統を取得するスレッドを終了する"""
+        self._executor.shutdown(cancel_futures=True)
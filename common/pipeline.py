@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple, Union
+from common.crawler import DEFAULT_MAX_WORKERS
+from common.parser import get_parser, set_parser
+from common.utils import InvalidArgument
+
+
+DEFAULT_N_PARSERS = max(1, (os.cpu_count() or 2) - 1)
+DEFAULT_QUEUE_SIZE = 32
+_POLL_INTERVAL = 0.1
+
+
+class _Done:
+    """ステージの終了を表す番兵"""
+    pass
+
+
+_DONE = _Done()
+
+
+def _init_parse_worker(parser_name: str) -> None:
+    # spawn で起動したプロセス (Windows) は呼び出し元の set_parser を引き継がないため、ここで揃える
+    set_parser(parser_name)
+
+
+def create_parse_executor(n_parsers: int = DEFAULT_N_PARSERS) -> ProcessPoolExecutor:
+    """解析用のプロセスプールを作る (各プロセスは呼び出し元で選択しているHTML解析バックエンドを使う)"""
+    return ProcessPoolExecutor(max_workers=n_parsers, initializer=_init_parse_worker, initargs=(get_parser().name,))
+
+
+class StageStats:
+    """パイプラインの1ステージの処理件数と処理時間を集計するクラス"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.n_items = 0
+        self.n_errors = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float, is_error: bool = False) -> None:
+        with self._lock:
+            self.n_items += 1
+            self.busy_seconds += seconds
+            if is_error:
+                self.n_errors += 1
+
+
+class Pipeline:
+    """取得 (スレッド) -> 解析 (プロセスプール) -> 書き込み (呼び出し側のスレッド) のパイプライン
+
+    各ステージは上限付きのキューでつながり、後段が詰まると前段は待機する。
+
+    Parameters
+    ----------
+    fetch : Callable[[str], Any]
+        IDを受け取りページを取得する関数 (スレッドで実行する)
+    parse : Callable[[Any], Any]
+        fetch の戻り値を解析する関数 (プロセスで実行するため、pickle 可能であること)
+    n_fetchers : int, default DEFAULT_MAX_WORKERS
+        取得スレッドの数
+    n_parsers : int, default DEFAULT_N_PARSERS
+        解析プロセスの数 (0 の場合はプロセスを使わずにスレッド内で解析する)
+    queue_size : int, default DEFAULT_QUEUE_SIZE
+        ステージ間のキューの上限
+    executor : ProcessPoolExecutor, optional
+        解析に使うプロセスプール (create_parse_executor で作成したもの)。
+        省略時は初回の run で作成して run をまたいで使い回し、close で終了する。
+    """
+
+    def __init__(
+            self,
+            fetch: Callable[[str], Any],
+            parse: Callable[[Any], Any],
+            n_fetchers: int = DEFAULT_MAX_WORKERS,
+            n_parsers: int = DEFAULT_N_PARSERS,
+            queue_size: int = DEFAULT_QUEUE_SIZE,
+            executor: ProcessPoolExecutor = None
+        ) -> None:
+        if n_fetchers < 1:
+            raise InvalidArgument("'n_fetchers' must be >=1")
+        if n_parsers < 0:
+            raise InvalidArgument("'n_parsers' must be >=0")
+
+        self.fetch = fetch
+        self.parse = parse
+        self.n_fetchers = n_fetchers
+        self.n_parsers = n_parsers
+        self.queue_size = queue_size
+        self.stats: Dict[str, StageStats] = {}
+        self._elapsed = 0.0
+        self._executor = executor
+        # 渡されたプロセスプールは呼び出し元が終了させる
+        self._owns_executor = executor is None
+
+    def _get_executor(self) -> Union[ProcessPoolExecutor, None]:
+        if self.n_parsers == 0:
+            return None
+        if self._executor is None:
+            self._executor = create_parse_executor(self.n_parsers)
+        return self._executor
+
+    def close(self) -> None:
+        """run で作成した解析用のプロセスを終了する"""
+        if self._owns_executor and self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _put(self, q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue, stop: threading.Event) -> Any:
+        while not stop.is_set():
+            try:
+                return q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _feed(self, id_list: Iterable[str], id_queue: queue.Queue, stop: threading.Event) -> None:
+        for id in id_list:
+            if not self._put(id_queue, id, stop):
+                return
+        for _ in range(self.n_fetchers):
+            self._put(id_queue, _DONE, stop)
+
+    def _fetch_worker(self, id_queue: queue.Queue, fetched_queue: queue.Queue, stop: threading.Event) -> None:
+        while True:
+            id = self._get(id_queue, stop)
+            if id is _DONE:
+                return
+
+            start = time.perf_counter()
+            try:
+                item = (id, self.fetch(id), None)
+            except Exception as e:
+                item = (id, None, e)
+            self.stats['fetch'].add(time.perf_counter() - start, item[2] is not None)
+
+            if not self._put(fetched_queue, item, stop):
+                return
+
+    def _parse_worker(
+            self,
+            executor: Union[ProcessPoolExecutor, None],
+            fetched_queue: queue.Queue,
+            parsed_queue: queue.Queue,
+            stop: threading.Event
+        ) -> None:
+        while True:
+            item = self._get(fetched_queue, stop)
+            if item is _DONE:
+                return
+
+            id, fetched, error = item
+            if error is None:
+                start = time.perf_counter()
+                try:
+                    if executor is None:
+                        parsed = self.parse(fetched)
+                    else:
+                        parsed = executor.submit(self.parse, fetched).result()
+                    item = (id, parsed, None)
+                except Exception as e:
+                    item = (id, None, e)
+                self.stats['parse'].add(time.perf_counter() - start, item[2] is not None)
+
+            if not self._put(parsed_queue, item, stop):
+                return
+
+    def _close_stage(self, threads, next_queue: queue.Queue, n_done: int, stop: threading.Event) -> None:
+        for t in threads:
+            t.join()
+        for _ in range(n_done):
+            self._put(next_queue, _DONE, stop)
+
+    def run(self, id_list: Iterable[str]) -> Iterator[Tuple[str, Any, Union[Exception, None]]]:
+        """id_list の各IDを取得・解析し、解析できた順に返す
+
+        書き込みステージは、このジェネレータを消費する呼び出し側のスレッドで行う。
+
+        Yields
+        ------
+        id : str
+            ID
+        result : Any
+            parse の戻り値 (例外発生時は None)
+        error : Exception or None
+            fetch または parse で発生した例外
+        """
+        self.stats = {name: StageStats(name) for name in ['fetch', 'parse', 'write']}
+        stop = threading.Event()
+        id_queue = queue.Queue(maxsize=self.queue_size)
+        fetched_queue = queue.Queue(maxsize=self.queue_size)
+        parsed_queue = queue.Queue(maxsize=self.queue_size)
+        n_parse_threads = max(1, self.n_parsers)
+        executor = self._get_executor()
+
+        fetchers = [threading.Thread(target=self._fetch_worker, args=(id_queue, fetched_queue, stop), daemon=True)
+                    for _ in range(self.n_fetchers)]
+        parsers = [threading.Thread(target=self._parse_worker, args=(executor, fetched_queue, parsed_queue, stop), daemon=True)
+                   for _ in range(n_parse_threads)]
+        threads = [
+            threading.Thread(target=self._feed, args=(id_list, id_queue, stop), daemon=True),
+            threading.Thread(target=self._close_stage, args=(fetchers, fetched_queue, n_parse_threads, stop), daemon=True),
+            threading.Thread(target=self._close_stage, args=(parsers, parsed_queue, 1, stop), daemon=True),
+        ]
+
+        start = time.perf_counter()
+        for t in fetchers + parsers + threads:
+            t.start()
+
+        try:
+            while True:
+                item = self._get(parsed_queue, stop)
+                if item is _DONE:
+                    break
+                write_start = time.perf_counter()
+                yield item
+                self.stats['write'].add(time.perf_counter() - write_start)
+        finally:
+            # プロセスプールは次の run で使い回すため終了しない (解析スレッドは実行中の1件を終えると止まる)
+            stop.set()
+            self._elapsed = time.perf_counter() - start
+
+    def report(self) -> str:
+        """ステージごとの処理件数とスループットを文字列で返す"""
+        lines = []
+        for stats in self.stats.values():
+            throughput = stats.n_items / self._elapsed if self._elapsed > 0 else 0.0
+            lines.append('{:<6} items:{:>7} errors:{:>5} busy:{:>9.1f}s throughput:{:>8.2f}/s'.format(
+                stats.name, stats.n_items, stats.n_errors, stats.busy_seconds, throughput))
+        return '\n'.join(lines)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import datetime as dt
+from typing import Iterator
+from common.dbapi import DBManager
+from common.scrape import scrape_race_exists
+from common.utils import (
+    MAX_DAY_NUM,
+    MAX_HOLD_NUM,
+    MAX_PLACE_NUM,
+    MAX_RACE_NUM,
+    InvalidArgument
+)
+
+
+class RaceIdProber:
+    """開催の有無を確認しながらレースIDを生成するクラス
+
+    各日の1Rが存在しなければその日以降を、各回の1日目が存在しなければその回以降を
+    スキップする。確定済みの年 (今年より前) で開催が無いと分かった範囲はDBに記録し、
+    次回以降は確認しない。
+
+    Parameters
+    ----------
+    db_path : str
+        dbファイルへのパス
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self._dbm = DBManager(db_path)
+
+    def _exists(self, race_id: str) -> bool:
+        if self._dbm.is_id_inserted('race_info', race_id):
+            return True
+        try:
+            return scrape_race_exists(race_id)
+        except Exception as e:
+            # 確認できなかった場合は開催があるものとして扱い、記録もしない
+            print("'{}' has been raised while probing race_id:'{}' ({})".format(e.__class__.__name__, race_id, e))
+            return True
+
+    def _record_empty(self, year: int, place: int, hold: int, day: int) -> None:
+        sql = 'INSERT OR REPLACE INTO race_id_probe VALUES (?,?,?,?,?)'
+        checked_at = int(dt.date.today().strftime('%Y%m%d'))
+        self._dbm.insert_data(sql, (year, place, hold, day, checked_at))
+
+    def iter_race_id_list(self, year: int) -> Iterator[str]:
+        """
+        指定した年の開催があるレースIDを順に生成する
+
+        Parameters
+        ----------
+        year : int
+            年 (>= 1975 and <= 今年)
+
+        Yields
+        ------
+        str
+            レースID
+        """
+        # 引数チェック
+        if year < 1975:
+            raise InvalidArgument("引数 year は 1975 以上の整数を指定してください。")
+        if year > dt.date.today().year:
+            raise InvalidArgument("引数 year は %d 以下の整数を指定してください。" % dt.date.today().year)
+
+        # 今年の未開催分は後から開催されるため記録しない
+        is_final = year < dt.date.today().year
+        empty_set = self._dbm.get_empty_race_ranges(year)
+
+        for place in range(1, MAX_PLACE_NUM):
+            for hold in range(1, MAX_HOLD_NUM):
+                if (place, hold, 0) in empty_set:
+                    break
+
+                hold_exists = True
+                for day in range(1, MAX_DAY_NUM):
+                    if (place, hold, day) in empty_set:
+                        break
+
+                    race_id = "{:4d}{:0>2d}{:0>2d}{:0>2d}{:0>2d}".format(year, place, hold, day, 1)
+                    if not self._exists(race_id):
+                        # hold_day=0 はその回以降の開催が無いことを表す
+                        if is_final:
+                            self._record_empty(year, place, hold, 0 if day == 1 else day)
+                        hold_exists = (day > 1)
+                        break
+
+                    for race in range(1, MAX_RACE_NUM):
+                        yield "{:4d}{:0>2d}{:0>2d}{:0>2d}{:0>2d}".format(year, place, hold, day, race)
+
+                # 1日目が無い回以降は開催が無い
+                if not hold_exists:
+                    break
@@ -6,21 +6,72 @@ import datetime as dt
 import numpy as np
 import pandas as pd
 import re
-from typing import Dict, List
-from common.utils import get_environment, judge_region
+from functools import partial
+from typing import Callable, Dict, List
+from common.utils import InvalidArgument, get_environment, judge_region
 if get_environment() == 'Jupyter':
     from tqdm.notebook import tqdm
 else:
     from tqdm import tqdm
+from common.crawler import DEFAULT_MAX_WORKERS
 from common.dbapi import DBManager
-from common.scrape import scrape_horse_peds, scrape_horse_results, scrape_race_info
+from common.derived_columns import derive_horse_results_columns, derive_results_columns
+from common.id_cache import IdCache
+from common.job_queue import JobQueue
+from common.peds_queue import PedsQueue
+from common.parser import get_parser
+from common.pipeline import DEFAULT_N_PARSERS, Pipeline, create_parse_executor
+from common.scrape import fetch_horse_results_page, fetch_race_info_page, parse_horse_results, parse_race_info
+
+
+# 最終確認日からこの日数が経過した馬は、新しいレースが見つからなくても再取得する
+# (results に登録されない地方・海外のレースへの出走を取りこぼさないため)
+FRESHNESS_MAX_AGE_DAYS = 28
 
 
 class Registar:
-    def __init__(self, db_path: str) -> None:
+    def __init__(self, db_path: str, max_workers: int = DEFAULT_MAX_WORKERS, n_parsers: int = DEFAULT_N_PARSERS) -> None:
         self._dbm = DBManager(db_path)
+        # 登録済みかどうかの確認はDBに問い合わせずにこのキャッシュで行う
+        self._ids = IdCache(self._dbm)
+        self.max_workers = max_workers
+        self.n_parsers = n_parsers
+        # 解析用のプロセスプール (初回の登録で作成し、以降のバッチで使い回す)
+        self._parse_executor = None
+        self._parser_name = None
+        self._peds_queue = PedsQueue(max_workers)
+        # ID -> 直近に発生したエラー
+        self.errors: Dict[str, str] = {}
+
+    def _pipeline(self, fetch, parse) -> Pipeline:
+        return Pipeline(fetch, parse, n_fetchers=self.max_workers, n_parsers=self.n_parsers,
+                        executor=self._get_parse_executor())
+
+    def _get_parse_executor(self):
+        if self.n_parsers == 0:
+            return None
+        # HTML解析バックエンドを切り替えた場合は、各プロセスに反映するため作り直す
+        if self._parse_executor is not None and self._parser_name != get_parser().name:
+            self._parse_executor.shutdown()
+            self._parse_executor = None
+        if self._parse_executor is None:
+            self._parser_name = get_parser().name
+            self._parse_executor = create_parse_executor(self.n_parsers)
+        return self._parse_executor
 
-    def regist_race_results(self, race_id_list: List[str]):
+    def close(self) -> None:
+        """解析用のプロセスと、血統を取得するスレッドを終了する"""
+        if self._parse_executor is not None:
+            self._parse_executor.shutdown()
+            self._parse_executor = None
+        self._peds_queue.shutdown()
+
+    def _report_error(self, id_name: str, id: str, e: Exception) -> None:
+        message = "'{}' has been raised with {}:'{}' ({})".format(e.__class__.__name__, id_name, id, e.args[0] if e.args else '')
+        print(message)
+        self.errors[id] = message
+
+    def regist_race_results(self, race_id_list: List[str], on_finished: Callable[[str, bool], None] = None) -> List[str]:
         """
         レース結果をDBに登録する関数
 
@@ -28,131 +79,309 @@ class Registar:
         ----------
         race_id_list : list[str]
             レースIDのリスト
+        on_finished : Callable[[str, bool], None], optional
+            1レースの登録が終わるたびに (レースID, 登録できたか) で呼ぶ関数
+            (血統の取得を待つ前に、レースごとにジョブを完了させるために使う)
+
+        Returns
+        -------
+        list[str]
+            登録に失敗したレースIDのリスト
         """
-        for race_id in tqdm(race_id_list):
-            if self._dbm.is_id_inserted('race_info', race_id):
+        target_id_list = []
+        for race_id in race_id_list:
+            if self._ids.has('race_info', race_id):
                 print('race_id:{} has been inserted.'.format(race_id))
+                if on_finished is not None:
+                    on_finished(race_id, True)
                 continue
+            target_id_list.append(race_id)
 
+        ng_id_list = []
+        # 取得はスレッド、解析はプロセスで並行して行い、DBへの登録は解析できた順にこのスレッドで行う
+        pipeline = self._pipeline(fetch_race_info_page, parse_race_info)
+        for race_id, scraped, error in tqdm(pipeline.run(target_id_list), total=len(target_id_list)):
+            ok = True
             try:
-                race_info, results, payoff_table = scrape_race_info(race_id)
+                if error is not None:
+                    raise error
+
+                race_info, results, payoff_table = scraped
+                # 1レース分の書き込みは1回のコミットで行い、失敗した場合は全て取り消す
+                with self._dbm.transaction():
+                    self._regist_jockey(dict(zip(results['jockey_id'], results['騎手'])))
+                    self._regist_trainer(dict(zip(results['trainer_id'], results['調教師'])))
+                    self._regist_race_info(race_id, race_info)
+                    self._regist_result(race_id, results)
+                    self._regist_payoff(race_id, payoff_table)
+                    self._ids.add('race_info', [race_id])
                 self.regist_horse_peds(dict(zip(results['horse_id'], results['馬名'])))
-                self._regist_jockey(dict(zip(results['jockey_id'], results['騎手'])))
-                self._regist_trainer(dict(zip(results['trainer_id'], results['調教師'])))
-                self._regist_race_info(race_id, race_info)
-                self._regist_result(race_id, results)
-                self._regist_payoff(race_id, payoff_table)
             except Exception as e:
-                print("'{}' has been raised with race_id:'{}' ({})".format(e.__class__.__name__, race_id, e.args[0]))
+                self._report_error('race_id', race_id, e)
+                ng_id_list.append(race_id)
+                ok = False
+
+            if on_finished is not None:
+                on_finished(race_id, ok)
+            # 取得が完了した血統を書き込む
+            self._write_horse_peds()
+
+        print(pipeline.report())
+        self.wait_horse_peds()
+        return ng_id_list
 
     def regist_horse_results(
             self,
             horse_id_list: List[str] = None,
             with_jockey_id: bool = True,
-            tqdm_leave: bool = True
+            tqdm_leave: bool = True,
+            skip_fresh: bool = True,
+            on_finished: Callable[[str, bool], None] = None
         ) -> List[str]:
         if horse_id_list is None:
             horse_id_list = self._dbm.get_horse_id_list()
 
+        if skip_fresh:
+            # 新しいレースが無いと分かっている馬はスキップ
+            horse_id_list = self._filter_stale_horses(horse_id_list)
+
         ng_id_list = []
-        for horse_id in tqdm(horse_id_list, leave=tqdm_leave):
+        pipeline = self._pipeline(fetch_horse_results_page, partial(parse_horse_results, with_jockey_id=with_jockey_id))
+        for horse_id, df, error in tqdm(pipeline.run(horse_id_list), total=len(horse_id_list), leave=tqdm_leave):
+            ok = True
             try:
-                df = scrape_horse_results(horse_id, with_jockey_id)
+                if error is not None:
+                    raise error
 
                 natinal_idx = df['race_id'].map(lambda x: judge_region(x) != 'Overseas')
                 df.loc[natinal_idx, '賞金'] = df.loc[natinal_idx, '賞金'].fillna(0)
+                last_race_date = pd.to_datetime(df['日付'], format='%Y/%m/%d').max()
 
-                for row in df.itertuples(name=None):
-                    race_id = row[29]
-
-                    if self._dbm.is_horse_results_inserted(horse_id=horse_id, race_id=race_id):
-                        # 処理時間短縮のため、登録済みならスキップ
-                        break
-
-                    if with_jockey_id:
-                        jockey_id = row[30]
-                        if pd.notna(row[13]) and pd.notna(jockey_id):
-                            jockey_dict = {}
-                            jockey_dict[jockey_id] = row[13]
-                            self._regist_jockey(jockey_dict)
-                    else:
-                        if pd.notna(row[13]):
-                            jockey_id = self._dbm.get_jockey_id(row[13])
-                        else:
-                            jockey_id = np.nan
-
-                    is_overseas = (judge_region(race_id) == 'Overseas')
-
-                    if not self._dbm.is_id_inserted('race_info', race_id):
-                        info = {
-                            'date': int(dt.datetime.strptime(row[1], '%Y/%m/%d').date().strftime('%Y%m%d')),
-                            'title': row[5],
-                            'distance': int(re.findall(r'\d+', row[15])[0]),
-                            'race_type': re.findall(r'\D+', row[15])[0],
-                            'turn': np.nan,
-                            'ground_state': row[16],
-                            'weather': row[3],
-                            'horse_num': row[7]
-                        }
-
-                        if is_overseas:
-                            info['place_id'] = race_id[4:6]
-                            info['hold_no'] = np.nan
-                            info['hold_day'] = np.nan
-                            info['race_no'] = int(race_id[10:12])
-                        else:
-                            info['place_id'] = str(int(race_id[4:6]))
-                            info['hold_no'] = int(race_id[6:8])
-                            info['hold_day'] = int(race_id[8:10])
-                            info['race_no'] = row[4]
-
-                        sql = 'INSERT INTO race_info VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)'
-                        data = (race_id, info['title'], info['date'],
-                                info['place_id'], info['hold_no'],
-                                info['hold_day'], info['race_no'],
-                                info['distance'], info['race_type'],
-                                info['turn'], info['ground_state'],
-                                info['weather'], info['horse_num'])
-                        self._dbm.insert_data(sql, data)
-
-                    sql = 'INSERT INTO horse_results VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'
-                    data = (horse_id, race_id, row[8], row[9], row[10],
-                            row[11], row[12], jockey_id, row[14], row[18],
-                            row[19], row[21], row[22], row[23], row[24],
-                            row[28])
-                    self._dbm.insert_data(sql, data)
+                # 1頭分の書き込みは1回のコミットで行う
+                with self._dbm.transaction():
+                    self._regist_horse_results(horse_id, df, with_jockey_id)
+                    self._update_horse_freshness(horse_id, last_race_date)
             except Exception as e:
-                print("'{}' has been raised with horse_id:'{}' ({})".format(e.__class__.__name__, horse_id, e.args[0]))
+                self._report_error('horse_id', horse_id, e)
                 ng_id_list.append(horse_id)
+                ok = False
+
+            if on_finished is not None:
+                on_finished(horse_id, ok)
+            self._write_horse_peds()
 
+        if tqdm_leave:
+            print(pipeline.report())
         return ng_id_list
 
+    def _regist_horse_results(self, horse_id: str, df: pd.DataFrame, with_jockey_id: bool) -> None:
+        race_info_list = []
+        horse_results_list = []
+        for row in df.itertuples(name=None):
+            race_id = row[29]
+
+            if self._ids.has_horse_result(horse_id, race_id):
+                # 処理時間短縮のため、登録済みならスキップ
+                break
+
+            if with_jockey_id:
+                jockey_id = row[30]
+                if pd.notna(row[13]) and pd.notna(jockey_id):
+                    jockey_dict = {}
+                    jockey_dict[jockey_id] = row[13]
+                    self._regist_jockey(jockey_dict)
+            else:
+                if pd.notna(row[13]):
+                    jockey_id = self._ids.get_jockey_id(row[13])
+                else:
+                    jockey_id = np.nan
+
+            is_overseas = (judge_region(race_id) == 'Overseas')
+
+            if not self._ids.has('race_info', race_id):
+                info = {
+                    'date': int(dt.datetime.strptime(row[1], '%Y/%m/%d').date().strftime('%Y%m%d')),
+                    'title': row[5],
+                    'distance': int(re.findall(r'\d+', row[15])[0]),
+                    'race_type': re.findall(r'\D+', row[15])[0],
+                    'turn': np.nan,
+                    'ground_state': row[16],
+                    'weather': row[3],
+                    'horse_num': row[7]
+                }
+
+                if is_overseas:
+                    info['place_id'] = race_id[4:6]
+                    info['hold_no'] = np.nan
+                    info['hold_day'] = np.nan
+                    info['race_no'] = int(race_id[10:12])
+                else:
+                    info['place_id'] = str(int(race_id[4:6]))
+                    info['hold_no'] = int(race_id[6:8])
+                    info['hold_day'] = int(race_id[8:10])
+                    info['race_no'] = row[4]
+
+                race_info_list.append((race_id, info['title'], info['date'],
+                                       info['place_id'], info['hold_no'],
+                                       info['hold_day'], info['race_no'],
+                                       info['distance'], info['race_type'],
+                                       info['turn'], info['ground_state'],
+                                       info['weather'], info['horse_num']))
+
+            horse_results_list.append((horse_id, race_id, row[8], row[9], row[10],
+                                       row[11], row[12], jockey_id, row[14], row[18],
+                                       row[19], row[21], row[22], row[23], row[24],
+                                       row[28]) + derive_horse_results_columns(row[18], row[21]))
+
+        self._dbm.execute_many('INSERT OR IGNORE INTO race_info VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', race_info_list)
+        self._dbm.execute_many('INSERT OR IGNORE INTO horse_results VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                               horse_results_list)
+        self._ids.add('race_info', [data[0] for data in race_info_list])
+        self._ids.add_horse_results((data[0], data[1]) for data in horse_results_list)
+
+    def drain_jobs(self, job_queue: JobQueue, kind: str, batch_size: int = 100, skip_fresh: bool = True) -> None:
+        """
+        ジョブキューから実行可能なジョブを取り出して登録する関数
+
+        ジョブは1件の登録が終わるたびに完了させ、同時に取り出し済みの残りのジョブの heartbeat を行う
+        (1度に取り出したジョブの処理が JobQueue の LOCK_TIMEOUT より長くかかっても、
+        他のワーカーの recover で pending に戻されない)。
+        中断された場合、処理していないジョブはキューに戻す。
+
+        Parameters
+        ----------
+        job_queue : JobQueue
+            ジョブキュー
+        kind : str
+            'race' (レース結果) or 'horse_results' (馬の過去成績)
+        batch_size : int, default 100
+            1度に取り出すジョブの数
+        skip_fresh : bool, default True
+            'horse_results' の場合に、新しいレースが無いと分かっている馬をスキップするか
+            (regist_horse_results を参照)
+        """
+        if kind == 'race':
+            regist = self.regist_race_results
+        elif kind == 'horse_results':
+            regist = partial(self.regist_horse_results, skip_fresh=skip_fresh)
+        else:
+            raise InvalidArgument("invalid argument of kind: '{}'".format(kind))
+
+        finished = set()
+
+        def on_finished(id: str, ok: bool) -> None:
+            if ok:
+                job_queue.complete(kind, [id])
+            else:
+                job_queue.fail(kind, id, self.errors.get(id))
+            finished.add(id)
+            job_queue.heartbeat()
+
+        while True:
+            id_list = job_queue.claim(kind, batch_size)
+            if not id_list:
+                break
+
+            finished.clear()
+            try:
+                ng_id_list = regist(id_list, on_finished=on_finished)
+            except BaseException:
+                job_queue.release(kind, id_list)
+                raise
+
+            # 登録の対象外となったジョブ (新しいレースが無い馬など) をまとめて完了させる
+            for id in set(ng_id_list) - finished:
+                job_queue.fail(kind, id, self.errors.get(id))
+            job_queue.complete(kind, set(id_list) - set(ng_id_list) - finished)
+
+    def _filter_stale_horses(self, horse_id_list: List[str]) -> List[str]:
+        """過去成績のページを取得する必要がある馬IDのみを返す
+
+        以下のいずれかに当てはまる馬を対象とする。
+            - 過去成績を1度も取得していない
+            - results に最終レース日より新しいレースが登録されている
+            - 最終確認日から FRESHNESS_MAX_AGE_DAYS 日以上経過している
+
+        新しいレースの有無は results に登録済みのレースで判断するため、results が最新でない場合
+        (レース結果を登録する前の出馬表の馬など) は、直近の出走を取りこぼすことがある。
+        その場合は regist_horse_results に skip_fresh=False を渡す。
+        """
+        df = self._dbm.select_horse_freshness(list(dict.fromkeys(horse_id_list)))
+        today = dt.date.today()
+        expire_date = int((today - dt.timedelta(days=FRESHNESS_MAX_AGE_DAYS)).strftime('%Y%m%d'))
+
+        is_stale = (
+            df['last_checked'].isna()
+            | (df['latest_result_date'] > df['last_race_date'].fillna(0))
+            | (df['last_checked'] < expire_date)
+        )
+        return df.index[is_stale].tolist()
+
+    def _update_horse_freshness(self, horse_id: str, last_race_date: pd.Timestamp) -> None:
+        sql = 'INSERT OR REPLACE INTO horse_freshness VALUES (?,?,?)'
+        last_race_date = int(last_race_date.strftime('%Y%m%d')) if pd.notna(last_race_date) else None
+        last_checked = int(dt.date.today().strftime('%Y%m%d'))
+        self._dbm.insert_data(sql, (horse_id, last_race_date, last_checked))
+
     def regist_horse_peds(self, horse_dict: Dict[str, str]):
-        for id, name in horse_dict.items():
-            if not self._dbm.is_id_inserted('horse', id):
-                sql = 'INSERT INTO horse VALUES (?,?,?,?,?,?,?,?)'
-                try:
-                    peds = scrape_horse_peds(id)
-                    data = (id, name, peds[0], peds[1], peds[2], peds[3], peds[4], peds[5])
-                except Exception as e:
-                    print("'{}' has been raised while scraping peds of horse_id:'{}' ({})".format(e.__class__.__name__, id))
-                    data = (id, name, None, None, None, None, None, None)
-
-                self._dbm.insert_data(sql, data)
+        """
+        馬をDBに登録し、血統の取得をバックグラウンドで予約する関数
+
+        血統は取得でき次第 _write_horse_peds で書き込まれる。
+        全ての血統の書き込みを待つ場合は wait_horse_peds を呼ぶ。
+
+        Parameters
+        ----------
+        horse_dict : dict[str, str]
+            馬ID -> 馬名
+        """
+        new_horse_dict = {id: name for id, name in horse_dict.items() if not self._ids.has('horse', id)}
+        sql = 'INSERT OR IGNORE INTO horse VALUES (?,?,?,?,?,?,?,?)'
+        self._dbm.execute_many(sql, ((id, name, None, None, None, None, None, None) for id, name in new_horse_dict.items()))
+        self._ids.add('horse', new_horse_dict.keys())
+        for id in new_horse_dict:
+            self._peds_queue.submit(id)
+
+    def regist_missing_horse_peds(self):
+        """血統が未登録の馬の血統の取得を予約する関数 (中断時の再開用)"""
+        for id in self._dbm.get_horse_id_list_without_peds():
+            self._peds_queue.submit(id)
+        self.wait_horse_peds()
+
+    def wait_horse_peds(self) -> None:
+        """予約済みの血統の取得を待ち、全て書き込む関数"""
+        self._peds_queue.join()
+        self._write_horse_peds()
+        if self._peds_queue.n_failed > 0:
+            print('Failed to scrape peds of {} horses.'.format(self._peds_queue.n_failed))
+
+    def _write_horse_peds(self) -> None:
+        data_list = []
+        for id, peds, error in self._peds_queue.drain():
+            if error is not None:
+                print("'{}' has been raised while scraping peds of horse_id:'{}'".format(error.__class__.__name__, id))
+                continue
+            if len(peds) < 6:
+                print("Peds of horse_id:'{}' are incomplete.".format(id))
+                continue
+            data_list.append((peds[0], peds[1], peds[2], peds[3], peds[4], peds[5], id))
+
+        if data_list:
+            sql = 'UPDATE horse SET father=?, mother=?, fathers_father=?, fathers_mother=?, ' \
+                  'mothers_father=?, mothers_mother=? WHERE id=?'
+            self._dbm.execute_many(sql, data_list)
 
     def _regist_jockey(self, jockey_dict: Dict[str, str]):
-        for id, name in jockey_dict.items():
-            if not self._dbm.is_id_inserted('jockey', id):
-                sql = 'INSERT INTO jockey VALUES (?,?)'
-                data = (id, name)
-                self._dbm.insert_data(sql, data)
+        new_jockey_dict = {id: name for id, name in jockey_dict.items() if not self._ids.has('jockey', id)}
+        sql = 'INSERT OR IGNORE INTO jockey VALUES (?,?)'
+        self._dbm.execute_many(sql, new_jockey_dict.items())
+        self._ids.add_jockeys(new_jockey_dict)
 
     def _regist_trainer(self, trainer_dict: Dict[str, str]):
-        for id, name in trainer_dict.items():
-            if not self._dbm.is_id_inserted('trainer', id):
-                sql = 'INSERT INTO trainer VALUES (?,?)'
-                data = (id, name)
-                self._dbm.insert_data(sql, data)
+        new_trainer_dict = {id: name for id, name in trainer_dict.items() if not self._ids.has('trainer', id)}
+        sql = 'INSERT OR IGNORE INTO trainer VALUES (?,?)'
+        self._dbm.execute_many(sql, new_trainer_dict.items())
+        self._ids.add('trainer', new_trainer_dict.keys())
 
     def _regist_race_info(self, race_id: str, race_info: Dict[str, str]):
         sql = 'INSERT INTO race_info VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)'
@@ -164,19 +393,16 @@ class Registar:
         self._dbm.insert_data(sql, data)
 
     def _regist_result(self, race_id: str, results: pd.DataFrame):
-        sql = 'INSERT INTO results VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'
-        for _, row in results.iterrows():
-            data = (race_id, row['馬番'], row['枠番'], row['着順'], row['horse_id'],
-                    row['性齢'], row['斤量'], row['jockey_id'], row['タイム'], row['着差'],
-                    row['通過'], row['上り'], row['単勝'], row['人気'], row['馬体重'],
-                    row['trainer_id'], row['馬主'], row['賞金（万円）'])
-            self._dbm.insert_data(sql, data)
+        sql = 'INSERT OR IGNORE INTO results VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'
+        columns = ['馬番', '枠番', '着順', 'horse_id', '性齢', '斤量', 'jockey_id', 'タイム', '着差',
+                   '通過', '上り', '単勝', '人気', '馬体重', 'trainer_id', '馬主', '賞金（万円）']
+        # 性齢と馬体重から計算した列 (sex, age, weight, weight_change) も保存する
+        self._dbm.execute_many(sql, ((race_id,) + row + derive_results_columns(row[4], row[13])
+                                     for row in results[columns].itertuples(index=False, name=None)))
 
     def _regist_payoff(self, race_id: str, payoff: pd.DataFrame):
         payoff_tmp = payoff.copy()
         payoff_tmp[2] = payoff_tmp[2].map(lambda x: re.findall(r'\d+,*\d+', x)[0]).str.replace(',', '').astype(int)
         payoff_tmp[3] = payoff_tmp[3].map(lambda x: re.findall(r'\d+', x)[0]).astype(int)
-        sql = 'INSERT INTO race_payoff VALUES (?,?,?,?,?)'
-        for row in payoff_tmp.itertuples(name=None):
-            data = (race_id, row[1], row[2], row[3], row[4])
-            self._dbm.insert_data(sql, data)
+        sql = 'INSERT OR IGNORE INTO race_payoff VALUES (?,?,?,?,?)'
+        self._dbm.execute_many(sql, ((race_id, row[1], row[2], row[3], row[4]) for row in payoff_tmp.itertuples(name=None)))
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import re
+from typing import Dict
+from common.dbapi import DBManager, reader_pool
+from common.utils import InvalidArgument
+
+
+DEFAULT_REPLICA_DIR = os.environ.get('KEIBA_REPLICA_DIR', './replica')
+# レプリカに複製するテーブル (行の追加は rowid で検出する)
+REPLICATED_TABLES = ['race_info', 'results', 'horse_results', 'race_payoff', 'horse', 'jockey', 'trainer']
+# 行が更新されるテーブル -> キーの列 (更新は change_log で検出する)
+UPDATED_TABLES = {'horse': 'id'}
+CHANGE_LOG_KEY = '_change_log'
+
+CREATE_REPLICA_STATE_SQL = '''CREATE TABLE if not exists "replica_state" (
+	"table_name"	TEXT NOT NULL,
+	"watermark"	INTEGER NOT NULL,
+	PRIMARY KEY("table_name")
+)'''
+
+
+def get_replica_path(master_path: str, replica_dir: str = DEFAULT_REPLICA_DIR) -> str:
+    """マスターのdbファイルに対応するレプリカのパス"""
+    # UNCパスもファイル名を取り出せるように、区切り文字は両方を扱う
+    return os.path.join(replica_dir, re.split(r'[\\/]', master_path)[-1])
+
+
+class Replica:
+    """ネットワーク共有上のDB (マスター) をローカルに複製するクラス
+
+    マスターは読み取り専用で開き、前回の同期以降に追加された行 (rowid が前回の
+    最大値より大きい行) と、change_log に記録された更新された行のみを複製する。
+    同期の状態はレプリカの replica_state に保存する。
+    マスターはマイグレーションしないため、スキーマのバージョンがレプリカと異なる場合は複製せずに例外を送出する。
+
+    Parameters
+    ----------
+    master_path : str
+        マスターのdbファイルへのパス
+    replica_path : str, optional
+        レプリカのdbファイルへのパス (省略時は get_replica_path で決める)
+    """
+
+    def __init__(self, master_path: str, replica_path: str = None) -> None:
+        self.master_path = master_path
+        self.replica_path = get_replica_path(master_path) if replica_path is None else replica_path
+
+    def _load_state(self, replica: DBManager) -> Dict[str, int]:
+        replica.update_data(CREATE_REPLICA_STATE_SQL)
+        df = replica.select_data('SELECT table_name, watermark FROM replica_state')
+        return dict(zip(df['table_name'], df['watermark']))
+
+    def sync(self) -> Dict[str, int]:
+        """マスターの変更をレプリカに反映する
+
+        Returns
+        -------
+        dict[str, int]
+            テーブル名 -> 反映した行数
+        """
+        replica_dir = os.path.dirname(self.replica_path)
+        if replica_dir:
+            os.makedirs(replica_dir, exist_ok=True)
+        # レプリカは書き込み用に開き、マスターと同じマイグレーションを適用する
+        replica = DBManager(self.replica_path)
+        state = self._load_state(replica)
+        n_rows = {}
+
+        with reader_pool.reader(self.master_path) as master:
+            # 行は列名を指定して複製するため、マスターとレプリカのスキーマが揃っていない場合は何も書き込まずに止める
+            # (マスターは読み取り専用で開くため、ここではマイグレーションしない)
+            master_version, replica_version = master.schema_version, replica.schema_version
+            if master_version != replica_version:
+                replica.close()
+                raise InvalidArgument(
+                    "Schema version of master '{}' is {}, but the replica requires {}. "
+                    "Open the master once with DBManager (e.g. run regist_worker.py) to migrate it.".format(
+                        self.master_path, master_version, replica_version))
+
+            for table_name in REPLICATED_TABLES:
+                watermark = state.get(table_name, 0)
+                n_rows[table_name] = 0
+                if master.get_max_rowid(table_name) < watermark:
+                    # マスターが作り直された場合は、全ての行を複製し直す
+                    watermark = 0
+                    replica.update_data('DELETE FROM {}'.format(table_name))
+
+                with replica.transaction():
+                    for columns, rows in master.iter_table_rows(table_name, watermark):
+                        sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                            table_name, ', '.join(columns[1:]), ','.join(['?'] * (len(columns) - 1)))
+                        replica.execute_many(sql, (row[1:] for row in rows))
+                        watermark = rows[-1][0]
+                        n_rows[table_name] += len(rows)
+                    replica.execute_many('INSERT OR REPLACE INTO replica_state VALUES (?,?)', [(table_name, watermark)])
+
+            # 更新された行を複製する (change_log が無い古いマスターの場合は何もしない)
+            if master.get_column_types('change_log'):
+                last_seq = state.get(CHANGE_LOG_KEY, 0)
+                change_log = master.select_change_log(last_seq)
+                with replica.transaction():
+                    for table_name, key_column in UPDATED_TABLES.items():
+                        key_list = list({key for _, name, key in change_log if name == table_name})
+                        if not key_list:
+                            continue
+                        columns, rows = master.select_rows_by_key(table_name, key_column, key_list)
+                        sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                            table_name, ', '.join(columns), ','.join(['?'] * len(columns)))
+                        replica.execute_many(sql, rows)
+                        n_rows[table_name] += len(rows)
+                    if change_log:
+                        replica.execute_many('INSERT OR REPLACE INTO replica_state VALUES (?,?)',
+                                             [(CHANGE_LOG_KEY, change_log[-1][0])])
+
+        replica.close()
+        return n_rows
+
+
+def sync_replica(master_path: str, replica_dir: str = DEFAULT_REPLICA_DIR) -> str:
+    """マスターをローカルのレプリカに同期し、レプリカのパスを返す"""
+    replica = Replica(master_path, get_replica_path(master_path, replica_dir))
+    replica.sync()
+    return replica.replica_path
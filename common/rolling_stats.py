@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import json
+from typing import List, Union
+import pandas as pd
+from common.dbapi import DBManager, SelectQuery
+from common.utils import InvalidArgument
+
+
+ROLLING_STATS_TABLE = 'horse_rolling_stats'
+DEFAULT_ROLLING_WINDOWS = [5, 9, 'all']
+
+# 平均を取る列 -> horse_results と race_info から計算する式 (HorseResults.preprocesing と同じ値)
+ROLLING_TARGET_COLUMNS = {
+    'arriving_order': "CASE WHEN typeof(arriving_order) IN ('integer', 'real') THEN arriving_order * 1.0 / horse_num END",
+    'popularity': 'popularity * 1.0 / horse_num',
+    'distance': 'distance * 1.0',
+    'goal_time': 'goal_time_sec / distance * 100',
+    'time_diff': 'time_diff',
+    'last_three_furlong': 'last_three_furlong',
+    'first_corner': 'first_corner * 1.0 / horse_num',
+    'last_corner': 'last_corner * 1.0 / horse_num',
+    'prise': 'prise',
+}
+
+CREATE_STATE_SQL = '''CREATE TABLE if not exists "rolling_stats_state" (
+	"table_name"	TEXT NOT NULL,
+	"windows"	TEXT NOT NULL,
+	"watermark"	INTEGER NOT NULL,
+	"race_info_watermark"	INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY("table_name")
+)'''
+
+# yyyymmdd の整数を julianday に渡せる日付に変換する
+DATE_SQL = "printf('%04d-%02d-%02d', date / 10000, date / 100 % 100, date % 100)"
+
+
+def get_rolling_columns(windows: List[Union[int, str]] = DEFAULT_ROLLING_WINDOWS) -> List[str]:
+    """集計した列の名前 (HorseResults.merge_all と同じ名前と順番)"""
+    columns = ['l_days']
+    for window in windows:
+        columns += ['{}_{}R'.format(column, window) for column in ROLLING_TARGET_COLUMNS]
+    return columns
+
+
+class RollingStats:
+    """馬ごとの過去 N 走の平均を、SQLite のウィンドウ関数で集計して保存するクラス
+
+    horse_results の各行 (馬, レース) について、そのレースより前に出走した
+    直近 N 走の平均と前走からの日数を ROLLING_STATS_TABLE に保存する。
+    値は HorseResults.merge_all と同じ列名・計算だが、horse_results に登録された
+    (馬, レース) の行のみを持つ。特徴量の作成は (race_id, horse_id) での結合となる。
+
+    集計は読み込み側 (DataProcessor.merge_rolling_stats) がローカルのレプリカで行う。
+    refresh では前回以降に過去成績が追加された馬と、前回以降に race_info が追加された
+    レースに出走した馬 (過去成績がレース情報より先に登録された場合) の行のみを集計し直す。
+    windows を変えた場合や、過去成績が作り直された場合はテーブルを作り直す。
+
+    Parameters
+    ----------
+    dbm : DBManager
+        集計を保存するDB (書き込み用に開いたレプリカ)
+    windows : list[int or str], default DEFAULT_ROLLING_WINDOWS
+        平均を取るレース数のリスト ('all' は全てのレース)
+    """
+
+    def __init__(self, dbm: DBManager, windows: List[Union[int, str]] = DEFAULT_ROLLING_WINDOWS) -> None:
+        for window in windows:
+            if window != 'all' and (not isinstance(window, int) or window < 1):
+                raise InvalidArgument("'windows' must be a list of positive int or 'all'")
+        self._dbm = dbm
+        self.windows = list(windows)
+
+    def _create_table_sql(self) -> str:
+        columns = ''.join('\t"{}"\tREAL,\n'.format(column) for column in get_rolling_columns(self.windows))
+        return ('CREATE TABLE "{}" (\n\t"horse_id"\tTEXT NOT NULL,\n\t"race_id"\tTEXT NOT NULL,\n'
+                '\t"date"\tINTEGER,\n{}\tPRIMARY KEY("horse_id","race_id")\n)').format(ROLLING_STATS_TABLE, columns)
+
+    def _select_sql(self) -> str:
+        """horse_results の各行について、それより前の出走を集計するSQL"""
+        items = ['julianday({0}) - julianday(LAG({0}) OVER w)'.format(DATE_SQL)]
+        for window in self.windows:
+            start = 'UNBOUNDED' if window == 'all' else str(window)
+            for column in ROLLING_TARGET_COLUMNS:
+                items.append('AVG({}) OVER (w ROWS BETWEEN {} PRECEDING AND 1 PRECEDING)'.format(column, start))
+        values = ', '.join('{} AS {}'.format(expr, column) for column, expr in ROLLING_TARGET_COLUMNS.items())
+        return ('SELECT horse_id, race_id, date, {} FROM ('
+                'SELECT horse_id, race_id, date, {} FROM horse_results INNER JOIN race_info USING(race_id) '
+                'WHERE horse_id IN (SELECT horse_id FROM temp.rolling_horses)) '
+                'WINDOW w AS (PARTITION BY horse_id ORDER BY date, race_id)').format(', '.join(items), values)
+
+    def refresh(self, full: bool = False) -> int:
+        """前回以降に過去成績またはレース情報が追加された馬の集計を更新する
+
+        Parameters
+        ----------
+        full : bool, default False
+            True の場合は全ての馬を集計し直す
+
+        Returns
+        -------
+        int
+            集計し直した馬の数
+        """
+        self._dbm.update_data(CREATE_STATE_SQL)
+        if 'race_info_watermark' not in self._dbm.get_column_types('rolling_stats_state'):
+            self._dbm.update_data('ALTER TABLE rolling_stats_state ADD COLUMN "race_info_watermark" INTEGER NOT NULL DEFAULT 0')
+        state = self._dbm.select_data(
+            "SELECT windows, watermark, race_info_watermark FROM rolling_stats_state WHERE table_name='{}'".format(
+                ROLLING_STATS_TABLE))
+        windows = json.dumps(self.windows)
+        max_rowid = self._dbm.get_max_rowid('horse_results')
+        max_race_info_rowid = self._dbm.get_max_rowid('race_info')
+        if (full or state.empty or state['windows'][0] != windows or max_rowid < int(state['watermark'][0])
+                or max_race_info_rowid < int(state['race_info_watermark'][0])):
+            watermark = 0
+            race_info_watermark = 0
+        else:
+            watermark = int(state['watermark'][0])
+            race_info_watermark = int(state['race_info_watermark'][0])
+
+        with self._dbm.transaction():
+            if watermark == 0:
+                self._dbm.update_data('DROP TABLE IF EXISTS {}'.format(ROLLING_STATS_TABLE))
+                self._dbm.update_data(self._create_table_sql())
+                self._dbm.update_data('CREATE INDEX idx_{0}_date ON {0}(date)'.format(ROLLING_STATS_TABLE))
+
+            # 集計し直す馬 (新しい過去成績より後の出走の集計も変わるため、馬ごとに集計し直す)
+            self._dbm.update_data('DROP TABLE IF EXISTS temp.rolling_horses')
+            self._dbm.update_data('CREATE TEMP TABLE rolling_horses (horse_id TEXT PRIMARY KEY)')
+            self._dbm.insert_data('INSERT INTO temp.rolling_horses SELECT DISTINCT horse_id FROM horse_results WHERE rowid>?',
+                                  (watermark,))
+            # 過去成績より後に登録されたレース情報は、結合できるようになった馬の集計を変える
+            self._dbm.insert_data('INSERT OR IGNORE INTO temp.rolling_horses SELECT DISTINCT horse_id FROM horse_results '
+                                  'WHERE race_id IN (SELECT race_id FROM race_info WHERE rowid>?)', (race_info_watermark,))
+            self._dbm.update_data(
+                'DELETE FROM {} WHERE horse_id IN (SELECT horse_id FROM temp.rolling_horses)'.format(ROLLING_STATS_TABLE))
+            self._dbm.update_data('INSERT INTO {} {}'.format(ROLLING_STATS_TABLE, self._select_sql()))
+            n_horses = int(self._dbm.select_data('SELECT COUNT(*) AS n FROM temp.rolling_horses')['n'][0])
+            self._dbm.update_data('DROP TABLE temp.rolling_horses')
+
+            self._dbm.execute_many('INSERT OR REPLACE INTO rolling_stats_state VALUES (?,?,?,?)',
+                                   [(ROLLING_STATS_TABLE, windows, max_rowid, max_race_info_rowid)])
+
+        return n_horses
+
+    def select(self, begin_date: int = None, end_date: int = None) -> pd.DataFrame:
+        """集計を読み込む (開催日の範囲は yyyymmdd、両端を含む)"""
+        query = SelectQuery(ROLLING_STATS_TABLE, ['race_id', 'horse_id'] + get_rolling_columns(self.windows))
+        if begin_date is not None:
+            query.where('date>=?', begin_date)
+        if end_date is not None:
+            query.where('date<=?', end_date)
+        return self._dbm.select_query(query)
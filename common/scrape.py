@@ -3,23 +3,38 @@ import sys
 import os
 sys.path.append(os.pardir)
 from typing import Dict, Tuple, Union, List
+import numpy as np
 import pandas as pd
-import requests
 import re
 from bs4 import BeautifulSoup
 import time
-from selenium import webdriver
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.support.ui import Select, WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
+import math
+from urllib.parse import urlencode
+try:
+    # selenium はHTTPでのID取得に失敗した場合のフォールバックにのみ使う
+    from selenium import webdriver
+    from webdriver_manager.chrome import ChromeDriverManager
+    from selenium.webdriver.support.ui import Select, WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+    from selenium.webdriver.common.by import By
+except ImportError:
+    webdriver = None
+from common.crawler import Crawler
+from common.fetch import Page, fetch_page
+from common.parser import get_parser
 from common.utils import DATE_PATTERN
 
 
 GROUND_STATE_LIST = ['良', '稍', '重', '不']
 WEATHER_LIST = ['曇', '晴', '雨', '小雨', '小雪', '雪']
+RACE_SEARCH_URL = 'https://db.netkeiba.com/'
+RACE_SEARCH_LIST_NUM = 100
+RACE_LIST_SUB_URL = 'https://race.netkeiba.com/top/race_list_sub.html'
+RE_WHITESPACE = re.compile(r'[\r\n]+|\s{2,}')
+RACE_INFO_URL = 'https://db.sp.netkeiba.com/race/'
+HORSE_RESULTS_URL = 'https://db.netkeiba.com/horse/result/'
 
 
 def scrape_race_info(race_id: str) -> Tuple[Dict[str, Union[str, int]], pd.DataFrame, pd.DataFrame]:
@@ -39,18 +54,24 @@ def scrape_race_info(race_id: str) -> Tuple[Dict[str, Union[str, int]], pd.DataF
     payoff_table : pandas.DataFrame
         払い戻し表
     """
-    time.sleep(1)
-    url = 'https://db.sp.netkeiba.com/race/' + race_id
+    return parse_race_info(fetch_race_info_page(race_id))
+
+
+def fetch_race_info_page(race_id: str) -> Page:
+    """レース結果のページを取得する関数 (解析は parse_race_info で行う)"""
+    return fetch_page(RACE_INFO_URL + race_id)
 
-    html = requests.get(url)
-    html.encoding = 'EUC-JP'
-    soup = BeautifulSoup(html.text, 'html.parser')
-    result_table = soup.find('table', attrs={'class': 'table_slide_body ResultsByRaceDetail'})
+
+def parse_race_info(page: Page) -> Tuple[Dict[str, Union[str, int]], pd.DataFrame, pd.DataFrame]:
+    """レース結果のページを解析する関数 (戻り値は scrape_race_info と同じ)"""
+    parser = get_parser()
+    root = parser.root(page)
+    result_table = parser.find(root, 'table', 'table_slide_body ResultsByRaceDetail')
 
     # race_info
     info_dict = {}
-    info_dict['title'] = soup.find('span', attrs={'class': 'RaceName_main'}).text
-    info_text = soup.find('div', attrs={'class': 'RaceData'}).text
+    info_dict['title'] = parser.text(parser.find(root, 'span', 'RaceName_main'))
+    info_text = parser.text(parser.find(root, 'div', 'RaceData'))
 
     # race_type, turn
     if '障' in info_text:
@@ -87,31 +108,28 @@ def scrape_race_info(race_id: str) -> Tuple[Dict[str, Union[str, int]], pd.DataF
         info_dict['weather'] = None
 
     # date
-    date_text = soup.find('span', attrs={'class': 'Race_Date'}).text
+    date_text = parser.text(parser.find(root, 'span', 'Race_Date'))
     info_dict['date'] = re.search(DATE_PATTERN, date_text).group()
 
     # horse_id
     horse_id_list = []
-    horse_a_list = result_table.find_all('a', attrs={'href': re.compile('/horse/.*/')})
-    for a in horse_a_list:
-        horse_id = a['href'].removeprefix('https://db.sp.netkeiba.com/horse/').removesuffix('/')
+    for href in parser.hrefs(result_table, '/horse/.*/'):
+        horse_id = href.removeprefix('https://db.sp.netkeiba.com/horse/').removesuffix('/')
         horse_id_list.append(horse_id)
 
     # jockey_id
     jockey_id_list = []
-    jockey_a_list = result_table.find_all('a', attrs={'href': re.compile('/jockey/.*/')})
-    for a in jockey_a_list:
-        jockey_id = a['href'].removeprefix('https://db.sp.netkeiba.com/jockey/').removesuffix('/')
+    for href in parser.hrefs(result_table, '/jockey/.*/'):
+        jockey_id = href.removeprefix('https://db.sp.netkeiba.com/jockey/').removesuffix('/')
         jockey_id_list.append(jockey_id)
 
     # trainer_id
     trainer_id_list = []
-    trainer_a_list = result_table.find_all('a', attrs={'href': re.compile('/trainer/.*/')})
-    for a in trainer_a_list:
-        trainer_id = a['href'].removeprefix('https://db.sp.netkeiba.com/trainer/').removesuffix('/')
+    for href in parser.hrefs(result_table, '/trainer/.*/'):
+        trainer_id = href.removeprefix('https://db.sp.netkeiba.com/trainer/').removesuffix('/')
         trainer_id_list.append(trainer_id)
 
-    df_list = pd.read_html(url)
+    df_list = page.tables
     df = df_list[0]
     df['horse_id'] = horse_id_list
     df['jockey_id'] = jockey_id_list
@@ -130,6 +148,24 @@ def scrape_race_info(race_id: str) -> Tuple[Dict[str, Union[str, int]], pd.DataF
     return info_dict, df, payoff_table
 
 
+def scrape_race_exists(race_id: str) -> bool:
+    """レース結果のページが存在するかを確認する関数
+
+    取得したページはキャッシュされるため、続く scrape_race_info では再取得しない。
+
+    Parameters
+    ----------
+    race_id : str
+        レースID
+
+    Returns
+    -------
+    bool
+        レース結果が存在するか
+    """
+    return 'ResultsByRaceDetail' in fetch_race_info_page(race_id).text
+
+
 def scrape_horse_peds(horse_id: str) -> pd.DataFrame:
     """馬の血統(2世代前まで)をスクレイピングする関数
 
@@ -140,21 +176,29 @@ def scrape_horse_peds(horse_id: str) -> pd.DataFrame:
 
     Returns
     -------
-    peds_df : pandas.DataFrame
+    peds_df : pandas.Series
         馬の血統表 (2世代前まで)
     """
-    time.sleep(1)
     url = 'https://db.netkeiba.com/horse/' + horse_id
-    df = pd.read_html(url)[2]
+    return parse_horse_peds(fetch_page(url), horse_id)
+
 
-    generations = {}
-    columns_num = len(df.columns)
-    for i in reversed(range(columns_num)):
-        generations[i] = df[i]
-        df.drop([i], axis=1, inplace=True)
-        df = df.drop_duplicates()
+def parse_horse_peds(page: Page, horse_id: str) -> pd.Series:
+    """馬のページから血統表を解析する関数 (戻り値は scrape_horse_peds と同じ)
 
-    peds_df = pd.concat([generations[i] for i in range(columns_num)], ignore_index=True).rename(horse_id)
+    血統表のセルを1度だけ走査し、rowspan の大きい順 (父母 -> 祖父母) に並べる。
+    """
+    parser = get_parser()
+    blood_table = parser.find(parser.root(page), 'table', 'blood_table')
+
+    cells = []
+    for td in parser.find_all(blood_table, 'td'):
+        # pandas.read_html と同じ空白の正規化
+        name = RE_WHITESPACE.sub(' ', parser.text(td).strip())
+        cells.append((int(parser.attr(td, 'rowspan', 1)), name if name else np.nan))
+    cells.sort(key=lambda cell: -cell[0])
+
+    peds_df = pd.Series([name for _, name in cells], name=horse_id, dtype=object)
     return peds_df
 
 
@@ -173,17 +217,20 @@ def scrape_race_card(race_id: str, date: int) -> pd.DataFrame:
     race_card_df : pd.DataFrame
         出馬表
     """
-    time.sleep(1)
     url = 'https://race.netkeiba.com/race/shutuba.html?race_id=' + race_id
-    df = pd.read_html(url)[0]
+    return parse_race_card(fetch_page(url), race_id, date)
+
+
+def parse_race_card(page: Page, race_id: str, date: int) -> pd.DataFrame:
+    """出馬表のページを解析する関数 (戻り値は scrape_race_card と同じ)"""
+    df = page.tables[0]
     df = df.T.reset_index(level=0, drop=True).T
 
-    html = requests.get(url)
-    html.encoding = 'EUC-JP'
-    soup = BeautifulSoup(html.text, 'html.parser')
+    parser = get_parser()
+    root = parser.root(page)
 
     # レース情報
-    info_texts = soup.find('div', attrs={'class': 'RaceData01'}).text
+    info_texts = parser.text(parser.find(root, 'div', 'RaceData01'))
     info = re.findall(r'\w+', info_texts)
 
     if '障' in info_texts:
@@ -213,30 +260,27 @@ def scrape_race_card(race_id: str, date: int) -> pd.DataFrame:
     df['horse_num'] = [len(df)] * len(df)
 
     # 優勝賞金
-    prise_text = soup.find('div', attrs={'class': 'RaceList_Item02'}).text
+    prise_text = parser.text(parser.find(root, 'div', 'RaceList_Item02'))
     prise_text = re.findall(r'本賞金:\d*', prise_text)[0]
     prise = int(re.findall(r'\d+', prise_text)[0])
     df['win_prise'] = [prise] * len(df)
 
     # horse_id
     horse_id_list = []
-    horse_td_list = soup.find_all('td', attrs={'class': 'HorseInfo'})
-    for td in horse_td_list:
-        horse_id = re.findall(r'\d+', td.find('a')['href'])
+    for td in parser.find_all(root, 'td', 'HorseInfo'):
+        horse_id = re.findall(r'\d+', parser.hrefs(td)[0])
         horse_id_list.append(horse_id[0])
 
     # jockey_id
     jockey_id_list = []
-    jockey_td_list = soup.find_all('td', attrs={'class': 'Jockey'})
-    for td in jockey_td_list:
-        jockey_id = re.findall(r'\d+', td.find('a')['href'])
+    for td in parser.find_all(root, 'td', 'Jockey'):
+        jockey_id = re.findall(r'\d+', parser.hrefs(td)[0])
         jockey_id_list.append(jockey_id[0])
 
     # trainer_id
     trainer_id_list = []
-    trainer_td_list = soup.find_all('td', attrs={'class': 'Trainer'})
-    for td in trainer_td_list:
-        trainer_id = re.findall(r'\d+', td.find('a')['href'])
+    for td in parser.find_all(root, 'td', 'Trainer'):
+        trainer_id = re.findall(r'\d+', parser.hrefs(td)[0])
         trainer_id_list.append(trainer_id[0])
 
     df['horse_id'] = horse_id_list
@@ -260,29 +304,31 @@ def scrape_horse_results(horse_id: str, with_jockey_id: bool = True) -> pd.DataF
     pd.DataFrame
         結果df
     """
-    time.sleep(1)
-    url = 'https://db.netkeiba.com/horse/result/' + horse_id
+    return parse_horse_results(fetch_horse_results_page(horse_id), with_jockey_id)
+
+
+def fetch_horse_results_page(horse_id: str) -> Page:
+    """馬の過去結果のページを取得する関数 (解析は parse_horse_results で行う)"""
+    return fetch_page(HORSE_RESULTS_URL + horse_id)
 
-    html = requests.get(url)
-    html.encoding = 'EUC-JP'
-    soup = BeautifulSoup(html.text, 'html.parser')
-    result_table = soup.find('table', attrs={'class': 'db_h_race_results nk_tb_common'})
 
-    race_a_list = result_table.find_all('a', attrs={'href': re.compile('^/race')})
+def parse_horse_results(page: Page, with_jockey_id: bool = True) -> pd.DataFrame:
+    """馬の過去結果のページを解析する関数 (戻り値は scrape_horse_results と同じ)"""
+    parser = get_parser()
+    result_table = parser.find(parser.root(page), 'table', 'db_h_race_results nk_tb_common')
+
     race_id_list = []
-    for a in race_a_list:
-        href = a['href']
+    for href in parser.hrefs(result_table, '^/race'):
         if not ('list' in href or 'sum' in href or 'movie' in href):
             race_id_list.append(href.removeprefix('/race/').removesuffix('/'))
 
     if with_jockey_id:
-        jockey_a_list = result_table.find_all('a', attrs={'href': re.compile('^/jockey')})
         jockey_id_list = []
-        for a in jockey_a_list:
-            jockey_id = a['href'].removeprefix('/jockey/').removesuffix('/')
+        for href in parser.hrefs(result_table, '^/jockey'):
+            jockey_id = href.removeprefix('/jockey/').removesuffix('/')
             jockey_id_list.append(jockey_id)
 
-    df = pd.read_html(url)[0]
+    df = page.tables[0]
 
     df.loc[df['レース名'].notna(), 'race_id'] = race_id_list
     if with_jockey_id:
@@ -291,7 +337,151 @@ def scrape_horse_results(horse_id: str, with_jockey_id: bool = True) -> pd.DataF
     return df
 
 
+def _race_search_url(
+        start_year: int,
+        end_year: int,
+        start_month: int,
+        end_month: int,
+        only_jra: bool,
+        page_no: int = 1
+    ) -> str:
+    # race_search_detail のフォームと同じパラメータ
+    params = [
+        ('pid', 'race_list'),
+        ('word', ''),
+        ('start_year', str(start_year)),
+        ('start_mon', str(start_month)),
+        ('end_year', str(end_year)),
+        ('end_mon', str(end_month)),
+    ]
+    if only_jra:
+        params += [('jyo[]', str(i).zfill(2)) for i in range(1, 11)]
+    params += [('sort', 'date'), ('list', str(RACE_SEARCH_LIST_NUM))]
+    if page_no > 1:
+        params.append(('page', str(page_no)))
+    return RACE_SEARCH_URL + '?' + urlencode(params)
+
+
+def _parse_race_search_page(page: Page) -> Tuple[List[str], int]:
+    """検索結果ページからレースIDのリストと総件数を取得する"""
+    race_table = page.soup.find('table', attrs={'class': 'race_table_01'})
+    if race_table is None:
+        return [], 0
+
+    race_id_list = []
+    for tr in race_table.find_all('tr')[1:]:
+        a = tr.find_all('td')[4].find('a')
+        race_id_list.append(re.findall(r'/race/(\w+)/', a['href'])[0])
+
+    # 例: "1,234件中1～100件目"
+    pager = page.soup.find('div', attrs={'class': 'pager'})
+    match = re.search(r'([\d,]+)件中', pager.text) if pager is not None else None
+    total = int(match.group(1).replace(',', '')) if match else len(race_id_list)
+    return race_id_list, total
+
+
 def scrape_period_race_id_list(
+        start_year: int,
+        end_year: int,
+        start_month: int = 1,
+        end_month: int = 12,
+        only_jra: bool = True,
+        use_selenium: bool = False
+    ) -> List[str]:
+    """期間内のレースIDをスクレイピングする関数
+
+    race_search_detail のフォームの送信先をHTTPで直接取得し、
+    1ページ目で総件数が分かった後は残りのページを並行して取得する。
+    HTTPでの取得に失敗した場合は selenium による取得にフォールバックする。
+
+    Parameters
+    ----------
+    start_year : int
+        開始年
+    end_year : int
+        終了年
+    start_month : int, default 1
+        開始月
+    end_month : int, default 12
+        終了月
+    only_jra : bool, default True
+        中央競馬のレースのみに絞るか
+    use_selenium : bool, default False
+        最初から selenium で取得するか
+
+    Returns
+    -------
+    list[str]
+        レースIDのリスト
+    """
+    if use_selenium:
+        return _scrape_period_race_id_list_selenium(start_year, end_year, start_month, end_month, only_jra)
+
+    try:
+        url = _race_search_url(start_year, end_year, start_month, end_month, only_jra)
+        race_id_list, total = _parse_race_search_page(fetch_page(url))
+
+        page_num = math.ceil(total / RACE_SEARCH_LIST_NUM)
+        url_list = [_race_search_url(start_year, end_year, start_month, end_month, only_jra, page_no)
+                    for page_no in range(2, page_num + 1)]
+        race_id_dict = {}
+        for url, page, error in Crawler().map(fetch_page, url_list):
+            if error is not None:
+                raise error
+            race_id_dict[url] = _parse_race_search_page(page)[0]
+    except Exception as e:
+        if webdriver is None:
+            raise
+        print("'{}' has been raised while scraping race id list. Retry with selenium.".format(e.__class__.__name__))
+        return _scrape_period_race_id_list_selenium(start_year, end_year, start_month, end_month, only_jra)
+
+    # ページ順に並べる
+    for url in url_list:
+        race_id_list += race_id_dict[url]
+    return race_id_list
+
+
+def scrape_race_card_id_list(race_date: str, use_selenium: bool = False) -> List[str]:
+    """開催日の出馬表のレースIDをスクレイピングする関数
+
+    race_list.html がJavaScriptで読み込んでいる race_list_sub.html をHTTPで直接取得する。
+    HTTPでの取得に失敗した場合は selenium による取得にフォールバックする。
+
+    Parameters
+    ----------
+    race_date : str
+        開催日 (yyyymmdd)
+    use_selenium : bool, default False
+        最初から selenium で取得するか
+
+    Returns
+    -------
+    list[str]
+        レースIDのリスト
+    """
+    if use_selenium:
+        return _scrape_race_card_id_list_selenium(race_date)
+
+    try:
+        page = fetch_page(RACE_LIST_SUB_URL + '?' + urlencode({'kaisai_date': race_date}))
+    except Exception as e:
+        if webdriver is None:
+            raise
+        print("'{}' has been raised while scraping race id list. Retry with selenium.".format(e.__class__.__name__))
+        return _scrape_race_card_id_list_selenium(race_date)
+
+    race_id_list = []
+    for elem in page.soup.find_all('li', attrs={'class': 'RaceList_DataItem'}):
+        a_tag = elem.find('a')
+        if a_tag:
+            match = re.findall(r'/race/shutuba\.html\?race_id=(\d+)', a_tag.get('href', ''))
+            if len(match) > 0:
+                race_id_list.append(match[0])
+
+    return race_id_list
+
+
+def _scrape_period_race_id_list_selenium(
         start_year: int,
         end_year: int,
         start_month: int = 1,
@@ -366,7 +556,7 @@ def scrape_period_race_id_list(
     return race_id_list
 
 
-def scrape_race_card_id_list(race_date: str) -> List[str]:
+def _scrape_race_card_id_list_selenium(race_date: str) -> List[str]:
 
     url = "https://race.netkeiba.com/top/race_list.html?kaisai_date=" + race_date
 
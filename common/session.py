@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import random
+import threading
+import time
+from typing import Dict, Tuple, Union
+import requests
+from requests.adapters import HTTPAdapter
+from common.crawler import rate_limiter
+
+
+# (接続, 読み込み) のタイムアウト [秒]
+DEFAULT_TIMEOUT = (10.0, 30.0)
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUS_LIST = [429, 500, 502, 503, 504]
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+
+class FetchStats:
+    """HTTPリクエストの回数と受信サイズ、キャッシュヒット数を集計するクラス"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+            self.bytes = 0
+            self.cache_hits = 0
+
+    def add(self, n_bytes: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.bytes += n_bytes
+
+    def add_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def add_cache_hit(self) -> None:
+        with self._lock:
+            self.cache_hits += 1
+
+
+# 全スクレイパーで共有する集計
+fetch_stats = FetchStats()
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session(pool_maxsize: int = POOL_MAXSIZE) -> requests.Session:
+    """コネクションプールを持つセッションを生成する関数
+
+    リトライは get で行うため、アダプタ自体のリトライは無効にする。
+
+    Parameters
+    ----------
+    pool_maxsize : int, default POOL_MAXSIZE
+        ホストごとに保持するコネクション数の上限
+
+    Returns
+    -------
+    requests.Session
+        セッション
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """全スクレイパーで共有する keep-alive セッションを返す関数"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def _backoff(n_retry: int, retry_after: Union[str, None] = None) -> float:
+    # Retry-After が指定されていればそれに従う
+    if retry_after is not None and retry_after.isdigit():
+        return min(float(retry_after), BACKOFF_MAX)
+
+    # 指数バックオフ (上限の半分 + ランダムな揺らぎ)
+    delay = min(BACKOFF_MAX, BACKOFF_FACTOR * (2 ** n_retry))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def get(
+        url: str,
+        headers: Dict[str, str] = None,
+        timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+        max_retries: int = MAX_RETRIES
+    ) -> requests.Response:
+    """共有セッションでGETリクエストを送信する関数
+
+    接続エラー、タイムアウトと RETRY_STATUS_LIST のステータスは、
+    指数バックオフを挟んで max_retries 回までリトライする。
+    リトライも rate_limiter の制限に従う。
+
+    Parameters
+    ----------
+    url : str
+        URL
+    headers : dict[str, str], optional
+        リクエストヘッダ
+    timeout : tuple[float, float], default DEFAULT_TIMEOUT
+        (接続, 読み込み) のタイムアウト [秒]
+    max_retries : int, default MAX_RETRIES
+        リトライ回数の上限
+
+    Returns
+    -------
+    requests.Response
+        レスポンス (リトライを使い切った場合は最後のレスポンス)
+    """
+    session = get_session()
+    n_retry = 0
+    while True:
+        rate_limiter.acquire(url)
+        try:
+            response = session.get(url, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if n_retry >= max_retries:
+                raise
+            retry_after = None
+        else:
+            fetch_stats.add(len(response.content))
+            if response.status_code not in RETRY_STATUS_LIST or n_retry >= max_retries:
+                return response
+            retry_after = response.headers.get('Retry-After')
+
+        fetch_stats.add_retry()
+        time.sleep(_backoff(n_retry, retry_after))
+        n_retry += 1
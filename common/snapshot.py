@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.pardir)
+import datetime as dt
+import glob
+import json
+import shutil
+from typing import Dict, List
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+from common.dbapi import reader_pool
+from common.utils import InvalidArgument
+
+
+DEFAULT_SNAPSHOT_DIR = os.environ.get('KEIBA_SNAPSHOT_DIR', './snapshot')
+MANIFEST_NAME = '_manifest.json'
+
+# スナップショット名 -> race_info と結合して年ごとに分割するテーブル
+PARTITIONED_TABLES = {
+    'results': 'results',
+    'horse_results': 'horse_results',
+}
+PEDS_COLUMNS = ['id', 'father', 'mother', 'fathers_father', 'fathers_mother', 'mothers_father', 'mothers_mother']
+
+
+def _check_pyarrow() -> None:
+    if pa is None:
+        raise ImportError('pyarrow is required for snapshots.')
+
+
+def _arrow_type(sqlite_type: str) -> 'pa.DataType':
+    if sqlite_type == 'INTEGER':
+        return pa.int64()
+    if sqlite_type == 'REAL':
+        return pa.float64()
+    # TEXT と NUMERIC (数値と文字列が混在する) は文字列として保存する
+    return pa.string()
+
+
+def _to_arrow(df: pd.DataFrame, schema: 'pa.Schema') -> 'pa.Table':
+    df = df.copy()
+    for field in schema:
+        if pa.types.is_string(field.type):
+            df[field.name] = df[field.name].map(lambda x: x if x is None or isinstance(x, str) or pd.isna(x) else str(x))
+    return pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+
+
+class Snapshot:
+    """DBのテーブルを列指向のファイル (Parquet) に書き出したローカルのスナップショット
+
+    results と horse_results は race_info と結合し、開催年ごとに
+    '<名前>/year=<年>/part-<rowid>.parquet' に分割して保存する。
+    前回の書き出し以降に追加された行 (rowid が前回の最大値より大きい行) のみを追記する。
+    horse (血統) は行が更新されるため、毎回全体を書き直す。
+
+    Parameters
+    ----------
+    snapshot_dir : str, default DEFAULT_SNAPSHOT_DIR
+        スナップショットのディレクトリ
+    """
+
+    def __init__(self, snapshot_dir: str = DEFAULT_SNAPSHOT_DIR) -> None:
+        _check_pyarrow()
+        self.snapshot_dir = snapshot_dir
+        self._manifest_path = os.path.join(snapshot_dir, MANIFEST_NAME)
+
+    def _load_manifest(self) -> Dict[str, Dict]:
+        if not os.path.exists(self._manifest_path):
+            return {}
+        with open(self._manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest: Dict[str, Dict]) -> None:
+        tmp_path = self._manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self._manifest_path)
+
+    @staticmethod
+    def _write_table(table: 'pa.Table', path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def update(self, db_path: str, full: bool = False) -> Dict[str, int]:
+        """DBに追加された行をスナップショットに書き出す
+
+        Parameters
+        ----------
+        db_path : str
+            dbファイルへのパス
+        full : bool, default False
+            True の場合は既存のスナップショットを削除して全ての行を書き出す
+
+        Returns
+        -------
+        dict[str, int]
+            スナップショット名 -> 書き出した行数
+        """
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        manifest = {} if full else self._load_manifest()
+        n_rows = {}
+
+        with reader_pool.reader(db_path) as dbm:
+            race_info_types = dbm.get_column_types('race_info')
+            for name, table_name in PARTITIONED_TABLES.items():
+                types = dbm.get_column_types(table_name)
+                types.update({k: v for k, v in race_info_types.items() if k not in types})
+                schema = pa.schema([(column, _arrow_type(t)) for column, t in types.items()])
+
+                # 列が追加された場合 (マイグレーション後) は、古いファイルと列が揃わないため全て書き直す
+                if full or (name in manifest and manifest[name].get('columns') != schema.names):
+                    shutil.rmtree(os.path.join(self.snapshot_dir, name), ignore_errors=True)
+                    manifest.pop(name, None)
+                last_rowid = manifest.get(name, {}).get('watermark', 0)
+
+                df = dbm.select_rows_since(table_name, last_rowid)
+                n_rows[name] = len(df)
+                if df.empty:
+                    continue
+
+                # 同じ watermark からの書き出しは同じファイル名になるため、中断後の再実行でも重複しない
+                for year, df_year in df.groupby(df['date'] // 10000):
+                    path = os.path.join(self.snapshot_dir, name, 'year={}'.format(year),
+                                        'part-{:012d}.parquet'.format(last_rowid))
+                    self._write_table(_to_arrow(df_year, schema), path)
+
+                manifest[name] = {
+                    'watermark': int(df['_rowid'].max()),
+                    'columns': schema.names,
+                    'updated_at': dt.datetime.now().isoformat(timespec='seconds')
+                }
+                self._save_manifest(manifest)
+
+            types = dbm.get_column_types('horse')
+            schema = pa.schema([(column, _arrow_type(types[column])) for column in PEDS_COLUMNS])
+            df = dbm.select_data('SELECT {} FROM horse'.format(', '.join(PEDS_COLUMNS)))
+            self._write_table(_to_arrow(df, schema), os.path.join(self.snapshot_dir, 'horse.parquet'))
+            n_rows['horse'] = len(df)
+            manifest['horse'] = {'updated_at': dt.datetime.now().isoformat(timespec='seconds')}
+            self._save_manifest(manifest)
+
+        return n_rows
+
+    def compact(self) -> None:
+        """年ごとに分かれたファイルを1つにまとめる"""
+        for name in PARTITIONED_TABLES:
+            for year_dir in glob.glob(os.path.join(self.snapshot_dir, name, 'year=*')):
+                paths = sorted(glob.glob(os.path.join(year_dir, 'part-*.parquet')))
+                if len(paths) < 2:
+                    continue
+                table = pa.concat_tables([pq.read_table(p) for p in paths])
+                # 最初のファイルに上書きし、残りを削除する
+                self._write_table(table, paths[0])
+                for p in paths[1:]:
+                    os.remove(p)
+
+    def read(
+            self,
+            name: str,
+            columns: List[str] = None,
+            begin_date: int = None,
+            end_date: int = None,
+            race_type_list: List[str] = None
+        ) -> pd.DataFrame:
+        """スナップショットを読み込む
+
+        対象の年のファイルのみを読み込み、存在しない列は無視する。
+
+        Parameters
+        ----------
+        name : str
+            'results' or 'horse_results'
+        columns : list[str], optional
+            読み込む列 (省略時は全ての列)
+        begin_date, end_date : int, optional
+            開催日の範囲 (yyyymmdd、両端を含む)
+        race_type_list : list[str], optional
+            レースの種類
+        """
+        if name not in PARTITIONED_TABLES:
+            raise InvalidArgument("invalid argument of name: '{}'".format(name))
+        path = os.path.join(self.snapshot_dir, name)
+        if not os.path.isdir(path):
+            raise FileNotFoundError("Snapshot '{}' does not exist. Run snapshot.py first.".format(path))
+
+        dataset = ds.dataset(path, format='parquet', partitioning='hive')
+        expr = None
+        conditions = []
+        if begin_date is not None:
+            conditions += [ds.field('year') >= begin_date // 10000, ds.field('date') >= begin_date]
+        if end_date is not None:
+            conditions += [ds.field('year') <= end_date // 10000, ds.field('date') <= end_date]
+        if race_type_list is not None:
+            conditions.append(ds.field('race_type').isin(race_type_list))
+        for condition in conditions:
+            expr = condition if expr is None else expr & condition
+
+        if columns is not None:
+            columns = [c for c in columns if c in dataset.schema.names and c != 'year']
+        else:
+            columns = [c for c in dataset.schema.names if c != 'year']
+        return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+    def read_peds(self) -> pd.DataFrame:
+        """血統のスナップショットを読み込む (index: 馬ID)"""
+        path = os.path.join(self.snapshot_dir, 'horse.parquet')
+        if not os.path.exists(path):
+            raise FileNotFoundError("Snapshot '{}' does not exist. Run snapshot.py first.".format(path))
+        return pq.read_table(path).to_pandas().set_index('id')
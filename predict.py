@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from ast import arg
+import os
 import sys
 import pandas as pd
 import numpy as np
@@ -13,11 +14,15 @@ from common.data_processor import (
     split_data
 )
 from common.db_config import db_config
+from common.feature_store import FeatureStore
 from common.utils import InvalidArgument
 from sklearn.model_selection import train_test_split
 
 
-RESULTS_M_PKL_PATH = "./results_m_2015_2021.pickle"
+RESULTS_BEGIN_DATE = 20150101
+RESULTS_END_DATE = 20211231
+# 過去成績の結合 (作り直す月をまとめて計算する) に使うプロセスの数
+MERGE_N_WORKERS = os.cpu_count() or 1
 
 
 def main(args):
@@ -29,15 +34,17 @@ def main(args):
     today = int(dt.datetime.today().strftime('%Y%m%d'))
     rc = RaceCard.scrape([race_id], today)
 
-    #r = Results.read_db(db_config['main'], begin_date=20150101, end_date=20211231, flat_only=True)
-    r = Results.read_pickle(RESULTS_M_PKL_PATH)
-    hr = HorseResults.read_db(db_config['main'])
-    #r.merge_horse_results(hr)
+    r = Results.read_db(db_config['main'], begin_date=RESULTS_BEGIN_DATE, end_date=RESULTS_END_DATE, flat_only=True)
+    hr = HorseResults.read_db(db_config['main'], n_workers=MERGE_N_WORKERS)
+    # 過去成績の結合は、前回までに処理した開催日は保存済みの特徴量を使い、新しい開催日のみ計算する
+    r.merge_horse_results(hr, feature_store=FeatureStore(db_config['feature_store']), incremental=True)
 
     p = Peds.read_db(db_config['main'])
     r.merge_peds(p)
 
+    # 出馬表は出走する馬の行のみ計算する (過去成績の並べ替えは上の結合で済んでいる)
     rc.merge_horse_results(hr)
+    hr.close()
     rc.merge_peds(p)
 
     r.process_categorical()
@@ -3,12 +3,18 @@ import sys
 import datetime as dt
 from common.register import Registar
 from common.db_config import db_config
+from common.job_queue import JobQueue
+from common.page_cache import page_cache
 from common.utils import InvalidArgument
 from common.scrape import scrape_period_race_id_list
 
 
 def main(args):
     # 引数処理
+    # --replay: キャッシュ済みのページのみを再解析する (ネットワークには接続しない)
+    if '--replay' in args:
+        page_cache.set_mode('replay')
+        args = [arg for arg in args if arg != '--replay']
     if len(args) != 3:
         raise InvalidArgument('It needs 2 arguments.')
     if not args[1].isdigit() or not args[2].isdigit():
@@ -30,7 +36,13 @@ def main(args):
                                               end_month=month)
 
     reg = Registar(db_config['main'])
-    reg.regist_race_results(race_id_list)
+    job_queue = JobQueue(db_config['queue'])
+    # 前回中断したジョブを再開する
+    job_queue.recover()
+    job_queue.enqueue('race', race_id_list)
+    reg.drain_jobs(job_queue, 'race')
+    reg.close()
+    print(job_queue.counts('race'))
     print('Finished.')
 
 
@@ -1,24 +1,32 @@
 # -*- coding: utf-8 -*-
 import sys
-from common.utils import InvalidArgument, create_race_id_list
+from common.utils import InvalidArgument
+from common.job_queue import JobQueue
+from common.race_id_prober import RaceIdProber
 from common.register import Registar
 from common.db_config import db_config
+from common.page_cache import page_cache
 
 
-def regist_per_year(register, year_list):
+def regist_per_year(register, prober, job_queue, year_list):
     for year in year_list:
         try:
-            race_id_list = create_race_id_list(year)
+            # 探索 (ネットワークへの接続) はキューのロックを取る前に済ませる
+            job_queue.enqueue('race', list(prober.iter_race_id_list(year)))
         except InvalidArgument as e:
             print(e)
             break
 
-        register.regist_race_results(race_id_list)
+        register.drain_jobs(job_queue, 'race')
         print("Race data of {} has been inserted successfully.".format(year))
 
 
 def main(args):
     # 引数処理
+    # --replay: キャッシュ済みのページのみを再解析する (ネットワークには接続しない)
+    if '--replay' in args:
+        page_cache.set_mode('replay')
+        args = [arg for arg in args if arg != '--replay']
     if len(args) < 2:
         raise InvalidArgument('Arguments are too short. It needs 2 argumens at least.')
 
@@ -30,15 +38,21 @@ def main(args):
             raise InvalidArgument('Arguments must be numeric.')
 
     reg = Registar(db_config['main'])
+    prober = RaceIdProber(db_config['main'])
+    job_queue = JobQueue(db_config['queue'])
+    # 前回中断したジョブを再開する
+    job_queue.recover()
     for year in year_list:
         try:
-            race_id_list = create_race_id_list(year)
+            # 開催が無い範囲を飛ばしながらレースIDを生成する (キューのロックを取る前に全て生成する)
+            job_queue.enqueue('race', list(prober.iter_race_id_list(year)))
         except InvalidArgument as e:
             print(e)
             continue
 
-        reg.regist_race_results(race_id_list)
-
+    reg.drain_jobs(job_queue, 'race')
+    reg.close()
+    print(job_queue.counts('race'))
     print("Race data of {} has been inserted successfully.".format(year))
 
 
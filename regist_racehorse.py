@@ -2,12 +2,13 @@
 import sys
 import re
 import datetime as dt
+from common.crawler import Crawler
+from common.job_queue import JobQueue
 from common.register import Registar
 from common.db_config import db_config
 from common.scrape import DATE_PATTERN, scrape_race_card, scrape_race_card_id_list
 from common.utils import InvalidArgument
 from tqdm import tqdm
-import joblib
 
 
 def main(args):
@@ -28,19 +29,29 @@ def main(args):
         print('"race_id_list" is null.')
         return
 
+    # 出馬表をまとめて取得し、全レースの出走馬を一括で登録する
+    horse_dict = {}
+    scraped_list = Crawler().map(scrape_race_card, race_id_list, date=int(race_date))
+    for race_id, race_card, error in tqdm(scraped_list, total=len(race_id_list)):
+        if error is not None:
+            print("'{}' has been raised with race_id:'{}' ({})".format(error.__class__.__name__, race_id, error.args[0]))
+            continue
+        horse_dict.update(zip(race_card['horse_id'], race_card['馬名']))
+
     reg = Registar(db_config['main'])
-    ng_horse_id_list = []
-    for race_id in tqdm(race_id_list):
-        try:
-            race_card = scrape_race_card(race_id, int(race_date))
-            reg.regist_horse_peds(dict(zip(race_card['horse_id'], race_card['馬名'])))
-            ng_horse_id_list += reg.regist_horse_results(race_card['horse_id'].to_list(), tqdm_leave=False)
-        except Exception as e:
-            print("'{}' has been raised with race_id:'{}' ({})".format(e.__class__.__name__, race_id, e.args[0]))
-
-    if ng_horse_id_list:
-        print("There is ng_horse_id_list.")
-        joblib.dump(ng_horse_id_list, 'error_id_list.pkl')
+    # 血統はバックグラウンドで取得しながら過去成績を登録する
+    reg.regist_horse_peds(horse_dict)
+    job_queue = JobQueue(db_config['queue'])
+    job_queue.recover()
+    job_queue.enqueue('horse_results', horse_dict.keys())
+    # 直近のレースは results に未登録のことがあるため、最終確認日に関わらず全ての出走馬を取得し直す
+    reg.drain_jobs(job_queue, 'horse_results', skip_fresh=False)
+    reg.wait_horse_peds()
+    reg.close()
+
+    counts = job_queue.counts('horse_results')
+    if counts['failed'] > 0 or counts['pending'] > 0:
+        print("There are unfinished horse_results jobs. ({})".format(counts))
 
     print('Finished')
 
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import sys
+from common.db_config import db_config
+from common.job_queue import JOB_KIND_LIST, JobQueue
+from common.register import Registar
+
+
+def main(args):
+    # 引数処理
+    # --retry-failed: 失敗したジョブを再実行する
+    job_queue = JobQueue(db_config['queue'])
+    if '--retry-failed' in args:
+        print('{} failed jobs are retried.'.format(job_queue.retry_failed()))
+
+    # 複数のワーカーを同時に起動しても、同じジョブは1つのワーカーしか取り出さない
+    job_queue.recover()
+    reg = Registar(db_config['main'])
+    for kind in JOB_KIND_LIST:
+        reg.drain_jobs(job_queue, kind)
+        print(kind, job_queue.counts(kind))
+    reg.close()
+
+    print('Finished.')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
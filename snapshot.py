@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import sys
+from common.db_config import db_config
+from common.snapshot import Snapshot
+
+
+def main(args):
+    # 引数処理
+    # --full: スナップショットを作り直す
+    # --compact: 年ごとのファイルを1つにまとめる
+    snapshot = Snapshot(db_config['snapshot'])
+    n_rows = snapshot.update(db_config['main'], full='--full' in args)
+    for name, n in n_rows.items():
+        print('{}: {} rows'.format(name, n))
+
+    if '--compact' in args:
+        snapshot.compact()
+
+    print('Finished.')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
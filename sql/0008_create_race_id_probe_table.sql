@@ -0,0 +1,8 @@
+CREATE TABLE if not exists "race_id_probe" (
+	"year"		INTEGER NOT NULL,
+	"place_id"	INTEGER NOT NULL,
+	"hold_no"	INTEGER NOT NULL,
+	"hold_day"	INTEGER NOT NULL,
+	"checked_at"	INTEGER,
+	PRIMARY KEY("year","place_id","hold_no","hold_day")
+)
\ No newline at end of file
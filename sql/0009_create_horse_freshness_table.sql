@@ -0,0 +1,6 @@
+CREATE TABLE if not exists "horse_freshness" (
+	"horse_id"	TEXT NOT NULL UNIQUE,
+	"last_race_date"	INTEGER,
+	"last_checked"	INTEGER,
+	PRIMARY KEY("horse_id")
+)
\ No newline at end of file
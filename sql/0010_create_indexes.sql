@@ -0,0 +1,7 @@
+-- 検索で使う列のインデックス
+-- (horse_results の horse_id での検索は主キー (horse_id, race_id) のインデックスを使う)
+CREATE INDEX if not exists "race_info_date_race_type" ON "race_info" ("date", "race_type");
+CREATE INDEX if not exists "results_horse_id" ON "results" ("horse_id");
+CREATE INDEX if not exists "results_jockey_id" ON "results" ("jockey_id");
+CREATE INDEX if not exists "jockey_name" ON "jockey" ("name");
+ANALYZE;
\ No newline at end of file
@@ -0,0 +1,12 @@
+-- レプリカへの同期用の変更履歴 (行の追加は rowid で検出し、更新はこの履歴で検出する)
+CREATE TABLE if not exists "change_log" (
+	"seq"	INTEGER NOT NULL,
+	"table_name"	TEXT NOT NULL,
+	"row_key"	TEXT NOT NULL,
+	"changed_at"	TEXT,
+	PRIMARY KEY("seq" AUTOINCREMENT)
+);
+CREATE TRIGGER if not exists "horse_update_log" AFTER UPDATE ON "horse"
+BEGIN
+	INSERT INTO change_log (table_name, row_key, changed_at) VALUES ('horse', NEW.id, datetime('now', 'localtime'));
+END;
\ No newline at end of file
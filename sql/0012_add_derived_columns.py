@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# results と horse_results に、文字列の列から計算した型付きの列を追加し、既存の行を埋める
+import sqlite3
+from common.derived_columns import parse_corner_pass, parse_goal_time, parse_horse_weight, parse_sex_age
+
+
+ADD_COLUMNS_SQL = '''
+ALTER TABLE results ADD COLUMN "sex" TEXT;
+ALTER TABLE results ADD COLUMN "age" INTEGER;
+ALTER TABLE results ADD COLUMN "weight" INTEGER;
+ALTER TABLE results ADD COLUMN "weight_change" INTEGER;
+ALTER TABLE horse_results ADD COLUMN "goal_time_sec" REAL;
+ALTER TABLE horse_results ADD COLUMN "first_corner" INTEGER;
+ALTER TABLE horse_results ADD COLUMN "last_corner" INTEGER;
+'''
+
+BACKFILL_SQL = '''
+UPDATE results SET
+    sex = derived_sex(sex_age),
+    age = derived_age(sex_age),
+    weight = derived_weight(horse_weight),
+    weight_change = derived_weight_change(horse_weight);
+UPDATE horse_results SET
+    goal_time_sec = derived_goal_time_sec(goal_time),
+    first_corner = derived_first_corner(corner_pass),
+    last_corner = derived_last_corner(corner_pass);
+'''
+
+
+def upgrade(conn: sqlite3.Connection) -> None:
+    # 登録時と同じ関数で計算するため、SQLから呼べるように登録する
+    conn.create_function('derived_sex', 1, lambda x: parse_sex_age(x)[0], deterministic=True)
+    conn.create_function('derived_age', 1, lambda x: parse_sex_age(x)[1], deterministic=True)
+    conn.create_function('derived_weight', 1, lambda x: parse_horse_weight(x)[0], deterministic=True)
+    conn.create_function('derived_weight_change', 1, lambda x: parse_horse_weight(x)[1], deterministic=True)
+    conn.create_function('derived_goal_time_sec', 1, parse_goal_time, deterministic=True)
+    conn.create_function('derived_first_corner', 1, lambda x: parse_corner_pass(x)[0], deterministic=True)
+    conn.create_function('derived_last_corner', 1, lambda x: parse_corner_pass(x)[1], deterministic=True)
+
+    for sql in (ADD_COLUMNS_SQL + BACKFILL_SQL).split(';'):
+        if sql.strip():
+            conn.execute(sql)
@@ -0,0 +1,2 @@
+-- horse_results の列名の誤記 (pupularity) を、results と同じ popularity に直す
+ALTER TABLE "horse_results" RENAME COLUMN "pupularity" TO "popularity";